@@ -1,13 +1,18 @@
 # tvf_app/test_requests/admin.py
 from django.contrib import admin
+from django.template.response import TemplateResponse
+from django.urls import path
 from django.contrib.auth.models import Group # Import Group model
 from .models import (
     Customer, Project, TVFType, TVFEnvironment, PlasticCodeLookup,
     DispatchMethod, TVFStatus, TestRequest, TestRequestPlasticCode,
     TestRequestInputFile, TestRequestPAN, TestRequestQuality,
     TestRequestShipping, TestRequestPhaseDefinition, TestRequestPhaseLog,
-    AuditLog, RejectReason, TrustportFolder
+    AuditLog, RejectReason, TrustportFolder, TVFNumberSequence, PDFRenderJob,
+    Holiday, QueueCounter,
 )
+from .audit import AUDITED_MODELS
+from .audit_archive import add_usernames, audit_history
 
 # Register your models here.
 
@@ -66,6 +71,12 @@ class TestRequestPhaseDefinitionAdmin(admin.ModelAdmin):
     search_fields = ('name',)
     list_editable = ('order',)
 
+@admin.register(Holiday)
+class HolidayAdmin(admin.ModelAdmin):
+    list_display = ('date', 'name')
+    search_fields = ('name',)
+    date_hierarchy = 'date'
+
 @admin.register(RejectReason) # New Admin for RejectReason
 class RejectReasonAdmin(admin.ModelAdmin):
     list_display = ('reason', 'description')
@@ -102,14 +113,14 @@ class TestRequestPhaseLogInline(admin.TabularInline):
 @admin.register(TestRequest)
 class TestRequestAdmin(admin.ModelAdmin):
     list_display = ('tvf_number', 'tvf_name', 'customer', 'project', 'tvf_initiator', 'status', 'current_phase', 'is_rejected', 'request_received_date', 'request_ship_date', 'tvf_completed_date', 'run_today')
-    list_filter = ('customer', 'project', 'tvf_type', 'tvf_environment', 'status', 'current_phase', 'tvf_pin_mailer', 'is_rejected', 'run_today')
+    list_filter = ('customer', 'project', 'tvf_type', 'tvf_environment', 'status', 'current_phase', 'queue', 'tvf_pin_mailer', 'is_rejected', 'run_today')
     search_fields = ('tvf_number__iexact', 'tvf_name__icontains', 'cr_number__iexact', 'customer__name__icontains', 'project__name__icontains', 'tvf_initiator__username__icontains')
     raw_id_fields = ('customer', 'project', 'tvf_initiator', 'tvf_type', 'tvf_environment', 'status', 'current_phase', 'rejected_by', 'rejected_reason', 'trustport_folder_actual')
-    readonly_fields = ('tvf_number', 'last_status_update')
+    readonly_fields = ('tvf_number', 'last_status_update', 'queue')
 
     fieldsets = (
         (None, {
-            'fields': ('cr_number', 'customer', 'project', 'tvf_name', 'tvf_initiator', 'tvf_type', 'tvf_environment', 'tvf_pin_mailer', 'status', 'current_phase', 'run_today')
+            'fields': ('cr_number', 'customer', 'project', 'tvf_name', 'tvf_initiator', 'tvf_type', 'tvf_environment', 'tvf_pin_mailer', 'status', 'current_phase', 'queue', 'run_today')
         }),
         ('Dates', {
             'fields': ('request_received_date', 'request_ship_date', 'tvf_completed_date', 'last_status_update')
@@ -129,6 +140,25 @@ class TestRequestAdmin(admin.ModelAdmin):
     # Example: inlines = [TestRequestPlasticCodeInline, TestRequestInputFileInline, TestRequestPhaseLogInline]
 
 
+@admin.register(TVFNumberSequence)
+class TVFNumberSequenceAdmin(admin.ModelAdmin):
+    list_display = ('name', 'last_value')
+
+@admin.register(QueueCounter)
+class QueueCounterAdmin(admin.ModelAdmin):
+    list_display = ('queue', 'customer', 'count')
+    list_filter = ('queue', 'customer')
+    readonly_fields = ('queue', 'customer', 'count') # Maintained by the transitions; fix drift with reconcile_queue_counters
+
+@admin.register(PDFRenderJob)
+class PDFRenderJobAdmin(admin.ModelAdmin):
+    list_display = ('pk', 'test_request', 'requested_by', 'status', 'attempts', 'worker', 'created_at', 'finished_at')
+    list_filter = ('status',)
+    search_fields = ('test_request__tvf_number', 'requested_by__username')
+    raw_id_fields = ('test_request', 'requested_by')
+    readonly_fields = ('created_at', 'started_at', 'finished_at', 'worker', 'attempts')
+
+
 @admin.register(TestRequestInputFile)
 class TestRequestInputFileAdmin(admin.ModelAdmin):
     list_display = ('test_request', 'file_name', 'card_qty', 'pin_qty', 'date_file_received')
@@ -178,4 +208,31 @@ class AuditLogAdmin(admin.ModelAdmin):
     list_display = ('timestamp', 'user', 'action', 'model_name', 'record_id', 'field_name', 'new_value')
     list_filter = ('action', 'model_name', 'user')
     search_fields = ('model_name', 'record_id', 'field_name', 'old_value', 'new_value', 'user__username')
-    readonly_fields = ('timestamp', 'user', 'action', 'model_name', 'record_id', 'field_name', 'old_value', 'new_value', 'change_details')
\ No newline at end of file
+    readonly_fields = ('timestamp', 'user', 'action', 'model_name', 'record_id', 'field_name', 'old_value', 'new_value', 'change_details')
+    change_list_template = 'admin/test_requests/auditlog/change_list.html'
+
+    # Rows older than TVF_AUDIT_RETENTION_DAYS live in the archive (see audit_archive.py);
+    # the record history page searches both
+    RECORD_HISTORY_LIMIT = 500
+
+    def get_urls(self):
+        return [
+            path('record_history/', self.admin_site.admin_view(self.record_history_view), name='test_requests_auditlog_record_history'),
+        ] + super().get_urls()
+
+    def record_history_view(self, request):
+        model_name = request.GET.get('model_name', '')
+        record_id = request.GET.get('record_id', '').strip()
+        entries = []
+        if model_name and record_id:
+            entries = add_usernames(audit_history(model_name, record_id, limit=self.RECORD_HISTORY_LIMIT))
+        return TemplateResponse(request, 'admin/test_requests/auditlog/record_history.html', {
+            **self.admin_site.each_context(request),
+            'opts': self.model._meta,
+            'title': "Audit history",
+            'model_names': [model._meta.model_name for model in AUDITED_MODELS],
+            'model_name': model_name,
+            'record_id': record_id,
+            'entries': entries,
+            'limit': self.RECORD_HISTORY_LIMIT,
+        })
\ No newline at end of file
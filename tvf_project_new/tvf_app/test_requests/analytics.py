@@ -0,0 +1,174 @@
+# tvf_app/test_requests/analytics.py
+from datetime import timedelta
+
+import numpy as np
+from django.core.cache import cache
+from django.utils import timezone
+
+from .models import Customer, Project, TestRequestPhaseDefinition, TestRequestPhaseLog, TVFEnvironment, TVFType
+
+# Windows (in days) a coach can look back over
+ANALYTICS_WINDOWS = (30, 90, 180, 365)
+DEFAULT_ANALYTICS_WINDOW = 90
+
+# Dimension name -> (column of the phase-log query, model naming the groups)
+DIMENSIONS = {
+    'customer': ('test_request__customer_id', Customer),
+    'project': ('test_request__project_id', Project),
+    'tvf_type': ('test_request__tvf_type_id', TVFType),
+    'environment': ('test_request__tvf_environment_id', TVFEnvironment),
+}
+
+PERCENTILES = (50, 90, 99)
+
+# Histogram bin edges, in hours; the last bin is open-ended
+HISTOGRAM_EDGES_HOURS = (0, 1, 4, 8, 24, 48, 72, 120, 240, 480)
+
+# How long computed statistics are served from the cache before the next request recomputes them
+ANALYTICS_CACHE_TIMEOUT = 10 * 60
+
+LOG_COLUMNS = (
+    'test_request_id', 'phase_name_id', 'start_time', 'end_time',
+    'test_request__request_received_date', 'test_request__tvf_completed_date',
+)
+
+
+def _epoch_seconds(values):
+    return np.fromiter((value.timestamp() if value else np.nan for value in values), dtype=np.float64, count=len(values))
+
+
+def load_phase_log_columns(since, dimension=None):
+    """
+    Phase logs that started at or after `since`, as a dict of NumPy arrays (one query).
+    Times are epoch seconds (NaN when unset); ids are int64 (-1 when unset). With a
+    `dimension`, its group id is loaded as the 'group' column.
+    """
+    columns = list(LOG_COLUMNS)
+    if dimension:
+        columns.append(DIMENSIONS[dimension][0])
+    rows = list(TestRequestPhaseLog.objects.filter(start_time__gte=since).values_list(*columns))
+    values = list(zip(*rows)) if rows else [()] * len(columns)
+
+    def ids(column):
+        return np.fromiter((-1 if v is None else v for v in column), dtype=np.int64, count=len(column))
+
+    data = {
+        'tvf': ids(values[0]),
+        'phase': ids(values[1]),
+        'start': _epoch_seconds(values[2]),
+        'end': _epoch_seconds(values[3]),
+        'received': _epoch_seconds(values[4]),
+        'completed': _epoch_seconds(values[5]),
+    }
+    data['group'] = ids(values[6]) if dimension else np.zeros(len(rows), dtype=np.int64)
+    return data
+
+
+def grouped_statistics(keys, values):
+    """
+    Count, percentiles and histogram of `values` (minutes) for every distinct row of `keys`
+    (an (n, k) int array), without a Python loop over the values: the values are sorted within
+    their key, and each percentile is interpolated (as np.percentile does) from segment offsets.
+    Returns (unique keys, counts, percentiles of shape (groups, len(PERCENTILES)), histograms).
+    """
+    if not len(values):
+        return keys[:0], np.zeros(0, dtype=np.int64), np.zeros((0, len(PERCENTILES))), \
+            np.zeros((0, len(HISTOGRAM_EDGES_HOURS)), dtype=np.int64)
+
+    unique_keys, group_index = np.unique(keys, axis=0, return_inverse=True)
+    group_index = group_index.reshape(-1)
+    order = np.lexsort((values, group_index))
+    sorted_values = values[order]
+    counts = np.bincount(group_index, minlength=len(unique_keys))
+    starts = np.concatenate(([0], np.cumsum(counts)[:-1]))
+
+    positions = (counts - 1)[:, None] * (np.array(PERCENTILES) / 100.0)[None, :]
+    lower = np.floor(positions).astype(np.int64)
+    upper = np.minimum(lower + 1, (counts - 1)[:, None])
+    low_values = sorted_values[starts[:, None] + lower]
+    high_values = sorted_values[starts[:, None] + upper]
+    percentiles = low_values + (high_values - low_values) * (positions - lower)
+
+    edges_minutes = np.array(HISTOGRAM_EDGES_HOURS, dtype=np.float64) * 60
+    bins = np.searchsorted(edges_minutes, values, side='right') - 1
+    bins = np.clip(bins, 0, len(edges_minutes) - 1)
+    histograms = np.bincount(
+        group_index * len(edges_minutes) + bins, minlength=len(unique_keys) * len(edges_minutes),
+    ).reshape(len(unique_keys), len(edges_minutes))
+    return unique_keys, counts, percentiles, histograms
+
+
+def _stat_rows(counts, percentiles, histograms):
+    for count, values, histogram in zip(counts, percentiles, histograms):
+        row = {'count': int(count)}
+        row.update({f'p{p}': round(float(v), 1) for p, v in zip(PERCENTILES, values)})
+        row['histogram'] = histogram.tolist()
+        yield row
+
+
+def compute_cycle_time_analytics(days=DEFAULT_ANALYTICS_WINDOW, dimension=None, now=None):
+    """
+    Time-in-phase (per phase) and end-to-end cycle time (request received to completed) over
+    the last `days` days, in minutes, optionally per `dimension` group ('customer', 'project',
+    'tvf_type' or 'environment'). Only closed phase logs count towards time in phase; a TVF
+    counts towards cycle time when it was completed in the window.
+    """
+    now = now or timezone.now()
+    since = now - timedelta(days=days)
+    data = load_phase_log_columns(since, dimension)
+
+    closed = ~np.isnan(data['end'])
+    phase_minutes = (data['end'][closed] - data['start'][closed]) / 60
+    phase_keys = np.column_stack((data['group'][closed], data['phase'][closed]))
+    phase_groups = grouped_statistics(phase_keys, phase_minutes)
+
+    # One value per TVF: its logs share the received and completed dates
+    _, first_rows = np.unique(data['tvf'], return_index=True)
+    completed = data['completed'][first_rows]
+    finished = completed >= since.timestamp()
+    cycle_minutes = (completed[finished] - data['received'][first_rows][finished]) / 60
+    cycle_groups = grouped_statistics(data['group'][first_rows][finished][:, None], cycle_minutes)
+
+    phases = {pk: (name, order) for pk, name, order in TestRequestPhaseDefinition.objects.values_list('pk', 'name', 'order')}
+    group_ids = set(phase_groups[0][:, 0].tolist()) | set(cycle_groups[0][:, 0].tolist())
+    group_names = {}
+    if dimension and group_ids:
+        group_names = dict(DIMENSIONS[dimension][1].objects.filter(pk__in=group_ids).values_list('pk', 'name'))
+
+    def group(group_id):
+        if not dimension:
+            return None
+        return {'id': int(group_id), 'name': group_names.get(int(group_id), 'Unknown')}
+
+    phase_rows = [
+        {'group': group(key[0]), 'phase': phases.get(int(key[1]), ('Unknown', 0))[0], **stats}
+        for key, stats in zip(phase_groups[0], _stat_rows(*phase_groups[1:]))
+    ]
+    phase_order = dict(phases.values())
+    phase_rows.sort(key=lambda row: ((row['group'] or {}).get('name', ''), phase_order.get(row['phase'], 0)))
+    cycle_rows = [{'group': group(key[0]), **stats} for key, stats in zip(cycle_groups[0], _stat_rows(*cycle_groups[1:]))]
+    cycle_rows.sort(key=lambda row: (row['group'] or {}).get('name', ''))
+
+    return {
+        'window_days': days,
+        'dimension': dimension,
+        'since': since.isoformat(),
+        'generated_at': now.isoformat(),
+        'unit': 'minutes',
+        'percentiles': list(PERCENTILES),
+        'histogram_edges_hours': list(HISTOGRAM_EDGES_HOURS),
+        'phase_logs': int(len(data['tvf'])),
+        'time_in_phase': phase_rows,
+        'cycle_time': cycle_rows,
+    }
+
+
+def get_cycle_time_analytics(days=DEFAULT_ANALYTICS_WINDOW, dimension=None):
+    """
+    compute_cycle_time_analytics(), cached per window and dimension for ANALYTICS_CACHE_TIMEOUT.
+    """
+    return cache.get_or_set(
+        f'tvf:analytics:cycle_time:{days}:{dimension or "all"}',
+        lambda: compute_cycle_time_analytics(days, dimension),
+        ANALYTICS_CACHE_TIMEOUT,
+    )
@@ -4,3 +4,7 @@ from django.apps import AppConfig
 class TestRequestsConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'test_requests'
+
+    def ready(self):
+        # Connect signal receivers defined outside models.py
+        from . import audit, pdf_cache, queue_counters, reference_data, roles, sla, versioning, workflow  # noqa: F401
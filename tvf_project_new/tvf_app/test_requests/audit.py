@@ -0,0 +1,359 @@
+# tvf_app/test_requests/audit.py
+import atexit
+import contextvars
+import json
+import logging
+import os
+import queue
+import threading
+import time
+from datetime import datetime, timezone as dt_timezone
+from pathlib import Path
+
+from django.conf import settings
+from django.core.exceptions import FieldDoesNotExist
+from django.db import DatabaseError, close_old_connections, transaction
+from django.db.models.signals import post_delete, post_save, pre_save
+from django.utils import timezone
+
+from .models import (
+    AuditLog, TestRequest, TestRequestInputFile, TestRequestPAN, TestRequestPlasticCode,
+    TestRequestQuality, TestRequestShipping,
+)
+
+logger = logging.getLogger(__name__)
+
+# TestRequest and its child models; every field change on them is captured
+AUDITED_MODELS = (
+    TestRequest, TestRequestPlasticCode, TestRequestInputFile, TestRequestPAN, TestRequestQuality, TestRequestShipping,
+)
+# Fields that change on every save, or are derived from audited ones, and would only add noise
+IGNORED_FIELDS = frozenset({'last_status_update', 'queue'})
+
+ACTION_CREATED = 'created'
+ACTION_UPDATED = 'updated'
+ACTION_DELETED = 'deleted'
+
+# Entries written per INSERT, and the longest an entry waits in the queue before being written
+AUDIT_BATCH_SIZE = 200
+AUDIT_FLUSH_INTERVAL = 2.0
+# Entries held in memory; past this they go straight to the spool file
+AUDIT_QUEUE_SIZE = 10000
+DEFAULT_SPOOL_DIRNAME = 'audit_spool'
+
+# The current request, whose user is the one audited (see AuditUserMiddleware). The request is held
+# rather than its lazy user: asgiref inspects context values when switching threads under ASGI,
+# which would load the user from inside the event loop
+_current_request = contextvars.ContextVar('tvf_audit_request', default=None)
+
+_STOP = object()
+
+
+def current_user_id():
+    user = getattr(_current_request.get(), 'user', None)
+    return user.pk if user is not None and user.is_authenticated else None
+
+
+def _display(value):
+    if value is None:
+        return None
+    if isinstance(value, datetime) and timezone.is_aware(value):
+        value = value.astimezone(dt_timezone.utc) # The database and the instance may hold the same instant in different zones
+    return str(value)
+
+
+def _audited_fields(model):
+    return [field for field in model._meta.concrete_fields if not field.primary_key and field.name not in IGNORED_FIELDS]
+
+
+def make_entry(action, instance_or_model, record_id, field_name=None, old_value=None, new_value=None, details=None, user_id=None):
+    """
+    One AuditLog row as a JSON-serialisable dict, so it can sit in the queue or the spool file.
+    """
+    return {
+        'timestamp': timezone.now().isoformat(),
+        'user_id': user_id if user_id is not None else current_user_id(),
+        'action': action,
+        'model_name': instance_or_model._meta.model_name,
+        'record_id': _display(record_id) or '',
+        'field_name': field_name,
+        'old_value': _display(old_value),
+        'new_value': _display(new_value),
+        'change_details': json.dumps(details) if details else None,
+    }
+
+
+def instance_changes(instance, old_values=None):
+    """
+    Entries for a saved instance: one 'created' entry holding every field, or one 'updated' entry
+    per field whose value differs from `old_values` ({attname: value}).
+    """
+    fields = _audited_fields(type(instance))
+    if old_values is None:
+        values = {field.attname: _display(field.value_from_object(instance)) for field in fields}
+        return [make_entry(ACTION_CREATED, instance, instance.pk, details=values)]
+    entries = []
+    for field in fields:
+        old, new = old_values.get(field.attname), field.value_from_object(instance)
+        if _display(old) != _display(new):
+            entries.append(make_entry(ACTION_UPDATED, instance, instance.pk, field.name, old, new))
+    return entries
+
+
+def form_changes(form, created):
+    """
+    Entries for a ModelForm's instance written in bulk (see persistence.py). The old values
+    come from the form's initial data, so no extra query is needed.
+    """
+    instance = form.instance
+    if created:
+        return instance_changes(instance)
+    entries = []
+    for name in form.changed_data:
+        try:
+            field = instance._meta.get_field(name)
+        except FieldDoesNotExist: # Form-only fields such as DELETE
+            continue
+        if not field.concrete or field.name in IGNORED_FIELDS:
+            continue
+        old, new = form.initial.get(name), field.value_from_object(instance)
+        if _display(old) != _display(new):
+            entries.append(make_entry(ACTION_UPDATED, instance, instance.pk, field.name, old, new))
+    return entries
+
+
+def field_changes(model, pk, changes):
+    """
+    'updated' entries for a row changed with a queryset UPDATE; `changes` maps attnames to (old, new).
+    """
+    entries = []
+    for attname, (old, new) in changes.items():
+        field = model._meta.get_field(attname)
+        if field.name not in IGNORED_FIELDS and _display(old) != _display(new):
+            entries.append(make_entry(ACTION_UPDATED, model, pk, field.name, old, new))
+    return entries
+
+
+def deletion(model, pk, details=None):
+    return make_entry(ACTION_DELETED, model, pk, details=details)
+
+
+def record(entries):
+    """
+    Queues `entries` once the current transaction commits; changes that roll back are not audited.
+    """
+    if entries:
+        transaction.on_commit(lambda: writer.record(entries))
+
+
+class AuditWriter:
+    """
+    Buffers audit entries in memory and writes them with bulk_create, AUDIT_BATCH_SIZE at a time
+    or AUDIT_FLUSH_INTERVAL seconds after the first pending entry, whichever comes first.
+
+    In the web server process start() runs a background thread that does the writing, so
+    requests never wait on audit INSERTs, and whatever is still queued is written at exit.
+    Elsewhere (management commands, tests) nothing is queued: entries are written by the
+    thread that records them, so none are left for an exit hook to write against whatever
+    database is configured by then. Entries that cannot be written (database down, queue
+    full) are appended to a spool file and replayed when the writer next starts.
+    """
+    def __init__(self, batch_size=AUDIT_BATCH_SIZE, flush_interval=AUDIT_FLUSH_INTERVAL,
+                 queue_size=AUDIT_QUEUE_SIZE, spool_dir=None):
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self._spool_dir = spool_dir
+        self._queue = queue.Queue(maxsize=queue_size)
+        self._lock = threading.Lock()
+        self._thread = None
+        self._pid = None
+        self._stop_at_exit = False
+
+    @property
+    def spool_dir(self):
+        # Resolved lazily so settings overrides (e.g. in tests) are honoured
+        return Path(self._spool_dir or getattr(settings, 'TVF_AUDIT_SPOOL_DIR', Path(settings.BASE_DIR) / DEFAULT_SPOOL_DIRNAME))
+
+    @property
+    def running(self):
+        # A thread started before a fork (e.g. gunicorn --preload) does not exist in the worker
+        return self._thread is not None and self._pid == os.getpid() and self._thread.is_alive()
+
+    def start(self):
+        """
+        Starts the background writer thread (once per process), which first replays the spool,
+        and has the queue written out at exit.
+        """
+        with self._lock:
+            if self.running:
+                return
+            if not self._stop_at_exit:
+                atexit.register(self.stop)
+                self._stop_at_exit = True
+            if self._pid is not None and self._pid != os.getpid():
+                self._queue = queue.Queue(maxsize=self._queue.maxsize) # Its locks may have been held at the fork
+            self._pid = os.getpid()
+            self._thread = threading.Thread(target=self._run, name='tvf-audit-writer', daemon=True)
+            self._thread.start()
+
+    def stop(self, timeout=10):
+        """
+        Writes everything still queued and stops the background thread, if any.
+        """
+        if self.running:
+            self._queue.put(_STOP)
+            self._thread.join(timeout)
+        self.drain()
+
+    def record(self, entries):
+        if self._pid is not None and not self.running:
+            self.start() # Restart in a worker forked from the process that started the writer
+        if not self.running:
+            self._write_batches(entries)
+            return
+        try:
+            self._queue.put_nowait(entries)
+        except queue.Full:
+            self.spool(entries)
+
+    def drain(self):
+        """
+        Writes every queued entry from the calling thread.
+        """
+        pending = []
+        while True:
+            try:
+                item = self._queue.get_nowait()
+            except queue.Empty:
+                break
+            if item is not _STOP:
+                pending.extend(item)
+        self._write_batches(pending)
+
+    def _write_batches(self, entries):
+        for start in range(0, len(entries), self.batch_size):
+            self._write(entries[start:start + self.batch_size])
+
+    def _run(self):
+        close_old_connections()
+        self.replay_spool()
+        pending = []
+        deadline = None
+        while True:
+            timeout = None if not pending else max(0.0, deadline - time.monotonic())
+            try:
+                item = self._queue.get(timeout=timeout)
+            except queue.Empty:
+                item = None
+            if item is _STOP:
+                self._write(pending)
+                return
+            if item:
+                if not pending:
+                    deadline = time.monotonic() + self.flush_interval
+                pending.extend(item)
+            if pending and (len(pending) >= self.batch_size or time.monotonic() >= deadline):
+                close_old_connections() # The thread's connection may have timed out while idle
+                self._write(pending)
+                pending = []
+
+    def _write(self, entries):
+        if not entries:
+            return
+        try:
+            AuditLog.objects.bulk_create([AuditLog(**entry) for entry in entries], batch_size=self.batch_size)
+        except DatabaseError:
+            logger.exception("Could not write %d audit entries; spooling them.", len(entries))
+            self.spool(entries)
+
+    # --- Spool file ---
+
+    def _spool_path(self):
+        # One file per process, so concurrent workers never interleave lines
+        return self.spool_dir / f'spool-{os.getpid()}.jsonl'
+
+    def spool(self, entries):
+        with self._lock:
+            path = self._spool_path()
+            path.parent.mkdir(parents=True, exist_ok=True)
+            with open(path, 'a', encoding='utf-8') as spool_file:
+                for entry in entries:
+                    spool_file.write(json.dumps(entry) + '\n')
+                spool_file.flush()
+                os.fsync(spool_file.fileno())
+
+    def replay_spool(self):
+        """
+        Writes the entries of every spool file to the database and removes the files.
+        Each file is renamed first, so two processes starting together do not replay it twice.
+        Returns the number of entries replayed.
+        """
+        if not self.spool_dir.is_dir():
+            return 0
+        replayed = 0
+        for path in sorted(self.spool_dir.glob('spool-*.jsonl')):
+            claimed = path.with_suffix(f'.replaying-{os.getpid()}')
+            try:
+                os.rename(path, claimed)
+            except OSError: # Claimed by another process
+                continue
+            with open(claimed, encoding='utf-8') as spool_file:
+                entries = [json.loads(line) for line in spool_file if line.strip()]
+            try:
+                with transaction.atomic():
+                    AuditLog.objects.bulk_create([AuditLog(**entry) for entry in entries], batch_size=self.batch_size)
+            except DatabaseError:
+                logger.exception("Could not replay the audit spool %s; it will be retried.", path)
+                os.rename(claimed, path)
+                continue
+            claimed.unlink()
+            replayed += len(entries)
+        return replayed
+
+
+writer = AuditWriter()
+
+
+class AuditUserMiddleware:
+    """
+    Makes the requesting user available to the audit signal receivers.
+    Must come after AuthenticationMiddleware.
+    """
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        token = _current_request.set(request)
+        try:
+            return self.get_response(request)
+        finally:
+            _current_request.reset(token)
+
+
+# --- Signal receivers (saves and deletes through the ORM; bulk writes record their own entries) ---
+
+def _remember_old_values(sender, instance, raw=False, **kwargs):
+    if raw or instance._state.adding or instance.pk is None:
+        instance._audit_old_values = None
+        return
+    attnames = [field.attname for field in _audited_fields(sender)]
+    instance._audit_old_values = sender._base_manager.filter(pk=instance.pk).values(*attnames).first()
+
+
+def _record_save(sender, instance, created, raw=False, **kwargs):
+    if raw:
+        return
+    old_values = None if created else getattr(instance, '_audit_old_values', None)
+    if not created and old_values is None:
+        return # Row was not in the database before the save; nothing to compare with
+    record(instance_changes(instance, old_values))
+
+
+def _record_delete(sender, instance, **kwargs):
+    record([deletion(sender, instance.pk)])
+
+
+for _model in AUDITED_MODELS:
+    pre_save.connect(_remember_old_values, sender=_model, dispatch_uid=f'audit_pre_save_{_model._meta.model_name}')
+    post_save.connect(_record_save, sender=_model, dispatch_uid=f'audit_post_save_{_model._meta.model_name}')
+    post_delete.connect(_record_delete, sender=_model, dispatch_uid=f'audit_post_delete_{_model._meta.model_name}')
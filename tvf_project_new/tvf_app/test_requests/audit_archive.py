@@ -0,0 +1,221 @@
+# tvf_app/test_requests/audit_archive.py
+import gzip
+import json
+import os
+import tempfile
+from datetime import date, datetime, timedelta
+from pathlib import Path
+
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.db import transaction
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+
+from .models import AuditLog
+
+DEFAULT_ARCHIVE_DIRNAME = 'audit_archive'
+DEFAULT_RETENTION_DAYS = 180
+
+# Rows moved per SELECT / archive write / DELETE
+ARCHIVE_BATCH_SIZE = 1000
+
+ARCHIVE_FIELDS = (
+    'id', 'timestamp', 'user_id', 'action', 'model_name', 'record_id',
+    'field_name', 'old_value', 'new_value', 'change_details',
+)
+
+
+def archive_dir():
+    return Path(getattr(settings, 'TVF_AUDIT_ARCHIVE_DIR', Path(settings.BASE_DIR) / DEFAULT_ARCHIVE_DIRNAME))
+
+
+def retention_days():
+    return getattr(settings, 'TVF_AUDIT_RETENTION_DAYS', DEFAULT_RETENTION_DAYS)
+
+
+def _index_key(model_name, record_id):
+    return f'{model_name}:{record_id}'
+
+
+class ArchivePartition:
+    """
+    One day of archived audit rows: <dir>/YYYY/MM/audit-YYYY-MM-DD.jsonl.gz holds the rows, one
+    JSON object per line, and audit-YYYY-MM-DD.index.json maps 'model_name:record_id' to the ids
+    of that record's rows. Searches read the small index first and only decompress partitions
+    that hold the record. Rows are appended as extra gzip members, so a day can be archived in
+    several runs; ids already in the index are skipped, so re-archiving after a crash that
+    happened before the DELETE does not duplicate them.
+    """
+    def __init__(self, day, directory=None):
+        self.day = day
+        base = Path(directory or archive_dir()) / f'{day:%Y}' / f'{day:%m}'
+        self.data_path = base / f'audit-{day.isoformat()}.jsonl.gz'
+        self.index_path = base / f'audit-{day.isoformat()}.index.json'
+        self._index = None
+
+    @classmethod
+    def from_index_path(cls, path):
+        day = date.fromisoformat(path.name[len('audit-'):-len('.index.json')])
+        return cls(day, path.parent.parent.parent)
+
+    @property
+    def index(self):
+        if self._index is None:
+            try:
+                with open(self.index_path, encoding='utf-8') as index_file:
+                    self._index = json.load(index_file)
+            except FileNotFoundError:
+                self._index = {}
+        return self._index
+
+    def archived_ids(self):
+        return {pk for ids in self.index.values() for pk in ids}
+
+    def append(self, rows):
+        """
+        Appends `rows` (dicts with ARCHIVE_FIELDS) and updates the index. The data is synced to
+        disk before the index is replaced, so the index never points at rows that are not there.
+        Returns the ids now safe to delete from the database.
+        """
+        archived = self.archived_ids()
+        new_rows = [row for row in rows if row['id'] not in archived]
+        if new_rows:
+            self.data_path.parent.mkdir(parents=True, exist_ok=True)
+            with open(self.data_path, 'ab') as raw:
+                with gzip.GzipFile(fileobj=raw, mode='ab') as data_file:
+                    for row in new_rows:
+                        data_file.write((json.dumps(row, default=str) + '\n').encode('utf-8'))
+                raw.flush()
+                os.fsync(raw.fileno())
+            for row in new_rows:
+                self.index.setdefault(_index_key(row['model_name'], row['record_id']), []).append(row['id'])
+            self._write_index()
+        return [row['id'] for row in rows]
+
+    def _write_index(self):
+        handle, temp_path = tempfile.mkstemp(dir=self.index_path.parent, suffix='.tmp')
+        with os.fdopen(handle, 'w', encoding='utf-8') as index_file:
+            json.dump(self.index, index_file, separators=(',', ':'))
+            index_file.flush()
+            os.fsync(index_file.fileno())
+        os.replace(temp_path, self.index_path)
+
+    def rows(self, model_name=None, record_id=None):
+        """
+        Yields the partition's rows, optionally only those of one record (timestamps as datetimes).
+        """
+        if model_name is not None and record_id is not None:
+            wanted = set(self.index.get(_index_key(model_name, record_id), ()))
+            if not wanted:
+                return
+        else:
+            wanted = None
+        if not self.data_path.exists():
+            return
+        seen = set() # A crash between the data and index writes can leave a row in the data twice
+        with gzip.open(self.data_path, 'rt', encoding='utf-8') as data_file:
+            for line in data_file:
+                row = json.loads(line)
+                if row['id'] in seen or (wanted is not None and row['id'] not in wanted):
+                    continue
+                seen.add(row['id'])
+                if model_name is not None and row['model_name'] != model_name:
+                    continue
+                row['timestamp'] = parse_datetime(row['timestamp'])
+                yield row
+
+
+def partitions(start=None, end=None, directory=None):
+    """
+    The archive's partitions, oldest first, optionally limited to days in [start, end].
+    """
+    base = Path(directory or archive_dir())
+    if not base.is_dir():
+        return []
+    found = [ArchivePartition.from_index_path(path) for path in sorted(base.glob('*/*/audit-*.index.json'))]
+    return [p for p in found if (start is None or p.day >= start) and (end is None or p.day <= end)]
+
+
+def archive_audit_logs(older_than, batch_size=ARCHIVE_BATCH_SIZE, directory=None, dry_run=False, progress=None):
+    """
+    Moves AuditLog rows with a timestamp before `older_than` into the archive, oldest first,
+    `batch_size` rows at a time: each batch is written to its day's partitions, then deleted from
+    the table in the same database transaction that read it. Returns the number of rows moved
+    (or, with `dry_run`, the number that would be).
+    """
+    queryset = AuditLog.objects.filter(timestamp__lt=older_than)
+    if dry_run:
+        return queryset.count()
+
+    moved = 0
+    open_partitions = {}
+    while True:
+        with transaction.atomic():
+            rows = list(queryset.order_by('timestamp', 'id').values(*ARCHIVE_FIELDS)[:batch_size])
+            if not rows:
+                break
+            by_day = {}
+            for row in rows:
+                by_day.setdefault(timezone.localtime(row['timestamp']).date(), []).append(row)
+            ids = []
+            for day, day_rows in by_day.items():
+                if day not in open_partitions:
+                    open_partitions[day] = ArchivePartition(day, directory)
+                ids.extend(open_partitions[day].append(day_rows))
+            AuditLog.objects.filter(pk__in=ids).delete()
+        moved += len(rows)
+        if progress:
+            progress(moved)
+    return moved
+
+
+def archive_cutoff(days=None, now=None):
+    """
+    Start of the local day `days` (default TVF_AUDIT_RETENTION_DAYS) days ago, so whole days are archived together.
+    """
+    now = timezone.localtime(now or timezone.now())
+    day = (now - timedelta(days=retention_days() if days is None else days)).date()
+    return timezone.make_aware(datetime.combine(day, datetime.min.time()))
+
+
+def search_archive(model_name=None, record_id=None, start=None, end=None, directory=None):
+    """
+    Archived rows, newest first. With `model_name` and `record_id` only the partitions whose index
+    lists that record are decompressed; `start`/`end` (dates) limit the partitions searched.
+    """
+    results = []
+    for partition in partitions(start, end, directory):
+        results.extend(partition.rows(model_name, record_id))
+    results.sort(key=lambda row: (row['timestamp'], row['id']), reverse=True)
+    return results
+
+
+def audit_history(model_name, record_id, limit=None, directory=None):
+    """
+    A record's full audit history, newest first: rows still in the AuditLog table followed by
+    archived ones, as dicts with ARCHIVE_FIELDS plus 'archived'.
+    """
+    hot = list(AuditLog.objects.filter(model_name=model_name, record_id=str(record_id))
+               .order_by('-timestamp', '-id').values(*ARCHIVE_FIELDS)[:limit])
+    for row in hot:
+        row['archived'] = False
+    if limit is not None and len(hot) >= limit:
+        return hot
+    hot_ids = {row['id'] for row in hot}
+    archived = [row for row in search_archive(model_name, str(record_id), directory=directory) if row['id'] not in hot_ids]
+    for row in archived:
+        row['archived'] = True
+    history = hot + archived
+    return history[:limit] if limit is not None else history
+
+
+def add_usernames(rows):
+    """
+    Sets 'username' on each history row, resolving the user ids with one query.
+    """
+    user_ids = {row['user_id'] for row in rows if row['user_id']}
+    usernames = dict(User.objects.filter(pk__in=user_ids).values_list('pk', 'username')) if user_ids else {}
+    for row in rows:
+        row['username'] = usernames.get(row['user_id'])
+    return rows
@@ -0,0 +1,140 @@
+# tvf_app/test_requests/choices.py
+from django import forms
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.core.exceptions import ValidationError
+from django.db.models import Q
+from django.forms.models import ModelChoiceIterator
+
+from .models import DispatchMethod, PlasticCodeLookup
+from .reference_data import REFERENCE_DATA_VERSION
+from .versioning import get_version
+
+# How long a choice list built from reference data is kept; a version bump makes it unreachable sooner
+CHOICES_CACHE_TIMEOUT = 24 * 60 * 60
+
+
+class ChoiceProvider:
+    """
+    Evaluated choice lists shared by every form and formset on a page. Each list is built at
+    most once per provider (one per request, see get_choice_provider); lists over reference
+    data are also cached across requests under the reference-data version.
+    """
+    def __init__(self):
+        self._lists = {}
+
+    def _get(self, key, build, reference_data=False):
+        if key not in self._lists:
+            if reference_data:
+                cache_key = f'tvf:choices:{key}:{get_version(REFERENCE_DATA_VERSION)}'
+                self._lists[key] = cache.get_or_set(cache_key, lambda: list(build()), CHOICES_CACHE_TIMEOUT)
+            else:
+                self._lists[key] = list(build())
+        return self._lists[key]
+
+    def plastic_codes(self, customer_id, project_id):
+        if not (customer_id and project_id):
+            return []
+        return self._get(
+            f'plastic_codes:{customer_id}:{project_id}',
+            lambda: PlasticCodeLookup.objects.filter(customer_id=customer_id, project_id=project_id).order_by('code'),
+            reference_data=True,
+        )
+
+    def dispatch_methods(self, customer_id, project_id):
+        """
+        The customer/project's dispatch methods plus the global ones (or only the global ones without a customer/project).
+        """
+        condition = Q(customer__isnull=True, project__isnull=True)
+        if customer_id and project_id:
+            condition |= Q(customer_id=customer_id, project_id=project_id)
+        return self._get(
+            f'dispatch_methods:{customer_id}:{project_id}',
+            # The labels show the customer and project names
+            lambda: DispatchMethod.objects.filter(condition).select_related('customer', 'project').order_by('name'),
+            reference_data=True,
+        )
+
+    def active_users(self):
+        return self._get('active_users', lambda: User.objects.filter(is_active=True).order_by('username'))
+
+
+def get_choice_provider(request):
+    """
+    The request's ChoiceProvider, created on first use.
+    """
+    provider = getattr(request, '_tvf_choices', None)
+    if provider is None:
+        provider = request._tvf_choices = ChoiceProvider()
+    return provider
+
+
+class SharedChoiceIterator(ModelChoiceIterator):
+    def __iter__(self):
+        if self.field.empty_label is not None:
+            yield ("", self.field.empty_label)
+        for obj in self.field.objects:
+            yield self.choice(obj)
+
+    def __len__(self):
+        return len(self.field.objects) + (1 if self.field.empty_label is not None else 0)
+
+    def __bool__(self):
+        return self.field.empty_label is not None or bool(self.field.objects)
+
+
+class SharedModelChoiceField(forms.ModelChoiceField):
+    """
+    ModelChoiceField that renders and validates against an already evaluated list of objects
+    (set with set_objects(), usually from a ChoiceProvider) instead of querying its queryset
+    for every form. Until set_objects() is called it behaves like a ModelChoiceField.
+    """
+    iterator = SharedChoiceIterator
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._objects = None
+        self._objects_by_pk = None
+
+    def __deepcopy__(self, memo):
+        result = super().__deepcopy__(memo)
+        result._objects = self._objects
+        result._objects_by_pk = self._objects_by_pk
+        return result
+
+    @property
+    def objects(self):
+        if self._objects is None:
+            self.set_objects(self.queryset)
+        return self._objects
+
+    def set_objects(self, objects):
+        self._objects = list(objects)
+        self._objects_by_pk = {str(obj.pk): obj for obj in self._objects}
+        self.widget.choices = self.choices
+
+    def to_python(self, value):
+        if value in self.empty_values:
+            return None
+        if isinstance(value, self.queryset.model):
+            value = value.pk
+        if self._objects is None:
+            self.set_objects(self.queryset)
+        try:
+            return self._objects_by_pk[str(value)]
+        except KeyError:
+            raise ValidationError(
+                self.error_messages['invalid_choice'], code='invalid_choice', params={'value': value},
+            )
+
+
+class SharedChoicesFormMixin:
+    """
+    For ModelForms with SharedModelChoiceFields: skips the model's per-row foreign key
+    existence check for those fields, since their value was already matched against rows
+    loaded from the database.
+    """
+    def _get_validation_exclusions(self):
+        exclude = super()._get_validation_exclusions()
+        exclude.update(name for name, field in self.fields.items() if isinstance(field, SharedModelChoiceField))
+        return exclude
@@ -0,0 +1,20 @@
+# tvf_app/test_requests/context_processors.py
+from .roles import (
+    ROLE_PROJECT_MANAGER, ROLE_NPI, ROLE_QUALITY, ROLE_LOGISTICS, ROLE_COACH,
+)
+
+
+def roles(request):
+    """
+    Exposes the request's role set and the per-role flags used by templates.
+    """
+    role_set = getattr(request, 'roles', frozenset())
+    return {
+        'roles': role_set,
+        'role_names': sorted(role_set),
+        'is_project_manager': ROLE_PROJECT_MANAGER in role_set,
+        'is_npi_user': ROLE_NPI in role_set,
+        'is_quality_user': ROLE_QUALITY in role_set,
+        'is_logistics_user': ROLE_LOGISTICS in role_set,
+        'is_coach': ROLE_COACH in role_set,
+    }
@@ -0,0 +1,175 @@
+# tvf_app/test_requests/dashboard.py
+from django.db import transaction
+from django.db.models import F, Q
+
+from .models import QueueCounter, TestRequest, TVFQueue
+from .roles import ROLE_PROJECT_MANAGER, ROLE_NPI, ROLE_QUALITY, ROLE_LOGISTICS, ROLE_COACH
+from .sla import annotate_sla
+from .versioning import bump_version
+
+# --- Queue bucket definitions ---
+# Each bucket lists the TestRequest.queue values that put a TVF in it (see models.QUEUE_STATES).
+# 'own': True only matches TVFs the user initiated.
+BUCKETS = {
+    'pm_draft_tvfs': [
+        {'queue': TVFQueue.PM_DRAFT, 'own': True},
+    ],
+    'pm_submitted_tvfs': [
+        {'queue': TVFQueue.RELEASED, 'own': True},
+        {'queue': TVFQueue.REJECTED_TO_PM},
+    ],
+    'npi_released_tvfs': [
+        {'queue': TVFQueue.RELEASED},
+        {'queue': TVFQueue.REWORK_AT_NPI},
+    ],
+    'npi_dp_done_tvfs': [
+        {'queue': TVFQueue.DP_DONE},
+    ],
+    'npi_processed_tvfs': [
+        {'queue': TVFQueue.PROCESSED_AT_NPI},
+    ],
+    'quality_open_tvfs': [
+        {'queue': TVFQueue.OPEN_AT_QA},
+        {'queue': TVFQueue.REWORK_AT_QA},
+    ],
+    'quality_validated_tvfs': [
+        {'queue': TVFQueue.VALIDATED_AT_QA},
+    ],
+    'logistics_open_tvfs': [
+        {'queue': TVFQueue.OPEN_AT_LOGISTICS},
+        {'queue': TVFQueue.REWORK_AT_LOGISTICS},
+    ],
+}
+
+# Queue -> dashboard buckets showing it
+QUEUE_BUCKETS = {}
+for _name, _rules in BUCKETS.items():
+    for _rule in _rules:
+        QUEUE_BUCKETS.setdefault(_rule['queue'], []).append(_name)
+
+# Buckets shown to each role, in the order roles take precedence on the dashboard
+ROLE_BUCKETS = [
+    (ROLE_PROJECT_MANAGER, ['pm_draft_tvfs', 'pm_submitted_tvfs']),
+    (ROLE_NPI, ['npi_released_tvfs', 'npi_dp_done_tvfs', 'npi_processed_tvfs']),
+    (ROLE_QUALITY, ['quality_open_tvfs', 'quality_validated_tvfs']),
+    (ROLE_LOGISTICS, ['logistics_open_tvfs']),
+    (ROLE_COACH, [
+        'npi_released_tvfs', 'npi_dp_done_tvfs', 'npi_processed_tvfs',
+        'quality_open_tvfs', 'quality_validated_tvfs', 'logistics_open_tvfs',
+    ]),
+]
+
+# Only the columns the dashboard tables display
+DASHBOARD_FIELDS = ('pk', 'tvf_number', 'tvf_name', 'request_received_date', 'request_ship_date')
+DASHBOARD_RELATED_FIELDS = {
+    'customer_name': F('customer__name'),
+    'project_name': F('project__name'),
+    'status_name': F('status__name'),
+    'phase_name': F('current_phase__name'),
+}
+SLA_FIELDS = ('sla_breached', 'sla_at_risk')
+# Extra columns needed to sort rows into buckets
+BUCKETING_COLUMNS = ('queue', 'tvf_initiator_id')
+
+
+def buckets_for_roles(roles, is_superuser=False):
+    """
+    Returns the bucket names visible to the first matching role.
+    """
+    for role, bucket_names in ROLE_BUCKETS:
+        if role in roles or (role == ROLE_COACH and is_superuser):
+            return bucket_names
+    return []
+
+
+def fetch_buckets(bucket_names, user):
+    """
+    Fetches every TVF in the given buckets with one query on the queue index and splits
+    the rows into buckets in Python.
+    Returns a dict of bucket name -> list of row dicts holding the dashboard columns.
+    """
+    buckets = {name: [] for name in bucket_names}
+    rules_by_queue = {}
+    for name in bucket_names:
+        for rule in BUCKETS[name]:
+            rules_by_queue.setdefault(rule['queue'], []).append((name, rule))
+    if not rules_by_queue:
+        return buckets
+
+    # Queues some bucket shows in full, and queues only shown for the user's own TVFs
+    shared = [queue for queue, rules in rules_by_queue.items() if any(not rule.get('own') for _, rule in rules)]
+    own = [queue for queue in rules_by_queue if queue not in shared]
+    condition = Q(queue__in=shared) if shared else Q()
+    if own:
+        condition |= Q(queue__in=own, tvf_initiator_id=user.pk)
+
+    # Most urgent first: ordered by SLA due date, with the breach/risk flags computed by the database
+    rows = annotate_sla(TestRequest.objects.filter(condition)).order_by(
+        F('request_ship_date').asc(nulls_last=True), 'tvf_number'
+    ).values(*DASHBOARD_FIELDS, *BUCKETING_COLUMNS, *SLA_FIELDS, **DASHBOARD_RELATED_FIELDS)
+    for row in rows:
+        for name, rule in rules_by_queue.get(row['queue'], ()):
+            if rule.get('own') and row['tvf_initiator_id'] != user.pk:
+                continue
+            buckets[name].append(row)
+    return buckets
+
+
+def bucket_version_name(name):
+    """
+    The version the bucket's cached fragments are keyed on (see fragments.py).
+    """
+    return f'dashboard:bucket:{name}'
+
+
+def invalidate_buckets(moves):
+    """
+    Gives a new version to every bucket the TVFs in `moves`, (tvf id, old queue, new queue) triples,
+    left, entered or were edited in. Bumped at once and again when the transaction commits, so a
+    dashboard rendered in between cannot leave the rows from before the commit cached.
+    """
+    names = sorted({name for _, old, new in moves for queue in (old, new) for name in QUEUE_BUCKETS.get(queue, ())})
+    if not names:
+        return
+    versions = [bucket_version_name(name) for name in names]
+    bump_version(*versions)
+    transaction.on_commit(lambda: bump_version(*versions))
+
+
+def queue_counts():
+    """
+    Live queue counts from the QueueCounter table, read with one query:
+    per queue, per role (TVFs in the queues of the role's buckets) and per customer.
+    The counters are not kept per initiator, so buckets limited to the user's own TVFs
+    count every user's TVFs here.
+    """
+    rows = QueueCounter.objects.filter(count__gt=0).values_list('queue', 'customer_id', 'customer__name', 'count')
+    role_queues = {
+        role: {rule['queue'] for name in bucket_names for rule in BUCKETS[name]}
+        for role, bucket_names in ROLE_BUCKETS
+    }
+
+    queues = {queue.name.lower(): 0 for queue in TVFQueue if queue != TVFQueue.NONE}
+    by_role = {role: 0 for role in role_queues}
+    customers = {}
+    total = 0
+    for queue, customer_id, customer_name, count in rows:
+        key = TVFQueue(queue).name.lower()
+        queues[key] += count
+        total += count
+        customer = customers.setdefault(customer_id, {
+            'id': customer_id, 'name': customer_name, 'total': 0,
+            'queues': {}, 'roles': {role: 0 for role in role_queues},
+        })
+        customer['total'] += count
+        customer['queues'][key] = customer['queues'].get(key, 0) + count
+        for role, role_queue_set in role_queues.items():
+            if queue in role_queue_set:
+                by_role[role] += count
+                customer['roles'][role] += count
+    return {
+        'total': total,
+        'queues': queues,
+        'roles': by_role,
+        'customers': sorted(customers.values(), key=lambda customer: customer['name']),
+    }
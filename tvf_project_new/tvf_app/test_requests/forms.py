@@ -13,7 +13,10 @@ from django.contrib.auth import get_user_model # Corrected import here
 from django.contrib.auth.forms import UserCreationForm, UserChangeForm
 from django.utils import timezone
 from django.core.exceptions import ValidationError # For custom validation
-from django.db.models import Q # Import Q for complex lookups
+from .choices import ChoiceProvider, SharedChoicesFormMixin, SharedModelChoiceField
+from .imports import FORMAT_AUTO, FORMAT_CSV, FORMAT_JSON, FORMAT_ZC_TVFPANS
+from .analytics import ANALYTICS_WINDOWS, DEFAULT_ANALYTICS_WINDOW
+from .grouping import GROUPING_CHOICES
 
 
 # Use Django's built-in UserCreationForm for simplicity
@@ -167,9 +170,9 @@ class TestRequestForm(forms.ModelForm):
 
 
 # --- TestRequestPlasticCodeForm (for inline formset) ---
-class TestRequestPlasticCodeForm(forms.ModelForm):
+class TestRequestPlasticCodeForm(SharedChoicesFormMixin, forms.ModelForm):
     # This field uses the lookup table for dropdown selection
-    plastic_code_lookup = forms.ModelChoiceField(
+    plastic_code_lookup = SharedModelChoiceField(
         queryset=PlasticCodeLookup.objects.none(), # Initially empty, populated by JS
         empty_label="Select Plastic Code (if in lookup)",
         required=False, # Make it optional if manual entry is allowed
@@ -194,6 +197,8 @@ class TestRequestPlasticCodeForm(forms.ModelForm):
         # Extract customer_id and project_id from kwargs, if provided
         self.customer_id = kwargs.pop('customer_id', None)
         self.project_id = kwargs.pop('project_id', None)
+        # Shared by all the forms of a page (pass it through the formset's form_kwargs)
+        choices = kwargs.pop('choices', None) or ChoiceProvider()
         super().__init__(*args, **kwargs)
         for field_name, field in self.fields.items():
             if isinstance(field.widget, (forms.TextInput, forms.Textarea, forms.Select, forms.EmailInput, forms.NumberInput)):
@@ -201,42 +206,8 @@ class TestRequestPlasticCodeForm(forms.ModelForm):
             elif isinstance(field.widget, forms.CheckboxInput):
                 field.widget.attrs.update({'class': 'form-check-input'})
         
-        # Dynamically set plastic_code_lookup queryset based on parent TestRequest's customer and project
-        current_customer_id = None
-        current_project_id = None
-
-        # This logic needs to get customer/project from the *main* TestRequest form
-        # This is usually done by passing it in initial, or accessing self.data (from POST)
-        # For inline formsets, the parent form's data is available in self.data
-        if self.instance.pk and self.instance.test_request: # For existing plastic code entries
-            current_customer_id = self.instance.test_request.customer_id
-            current_project_id = self.instance.test_request.project_id
-        elif self.data: # For new entries in the formset (on POST request)
-            # Access parent form's submitted data for customer and project
-            main_form_customer_id = self.data.get('customer')
-            main_form_project_id = self.data.get('project')
-
-            if main_form_customer_id and main_form_project_id:
-                 current_customer_id = main_form_customer_id
-                 current_project_id = main_form_project_id
-        
-        # Convert IDs to int safely
-        try:
-            current_customer_id = int(current_customer_id) if current_customer_id else None
-            current_project_id = int(current_project_id) if current_project_id else None
-        except (ValueError, TypeError):
-            current_customer_id = None
-            current_project_id = None
-
-        # Dynamically set plastic_code_lookup queryset
-        # Use self.customer_id and self.project_id from kwargs
-        if self.customer_id and self.project_id:
-            self.fields['plastic_code_lookup'].queryset = PlasticCodeLookup.objects.filter(
-                customer_id=self.customer_id,
-                project_id=self.project_id
-            ).order_by('code')
-        else:
-            self.fields['plastic_code_lookup'].queryset = PlasticCodeLookup.objects.none()
+        # Plastic codes of the TVF's customer and project, evaluated once per page for every row
+        self.fields['plastic_code_lookup'].set_objects(choices.plastic_codes(self.customer_id, self.project_id))
 
     def clean(self):
         cleaned_data = super().clean()
@@ -301,8 +272,8 @@ class TestRequestInputFileForm(forms.ModelForm):
 
 
 # --- TestRequestQualityForm (no changes needed) ---
-class TestRequestQualityForm(forms.ModelForm):
-    quality_sign_off_by = forms.ModelChoiceField(
+class TestRequestQualityForm(SharedChoicesFormMixin, forms.ModelForm):
+    quality_sign_off_by = SharedModelChoiceField(
         queryset=User.objects.filter(is_active=True).order_by('username'),
         empty_label="Select Sign-off User",
         required=False,
@@ -317,7 +288,9 @@ class TestRequestQualityForm(forms.ModelForm):
             'quality_sign_off_date': forms.DateTimeInput(attrs={'type': 'datetime-local', 'class': 'form-control'}),
         }
     def __init__(self, *args, **kwargs):
+        choices = kwargs.pop('choices', None) or ChoiceProvider()
         super().__init__(*args, **kwargs)
+        self.fields['quality_sign_off_by'].set_objects(choices.active_users())
         for field_name, field in self.fields.items():
             if isinstance(field.widget, (forms.TextInput, forms.Textarea, forms.Select, forms.EmailInput, forms.NumberInput, forms.DateTimeInput)):
                 field.widget.attrs.update({'class': 'form-control'})
@@ -325,14 +298,14 @@ class TestRequestQualityForm(forms.ModelForm):
                 field.widget.attrs.update({'class': 'form-check-input'})
 
 # --- TestRequestShippingForm (removed tracking_number, added detailed address) ---
-class TestRequestShippingForm(forms.ModelForm):
-    dispatch_method = forms.ModelChoiceField(
+class TestRequestShippingForm(SharedChoicesFormMixin, forms.ModelForm):
+    dispatch_method = SharedModelChoiceField(
         queryset=DispatchMethod.objects.none(), # Will be filtered dynamically
         empty_label="Select Dispatch Method",
         required=False, # As per your model and template
         help_text="Method of dispatch."
     )
-    shipping_sign_off_by = forms.ModelChoiceField(
+    shipping_sign_off_by = SharedModelChoiceField(
         queryset=User.objects.filter(is_active=True).order_by('username'),
         empty_label="Select Sign-off User",
         required=False,
@@ -359,6 +332,7 @@ class TestRequestShippingForm(forms.ModelForm):
             'ship_to_country': forms.TextInput(attrs={'class': 'form-control'}),
         }
     def __init__(self, *args, **kwargs):
+        choices = kwargs.pop('choices', None) or ChoiceProvider()
         super().__init__(*args, **kwargs)
         for field_name, field in self.fields.items():
             if hasattr(field.widget, 'attrs'):
@@ -374,17 +348,126 @@ class TestRequestShippingForm(forms.ModelForm):
             if parent_test_request:
                 current_customer_id = parent_test_request.customer_id
                 current_project_id = parent_test_request.project_id
-        
 
-        if current_customer_id and current_project_id:
-            self.fields['dispatch_method'].queryset = DispatchMethod.objects.filter(
-                Q(customer_id=current_customer_id, project_id=current_project_id) |
-                Q(customer__isnull=True, project__isnull=True) # Global methods
-            ).order_by('name')
-        else: # Default to only global methods if customer/project context is missing
-            self.fields['dispatch_method'].queryset = DispatchMethod.objects.filter(
-                customer__isnull=True, project__isnull=True
-            ).order_by('name')
+        # Global methods only if customer/project context is missing
+        self.fields['dispatch_method'].set_objects(choices.dispatch_methods(current_customer_id, current_project_id))
+        self.fields['shipping_sign_off_by'].set_objects(choices.active_users())
+
+# --- TVF List Filters ---
+class TVFListFilterForm(forms.Form):
+    customer = forms.ModelChoiceField(
+        queryset=Customer.objects.all().order_by('name'),
+        empty_label="All Customers",
+        required=False,
+    )
+    project = forms.ModelChoiceField(
+        queryset=Project.objects.all().order_by('name'),
+        empty_label="All Projects",
+        required=False,
+    )
+    tvf_environment = forms.ModelChoiceField(
+        queryset=TVFEnvironment.objects.all().order_by('name'),
+        empty_label="All Environments",
+        required=False,
+    )
+    tvf_type = forms.ModelChoiceField(
+        queryset=TVFType.objects.all().order_by('name'),
+        empty_label="All Types",
+        required=False,
+    )
+    date_from = forms.DateField(
+        required=False,
+        widget=forms.DateInput(attrs={'type': 'date'}),
+        help_text="Earliest creation date (finished date for shipped TVFs)."
+    )
+    date_to = forms.DateField(
+        required=False,
+        widget=forms.DateInput(attrs={'type': 'date'}),
+        help_text="Latest creation date (finished date for shipped TVFs)."
+    )
+    group = forms.ChoiceField(
+        choices=[('', "No grouping")] + GROUPING_CHOICES,
+        required=False,
+        label="Group by",
+        help_text="Groups the TVFs on each page.",
+    )
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        for field in self.fields.values():
+            field.widget.attrs.update({'class': 'form-control form-control-sm'})
+
+    def clean(self):
+        cleaned_data = super().clean()
+        date_from = cleaned_data.get('date_from')
+        date_to = cleaned_data.get('date_to')
+        if date_from and date_to and date_from > date_to:
+            raise ValidationError("The start date must be on or before the end date.")
+        return cleaned_data
+
+# --- Bulk PAN Import (per input file) ---
+class PANImportForm(forms.Form):
+    pan_file = forms.FileField(
+        label="PAN file",
+        help_text="A CSV (PAN column, optional availability column) or a zc_tvfpans text export.",
+    )
+    file_format = forms.ChoiceField(
+        choices=[
+            (FORMAT_AUTO, "Detect automatically"),
+            (FORMAT_CSV, "CSV"),
+            (FORMAT_ZC_TVFPANS, "zc_tvfpans export"),
+        ],
+        initial=FORMAT_AUTO,
+    )
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        for field in self.fields.values():
+            field.widget.attrs.update({'class': 'form-control form-control-sm'})
+
+class InputFileManifestForm(forms.Form):
+    manifest = forms.FileField(
+        help_text="CSV or JSON with file_name, date_file_received, card_co, card_wo, card_qty, pin_co, pin_wo and pin_qty.",
+    )
+    file_format = forms.ChoiceField(
+        choices=[
+            (FORMAT_AUTO, "Detect from file name"),
+            (FORMAT_CSV, "CSV"),
+            (FORMAT_JSON, "JSON"),
+        ],
+        initial=FORMAT_AUTO,
+    )
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        for field in self.fields.values():
+            field.widget.attrs.update({'class': 'form-control form-control-sm'})
+
+# --- Coach Cycle-Time Analytics ---
+class CycleTimeAnalyticsForm(forms.Form):
+    days = forms.TypedChoiceField(
+        label="Window",
+        choices=[(days, f"Last {days} days") for days in ANALYTICS_WINDOWS],
+        coerce=int,
+        initial=DEFAULT_ANALYTICS_WINDOW,
+        required=False,
+    )
+    by = forms.ChoiceField(
+        label="Slice by",
+        choices=[
+            ('', "All TVFs"),
+            ('customer', "Customer"),
+            ('project', "Project"),
+            ('tvf_type', "TVF type"),
+            ('environment', "Environment"),
+        ],
+        required=False,
+    )
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        for field in self.fields.values():
+            field.widget.attrs.update({'class': 'form-control form-control-sm'})
 
 # --- Inline Formset Factories ---
 
@@ -0,0 +1,115 @@
+# tvf_app/test_requests/fragments.py
+import math
+
+from django.conf import settings
+from django.core.cache import cache
+from django.middleware.csrf import get_token
+from django.template.loader import render_to_string
+from django.utils import timezone
+from django.utils.safestring import mark_safe
+
+from .dashboard import BUCKETS, ROLE_BUCKETS, bucket_version_name, fetch_buckets
+from .reference_data import REFERENCE_DATA_VERSION
+from .roles import ROLE_PROJECT_MANAGER, ROLE_NPI, ROLE_QUALITY, ROLE_LOGISTICS, ROLE_COACH
+from .sla import SLA_AT_RISK_WINDOW
+from .versioning import get_versions
+from .workflow import REGISTRY_VERSION
+
+# Dashboard sections, one per role's part of the page. Each bucket a section shows is a fragment,
+# rendered from test_requests/dashboard/<section>/<bucket>.html and cached on its own
+SECTION_ROLES = {
+    'pm': ROLE_PROJECT_MANAGER,
+    'npi': ROLE_NPI,
+    'quality': ROLE_QUALITY,
+    'logistics': ROLE_LOGISTICS,
+    'coach': ROLE_COACH,
+}
+SECTION_BUCKETS = {section: dict(ROLE_BUCKETS)[role] for section, role in SECTION_ROLES.items()}
+
+DEFAULT_FRAGMENT_TIMEOUT = 10 * 60
+
+# Fragments are shared between users, so their forms are cached with this in place of the CSRF
+# token and every response puts in the requesting user's own
+CSRF_PLACEHOLDER = 'tvf-fragment-csrf-token'
+
+
+def fragment_timeout():
+    """
+    Longest a fragment is served from the cache (TVF_DASHBOARD_FRAGMENT_TIMEOUT seconds). A version
+    bump makes it unreachable sooner, and it expires early when one of its TVFs changes SLA colour.
+    """
+    return getattr(settings, 'TVF_DASHBOARD_FRAGMENT_TIMEOUT', DEFAULT_FRAGMENT_TIMEOUT)
+
+
+def visible_sections(roles, is_superuser=False):
+    """
+    The sections the dashboard shows for the given roles, in page order.
+    """
+    return [
+        section for section, role in SECTION_ROLES.items()
+        if role in roles or (role == ROLE_COACH and is_superuser)
+    ]
+
+
+def visible_fragments(roles, is_superuser=False):
+    return [(section, bucket) for section in visible_sections(roles, is_superuser) for bucket in SECTION_BUCKETS[section]]
+
+
+def _fragment_keys(fragments, user):
+    """
+    The cache key of each (section, bucket) fragment: the bucket's version, the reference data and
+    workflow versions (the rows show customer, project, status and phase names) and, for buckets
+    limited to the user's own TVFs, the user. All versions are read in one cache round trip.
+    """
+    buckets = sorted({bucket for _, bucket in fragments})
+    versions = get_versions(REFERENCE_DATA_VERSION, REGISTRY_VERSION, *(bucket_version_name(bucket) for bucket in buckets))
+    shared = ':'.join(versions[:2])
+    bucket_versions = dict(zip(buckets, versions[2:]))
+    keys = {}
+    for section, bucket in fragments:
+        owner = user.pk if any(rule.get('own') for rule in BUCKETS[bucket]) else 'all'
+        keys[(section, bucket)] = f'tvf:dashboard:{section}:{bucket}:{owner}:{bucket_versions[bucket]}:{shared}'
+    return keys
+
+
+def _timeout(rows, now):
+    """
+    Seconds the fragment showing `rows` stays correct: until the first of them turns at risk or
+    breached, capped at fragment_timeout().
+    """
+    timeout = fragment_timeout()
+    for row in rows:
+        due = row['request_ship_date']
+        if due is None:
+            continue
+        for change in (due - SLA_AT_RISK_WINDOW, due):
+            if change > now:
+                timeout = min(timeout, (change - now).total_seconds())
+                break
+    return max(1, math.ceil(timeout))
+
+
+def render_fragments(request, fragments):
+    """
+    The HTML of each (section, bucket) fragment for request.user, as {section: {bucket: html}}.
+    Cached fragments are read in one round trip; the buckets of the missing ones are fetched with
+    one query (see dashboard.fetch_buckets), rendered and cached.
+    """
+    keys = _fragment_keys(fragments, request.user)
+    found = cache.get_many(list(keys.values()))
+    missing = [fragment for fragment in fragments if keys[fragment] not in found]
+    if missing:
+        now = timezone.now()
+        rows = fetch_buckets(sorted({bucket for _, bucket in missing}), request.user)
+        for section, bucket in missing:
+            html = str(render_to_string(
+                f'test_requests/dashboard/{section}/{bucket}.html', {bucket: rows[bucket], 'csrf_token': CSRF_PLACEHOLDER}
+            ))
+            cache.set(keys[(section, bucket)], html, _timeout(rows[bucket], now))
+            found[keys[(section, bucket)]] = html
+
+    token = get_token(request)
+    rendered = {}
+    for section, bucket in fragments:
+        rendered.setdefault(section, {})[bucket] = mark_safe(found[keys[(section, bucket)]].replace(CSRF_PLACEHOLDER, token))
+    return rendered
@@ -0,0 +1,46 @@
+# tvf_app/test_requests/grouping.py
+from .models import TVFQueue
+from .workflow import registry
+
+# What TVFs can be grouped by: the label shown for each group, the dashboard row key (rows from
+# dashboard.fetch_buckets) and the TestRequest column holding the group of each TVF
+GROUPINGS = {
+    'phase': ("Phase", 'phase_name', 'current_phase_id'),
+    'status': ("Status", 'status_name', 'status_id'),
+    'queue': ("Queue", 'queue', 'queue'),
+}
+GROUPING_CHOICES = [(name, label) for name, (label, _, _) in GROUPINGS.items()]
+
+NO_GROUP_LABEL = "None"
+
+
+def group_tvfs(tvfs, by):
+    """
+    Partitions already fetched TVFs by 'phase', 'status' or 'queue' in one pass, without queries:
+    TestRequest instances are grouped on their foreign key (or queue) column and labelled from the
+    workflow registry, dashboard rows on the names they were fetched with.
+    Returns [{'key', 'label', 'tvfs'}], the groups in order of their first TVF and each group's
+    TVFs in their original order.
+    """
+    try:
+        _, row_key, column = GROUPINGS[by]
+    except KeyError:
+        raise ValueError(f"Cannot group TVFs by '{by}'; choose one of {', '.join(GROUPINGS)}.")
+
+    groups = {}
+    rows = False
+    for tvf in tvfs:
+        rows = isinstance(tvf, dict)
+        key = tvf[row_key] if rows else getattr(tvf, column)
+        groups.setdefault(key, []).append(tvf)
+
+    if by == 'queue':
+        names = {queue.value: queue.label for queue in TVFQueue}
+    elif rows or not groups: # Rows already carry the names
+        names = {}
+    else:
+        names = registry.phase_names() if by == 'phase' else registry.status_names()
+    return [
+        {'key': key, 'label': NO_GROUP_LABEL if key is None else names.get(key, key), 'tvfs': members}
+        for key, members in groups.items()
+    ]
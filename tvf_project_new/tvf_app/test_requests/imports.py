@@ -0,0 +1,328 @@
+# tvf_app/test_requests/imports.py
+import codecs
+import csv
+import json
+import re
+
+from django.db import connection, transaction
+from django.forms.models import model_to_dict
+
+from . import audit
+from .models import TestRequestInputFile, TestRequestPAN
+from .pdf_cache import invalidate_tvf_pdfs
+
+FORMAT_AUTO = 'auto'
+FORMAT_CSV = 'csv'
+FORMAT_JSON = 'json'
+FORMAT_ZC_TVFPANS = 'zc_tvfpans'
+
+# PANs written per INSERT
+PAN_IMPORT_BATCH_SIZE = 1000
+# Invalid lines reported back in detail; the rest are only counted
+MAX_REPORTED_ERRORS = 50
+
+PAN_HEADERS = ('pan_truncated', 'pan', 'truncated_pan', 'card_number')
+AVAILABLE_HEADERS = ('is_available', 'available', 'status')
+AVAILABLE_VALUES = frozenset({'avble', 'available', 'yes', 'y', 'true', '1', 'x'})
+
+# Full PANs are 12-19 digits; truncated ones have some of those digits masked with X or *
+PAN_CHARS = re.compile(r'^[0-9Xx*]{12,19}$')
+PAN_SEPARATORS = re.compile(r'[\s-]')
+# Tokens of a zc_tvfpans line that are part of the PAN (it may be split into digit groups)
+PAN_TOKEN = re.compile(r'^[0-9Xx*-]+$')
+VISIBLE_DIGITS = 4
+
+
+class PANImportError(ValueError):
+    pass
+
+
+class ManifestError(ValueError):
+    pass
+
+
+class PANImportResult:
+    """
+    Running totals of a PAN import, passed to the progress callback after each batch.
+    """
+    def __init__(self):
+        self.lines = 0
+        self.created = 0
+        self.duplicates = 0
+        self.invalid = 0
+        self.errors = []
+
+    def add_error(self, line_number, message):
+        self.invalid += 1
+        if len(self.errors) < MAX_REPORTED_ERRORS:
+            self.errors.append(f"Line {line_number}: {message}")
+
+    def as_dict(self):
+        return {
+            'lines': self.lines,
+            'created': self.created,
+            'duplicates': self.duplicates,
+            'invalid': self.invalid,
+            'errors': self.errors,
+        }
+
+
+def mask_pan(value):
+    """
+    Normalises a full or truncated PAN to the stored form (XXXXXXXXXXXX7067): separators are
+    dropped and every digit except the last four is masked. Raises PANImportError if the value
+    is not a PAN.
+    """
+    pan = PAN_SEPARATORS.sub('', value or '')
+    if not PAN_CHARS.match(pan):
+        raise PANImportError(f"'{value}' is not a PAN (12-19 digits, optionally masked with X).")
+    if not pan[-VISIBLE_DIGITS:].isdigit():
+        raise PANImportError(f"'{value}' must end with its last {VISIBLE_DIGITS} digits.")
+    return 'X' * (len(pan) - VISIBLE_DIGITS) + pan[-VISIBLE_DIGITS:]
+
+
+def iter_lines(uploaded_file, encoding='utf-8-sig'):
+    """
+    Yields the text lines of a Django File (an upload, or File(open(path, 'rb'))), decoding it
+    chunk by chunk so the file is never held in memory.
+    """
+    decoder = codecs.getincrementaldecoder(encoding)(errors='replace')
+    pending = ''
+    for chunk in uploaded_file.chunks():
+        pending += decoder.decode(chunk)
+        *lines, pending = pending.split('\n')
+        for line in lines:
+            yield line.rstrip('\r')
+    pending += decoder.decode(b'', final=True)
+    if pending:
+        yield pending.rstrip('\r')
+
+
+def _column(header, names):
+    for index, name in enumerate(header):
+        if name.strip().lower() in names:
+            return index
+    return None
+
+
+def parse_csv(lines):
+    """
+    Yields (line number, raw PAN, available flag) from CSV lines. A header row naming the PAN
+    column (pan_truncated, pan, ...) and availability column is optional; without one the first
+    column is the PAN and the second, if any, the availability.
+    """
+    rows = csv.reader(lines)
+    pan_index, available_index = 0, 1
+    for line_number, row in enumerate(rows, start=1):
+        if not row or not any(cell.strip() for cell in row):
+            continue
+        if line_number == 1 and _column(row, PAN_HEADERS) is not None:
+            pan_index = _column(row, PAN_HEADERS)
+            available_index = _column(row, AVAILABLE_HEADERS)
+            continue
+        pan = row[pan_index] if pan_index < len(row) else ''
+        available = available_index is not None and available_index < len(row) and \
+            row[available_index].strip().lower() in AVAILABLE_VALUES
+        yield line_number, pan, available
+
+
+def parse_zc_tvfpans(lines):
+    """
+    Yields (line number, raw PAN, available flag) from a zc_tvfpans text export: one PAN per line,
+    followed by 'Avble' when it is available. Blank lines and lines that do not start with digits
+    (report headers, separators, comments) are skipped; other lines are validated as PANs.
+    """
+    for line_number, line in enumerate(lines, start=1):
+        tokens = line.split()
+        # Report headers and separators do not start with a digit group
+        if not tokens or not PAN_TOKEN.match(tokens[0]) or not any(c.isdigit() for c in tokens[0]):
+            continue
+        pan_tokens = 1
+        while pan_tokens < len(tokens) and PAN_TOKEN.match(tokens[pan_tokens]):
+            pan_tokens += 1
+        status = tokens[pan_tokens].lower() if pan_tokens < len(tokens) else ''
+        yield line_number, ' '.join(tokens[:pan_tokens]), status in AVAILABLE_VALUES
+
+
+def detect_format(file_name, first_line):
+    if (file_name or '').lower().endswith('.csv') or ',' in first_line:
+        return FORMAT_CSV
+    return FORMAT_ZC_TVFPANS
+
+
+def import_pans(input_file, uploaded_file, file_format=FORMAT_AUTO, batch_size=PAN_IMPORT_BATCH_SIZE, progress=None):
+    """
+    Streams PANs from a CSV or zc_tvfpans upload into `input_file`, masking and validating each one.
+    PANs are inserted in batches of `batch_size` with bulk_create(ignore_conflicts=True), so PANs
+    already on the input file (or repeated in the upload) are counted as duplicates instead of
+    failing the import, and re-running an interrupted import is safe. Each inserted PAN is audited.
+    `progress(result)` is called after every batch. Returns the PANImportResult.
+    """
+    result = PANImportResult()
+    lines = iter_lines(uploaded_file)
+    first_line = next(lines, '')
+
+    def all_lines():
+        yield first_line
+        yield from lines
+
+    if file_format == FORMAT_AUTO:
+        file_format = detect_format(getattr(uploaded_file, 'name', ''), first_line)
+    parse = parse_csv if file_format == FORMAT_CSV else parse_zc_tvfpans
+
+    seen = set()
+    batch = []
+    for line_number, raw_pan, available in parse(all_lines()):
+        result.lines = line_number
+        try:
+            pan = mask_pan(raw_pan)
+        except PANImportError as e:
+            result.add_error(line_number, str(e))
+            continue
+        if pan in seen:
+            result.duplicates += 1
+            continue
+        seen.add(pan)
+        batch.append(TestRequestPAN(test_request_input_file=input_file, pan_truncated=pan, is_available=available))
+        if len(batch) >= batch_size:
+            _insert_batch(input_file, batch, result)
+            batch = []
+            if progress:
+                progress(result)
+    if batch:
+        _insert_batch(input_file, batch, result)
+    if progress:
+        progress(result)
+    return result
+
+
+def _insert_batch(input_file, batch, result):
+    existing = set(TestRequestPAN.objects.filter(
+        test_request_input_file=input_file, pan_truncated__in=[pan.pan_truncated for pan in batch],
+    ).values_list('pan_truncated', flat=True))
+    new = [pan for pan in batch if pan.pan_truncated not in existing]
+    # ignore_conflicts still covers PANs added by a concurrent import since the lookup above
+    TestRequestPAN.objects.bulk_create(new, ignore_conflicts=True)
+    if new: # bulk_create sends no post_save, so the TVF's cached PDF is invalidated here
+        invalidate_tvf_pdfs(input_file.test_request_id)
+    result.created += len(new)
+    result.duplicates += len(existing)
+
+    # Conflict-ignoring inserts return no primary keys, so the audited ids are read back in one query
+    pks = dict(TestRequestPAN.objects.filter(
+        test_request_input_file=input_file, pan_truncated__in=[pan.pan_truncated for pan in new],
+    ).values_list('pan_truncated', 'pk'))
+    entries = []
+    for pan in new:
+        pan.pk = pks.get(pan.pan_truncated)
+        entries.extend(audit.instance_changes(pan))
+    audit.record(entries)
+
+
+# --- Input-file manifests ---
+
+MANIFEST_FIELDS = ('file_name', 'date_file_received', 'card_co', 'card_wo', 'card_qty', 'pin_co', 'pin_wo', 'pin_qty')
+MANIFEST_DEFAULTS = {'card_qty': 0, 'pin_qty': 0}
+
+
+class ManifestImportResult:
+    """
+    Outcome of a manifest import: how many input files were created and updated, and the
+    validation errors of the rows that were skipped, keyed by manifest row number.
+    """
+    def __init__(self):
+        self.created = 0
+        self.updated = 0
+        self.errors = {}
+
+    def as_dict(self):
+        return {
+            'created': self.created,
+            'updated': self.updated,
+            'errors': [{'row': row, 'errors': errors} for row, errors in sorted(self.errors.items())],
+        }
+
+
+def parse_manifest(uploaded_file, file_format=FORMAT_AUTO):
+    """
+    Yields (row number, {field: value}) from a CSV manifest (header row of field names) or a
+    JSON manifest (a list of objects, or {"input_files": [...]}). Unknown columns are ignored.
+    """
+    if file_format == FORMAT_AUTO:
+        file_format = FORMAT_JSON if (getattr(uploaded_file, 'name', '') or '').lower().endswith('.json') else FORMAT_CSV
+
+    if file_format == FORMAT_JSON:
+        try:
+            document = json.loads(b''.join(uploaded_file.chunks()).decode('utf-8-sig'))
+        except (UnicodeDecodeError, ValueError) as e:
+            raise ManifestError(f"The manifest is not valid JSON: {e}")
+        rows = document.get('input_files') if isinstance(document, dict) else document
+        if not isinstance(rows, list):
+            raise ManifestError("A JSON manifest must be a list of input files or {\"input_files\": [...]}.")
+        for row_number, row in enumerate(rows, start=1):
+            if not isinstance(row, dict):
+                raise ManifestError(f"Row {row_number} of the manifest is not an object.")
+            yield row_number, {field: row[field] for field in MANIFEST_FIELDS if field in row}
+        return
+
+    reader = csv.DictReader(iter_lines(uploaded_file))
+    if not reader.fieldnames or 'file_name' not in [name.strip() for name in reader.fieldnames]:
+        raise ManifestError("A CSV manifest needs a header row with at least a file_name column.")
+    for row_number, row in enumerate(reader, start=1):
+        row = {(key or '').strip(): (value or '').strip() for key, value in row.items()}
+        if any(row.values()):
+            yield row_number, {field: row[field] for field in MANIFEST_FIELDS if field in row}
+
+
+def import_input_file_manifest(test_request, uploaded_file, file_format=FORMAT_AUTO):
+    """
+    Creates or updates the TVF's input files from a manifest, in one transaction.
+    Each row is validated with TestRequestInputFileForm; columns a row leaves out keep their
+    current value (or the model default for new files). Valid rows are upserted with one
+    bulk_create(update_conflicts=True) on (test_request, file_name) and audited like saves;
+    invalid rows are skipped and reported in the result instead of failing the whole manifest.
+    """
+    from .forms import TestRequestInputFileForm # forms.py imports this module's format constants
+
+    result = ManifestImportResult()
+    existing = {input_file.file_name: input_file for input_file in test_request.input_files_entries.all()}
+    rows = {}
+    for row_number, values in parse_manifest(uploaded_file, file_format):
+        current = existing.get(str(values.get('file_name', '')).strip())
+        initial = model_to_dict(current, fields=MANIFEST_FIELDS) if current else dict(MANIFEST_DEFAULTS)
+        form = TestRequestInputFileForm(data={**initial, **values})
+        if not form.is_valid():
+            result.errors[row_number] = {field: list(errors) for field, errors in form.errors.items()}
+            continue
+        input_file = form.save(commit=False)
+        if input_file.file_name in rows:
+            result.errors[row_number] = {'file_name': [f"'{input_file.file_name}' is already listed on row {rows[input_file.file_name][0]}."]}
+            continue
+        input_file.test_request = test_request
+        rows[input_file.file_name] = (row_number, input_file)
+
+    input_files = [input_file for _, input_file in rows.values()]
+    # MySQL's ON DUPLICATE KEY UPDATE takes no conflict target; it uses the unique key itself
+    unique_fields = ['test_request', 'file_name'] if connection.features.supports_update_conflicts_with_target else None
+    update_fields = [field for field in MANIFEST_FIELDS if field != 'file_name']
+    with transaction.atomic():
+        TestRequestInputFile.objects.bulk_create(
+            input_files, update_conflicts=True, unique_fields=unique_fields, update_fields=update_fields,
+        )
+        invalidate_tvf_pdfs(test_request.pk)
+        # Upserts do not return primary keys on every backend, so the audited ids are read back
+        pks = dict(test_request.input_files_entries.filter(file_name__in=list(rows)).values_list('file_name', 'pk'))
+        entries = []
+        for input_file in input_files:
+            input_file.pk = pks.get(input_file.file_name)
+            current = existing.get(input_file.file_name)
+            if current is None:
+                entries.extend(audit.instance_changes(input_file))
+            else:
+                entries.extend(audit.field_changes(TestRequestInputFile, input_file.pk, {
+                    field: (getattr(current, field), getattr(input_file, field)) for field in update_fields
+                }))
+        audit.record(entries)
+    result.updated = sum(1 for file_name in rows if file_name in existing)
+    result.created = len(rows) - result.updated
+    return result
@@ -0,0 +1,168 @@
+# tvf_app/test_requests/listing.py
+import base64
+import binascii
+import json
+from datetime import datetime, time, timedelta
+
+from django.db.models import Q
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+
+PAGE_SIZE = 50
+
+# Sortable columns: ?sort=<key> for ascending, ?sort=-<key> for descending.
+# Every sort is tie-broken on tvf_number so keyset pages never skip or repeat a row.
+# Each sort is backed by a composite (column, tvf_number) index on TestRequest.
+SORT_FIELDS = {
+    'number': 'tvf_number',
+    'received': 'request_received_date',
+    'due': 'request_ship_date',
+    'completed': 'tvf_completed_date',
+}
+# Nullable columns list their dated rows first and then the rows without a date, in tvf_number order.
+# The two blocks are paged as separate range scans (see paginate) rather than with NULLS LAST or an
+# IS NULL alternative in the seek, which MySQL cannot serve from the (column, tvf_number) index.
+NULLABLE_SORT_FIELDS = {'request_ship_date', 'tvf_completed_date'}
+
+
+def parse_sort(sort, default):
+    """
+    Returns (sort key, field name, descending) for a ?sort= value, falling back to `default`.
+    """
+    key = (sort or default).lstrip('-')
+    if key not in SORT_FIELDS:
+        return parse_sort(default, default)
+    return key, SORT_FIELDS[key], (sort or default).startswith('-')
+
+
+def date_range_filter(field, date_from=None, date_to=None):
+    """
+    Q object limiting the datetime `field` to the inclusive date range, using plain
+    range comparisons so the column's index is still usable.
+    """
+    condition = Q()
+    if date_from:
+        condition &= Q(**{f'{field}__gte': timezone.make_aware(datetime.combine(date_from, time.min))})
+    if date_to:
+        condition &= Q(**{f'{field}__lt': timezone.make_aware(datetime.combine(date_to + timedelta(days=1), time.min))})
+    return condition
+
+
+def encode_cursor(row, field):
+    value = getattr(row, field)
+    if field == 'tvf_number':
+        value = None
+    elif value is not None:
+        value = value.isoformat()
+    payload = json.dumps([value, row.tvf_number]).encode()
+    return base64.urlsafe_b64encode(payload).decode().rstrip('=')
+
+
+def decode_cursor(cursor, field):
+    """
+    Returns (value, tvf_number) from a cursor, or None if it is missing or malformed.
+    """
+    if not cursor:
+        return None
+    try:
+        value, number = json.loads(base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)))
+        number = int(number)
+    except (ValueError, TypeError, binascii.Error):
+        return None
+    if value is not None:
+        value = parse_datetime(value) if isinstance(value, str) else None
+        if value is None:
+            return None
+    return value, number
+
+
+def _ordering(field, descending, backwards):
+    """
+    Order-by expressions for the sort; `backwards` flips it to walk towards earlier pages.
+    """
+    descending = descending != backwards
+    number = '-tvf_number' if descending else 'tvf_number'
+    if field == 'tvf_number':
+        return [number]
+    return ['-' + field if descending else field, number]
+
+
+def _seek(field, descending, backwards, value, number):
+    """
+    Q object matching the rows after the cursor row (before it when `backwards`).
+    """
+    op = 'lt' if descending != backwards else 'gt'
+    if field == 'tvf_number':
+        return Q(**{f'tvf_number__{op}': number})
+    return Q(**{f'{field}__{op}': value}) | Q(**{field: value, f'tvf_number__{op}': number})
+
+
+def _scan(queryset, field, descending, backwards, cursor, limit):
+    """
+    Up to `limit` rows of one indexed range scan, starting after the cursor.
+    """
+    if cursor is not None:
+        queryset = queryset.filter(_seek(field, descending, backwards, *cursor))
+    return list(queryset.order_by(*_ordering(field, descending, backwards))[:limit])
+
+
+class KeysetPage:
+    """
+    One page of a keyset-paginated queryset, with cursors for the neighbouring pages.
+    """
+    def __init__(self, rows, next_cursor, previous_cursor):
+        self.object_list = rows
+        self.next_cursor = next_cursor
+        self.previous_cursor = previous_cursor
+
+    def __iter__(self):
+        return iter(self.object_list)
+
+    def __len__(self):
+        return len(self.object_list)
+
+    @property
+    def has_next(self):
+        return self.next_cursor is not None
+
+    @property
+    def has_previous(self):
+        return self.previous_cursor is not None
+
+
+def paginate(queryset, field, descending, after=None, before=None, page_size=PAGE_SIZE):
+    """
+    Returns the KeysetPage following the `after` cursor (or preceding the `before` cursor).
+    Each page is one indexed range scan of page_size + 1 rows, whatever its depth (two where a
+    nullable column's dated rows give way to its undated ones).
+    """
+    backwards = before is not None and decode_cursor(before, field) is not None
+    cursor = decode_cursor(before if backwards else after, field)
+    if field in NULLABLE_SORT_FIELDS:
+        # Dated rows, then undated ones; each block is its own range scan, and a page that runs off
+        # the end of one block is topped up from the other
+        blocks = [(field, False), ('tvf_number', True)]
+        start = 1 if cursor is not None and cursor[0] is None else 0
+        rows = []
+        for index in (range(start, -1, -1) if backwards else range(start, len(blocks))):
+            block_field, undated = blocks[index]
+            rows += _scan(
+                queryset.filter(**{f'{field}__isnull': undated}), block_field, descending, backwards,
+                cursor if index == start else None, page_size + 1 - len(rows),
+            )
+            if len(rows) > page_size:
+                break
+    else:
+        rows = _scan(queryset, field, descending, backwards, cursor, page_size + 1)
+
+    has_more = len(rows) > page_size
+    rows = rows[:page_size]
+    if backwards:
+        rows.reverse()
+    if not rows:
+        return KeysetPage(rows, None, None)
+
+    first, last = encode_cursor(rows[0], field), encode_cursor(rows[-1], field)
+    if backwards:
+        return KeysetPage(rows, last, first if has_more else None)
+    return KeysetPage(rows, last if has_more else None, first if cursor is not None else None)
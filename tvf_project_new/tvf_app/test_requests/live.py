@@ -0,0 +1,228 @@
+# tvf_app/test_requests/live.py
+import asyncio
+import json
+import logging
+import threading
+
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.db import transaction
+from django.utils import timezone
+from django.utils.module_loading import import_string
+
+from .dashboard import QUEUE_BUCKETS
+from .models import TVFQueue
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_BROADCASTER = 'test_requests.live.LocalBroadcaster'
+DEFAULT_REDIS_CHANNEL = 'tvf:live'
+
+# Events held for one slow client before it is told to resync instead
+LIVE_QUEUE_SIZE = 100
+# Seconds between keep-alive comments on an idle stream, and the client's reconnect delay (ms)
+LIVE_HEARTBEAT_SECONDS = 15
+LIVE_RETRY_MS = 5000
+
+EVENT_QUEUE_MOVES = 'queue_moves'
+EVENT_RESYNC = 'resync'
+
+def format_sse(event, data):
+    """
+    One Server-Sent Events message, encoded once and shared by every subscriber.
+    """
+    return f"event: {event}\ndata: {json.dumps(data, separators=(',', ':'))}\n\n".encode('utf-8')
+
+
+RESYNC_MESSAGE = format_sse(EVENT_RESYNC, {})
+
+
+class Subscription:
+    """
+    One connected stream: a bounded asyncio queue on the event loop that serves it. If the
+    client falls LIVE_QUEUE_SIZE messages behind, its backlog is replaced by a single resync
+    message, so a stalled connection never holds memory or delays the others.
+    """
+    def __init__(self, broadcaster, queue_size=LIVE_QUEUE_SIZE):
+        self.broadcaster = broadcaster
+        self.loop = asyncio.get_running_loop()
+        self.queue = asyncio.Queue(maxsize=queue_size)
+
+    def put(self, message):
+        # Runs on self.loop
+        try:
+            self.queue.put_nowait(message)
+        except asyncio.QueueFull:
+            while not self.queue.empty():
+                self.queue.get_nowait()
+            self.queue.put_nowait(RESYNC_MESSAGE)
+
+    async def get(self, timeout=None):
+        """
+        The next message, or None after `timeout` seconds without one.
+        """
+        try:
+            return await asyncio.wait_for(self.queue.get(), timeout)
+        except asyncio.TimeoutError:
+            return None
+
+    def close(self):
+        self.broadcaster.unsubscribe(self)
+
+
+class LocalBroadcaster:
+    """
+    Fans messages out to the streams connected to this process. publish() may be called from
+    any thread (transactions commit in the sync worker threads); each event loop serving
+    streams is woken once per message, however many of its streams are subscribed.
+    Enough on its own for a single ASGI process.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._subscriptions = {} # event loop -> set of its subscriptions
+
+    def subscribe(self):
+        subscription = Subscription(self)
+        with self._lock:
+            self._subscriptions.setdefault(subscription.loop, set()).add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription):
+        with self._lock:
+            subscriptions = self._subscriptions.get(subscription.loop)
+            if subscriptions is not None:
+                subscriptions.discard(subscription)
+                if not subscriptions:
+                    del self._subscriptions[subscription.loop]
+
+    @property
+    def subscriber_count(self):
+        with self._lock:
+            return sum(len(subscriptions) for subscriptions in self._subscriptions.values())
+
+    def publish(self, message):
+        self.fan_out(message)
+
+    def fan_out(self, message):
+        with self._lock:
+            targets = [(loop, list(subscriptions)) for loop, subscriptions in self._subscriptions.items()]
+        for loop, subscriptions in targets:
+            try:
+                loop.call_soon_threadsafe(_deliver, subscriptions, message)
+            except RuntimeError: # The loop has closed; its streams are gone
+                with self._lock:
+                    self._subscriptions.pop(loop, None)
+
+
+def _deliver(subscriptions, message):
+    for subscription in subscriptions:
+        subscription.put(message)
+
+
+class RedisBroadcaster(LocalBroadcaster):
+    """
+    Relays messages between processes through a Redis pub/sub channel, for deployments with
+    several ASGI workers: publish() sends to Redis, and a listener thread in each process that
+    has streams fans what it receives out locally. Needs the `redis` package and
+    TVF_LIVE_REDIS_URL; TVF_LIVE_REDIS_CHANNEL names the channel.
+    """
+    def __init__(self):
+        super().__init__()
+        try:
+            import redis
+        except ImportError as e:
+            raise ImproperlyConfigured("RedisBroadcaster needs the 'redis' package.") from e
+        url = getattr(settings, 'TVF_LIVE_REDIS_URL', None)
+        if not url:
+            raise ImproperlyConfigured("RedisBroadcaster needs TVF_LIVE_REDIS_URL.")
+        self.channel = getattr(settings, 'TVF_LIVE_REDIS_CHANNEL', DEFAULT_REDIS_CHANNEL)
+        self._redis = redis.Redis.from_url(url)
+        self._listener = None
+
+    def subscribe(self):
+        subscription = super().subscribe()
+        with self._lock:
+            if self._listener is None or not self._listener.is_alive():
+                self._listener = threading.Thread(target=self._listen, name='tvf-live-redis', daemon=True)
+                self._listener.start()
+        return subscription
+
+    def publish(self, message):
+        self._redis.publish(self.channel, message)
+
+    def _listen(self):
+        pubsub = self._redis.pubsub(ignore_subscribe_messages=True)
+        pubsub.subscribe(self.channel)
+        for item in pubsub.listen():
+            if item['type'] == 'message':
+                self.fan_out(item['data'])
+
+
+_broadcaster = None
+_broadcaster_lock = threading.Lock()
+
+
+def get_broadcaster():
+    """
+    The process's broadcaster, of the class named by TVF_LIVE_BROADCASTER (LocalBroadcaster by default).
+    """
+    global _broadcaster
+    if _broadcaster is None:
+        with _broadcaster_lock:
+            if _broadcaster is None:
+                _broadcaster = import_string(getattr(settings, 'TVF_LIVE_BROADCASTER', DEFAULT_BROADCASTER))()
+    return _broadcaster
+
+
+def queue_moves_message(moves, now=None):
+    """
+    The SSE message for `moves`, (tvf id, old queue, new queue) triples, naming the dashboard
+    buckets each TVF left and entered so dashboards know which tables to patch.
+    """
+    return format_sse(EVENT_QUEUE_MOVES, {
+        'at': (now or timezone.now()).isoformat(),
+        'moves': [
+            {
+                'tvf': tvf_id,
+                'from': TVFQueue(old).name.lower(),
+                'to': TVFQueue(new).name.lower(),
+                'from_buckets': QUEUE_BUCKETS.get(old, []),
+                'to_buckets': QUEUE_BUCKETS.get(new, []),
+            }
+            for tvf_id, old, new in moves
+        ],
+    })
+
+
+def publish_queue_moves(moves):
+    """
+    Publishes `moves` once the current transaction commits; moves that roll back are never seen.
+    A failure to publish is logged, never raised: the dashboards resync on their next reconnect.
+    """
+    moves = [(tvf_id, old, new) for tvf_id, old, new in moves if old != new]
+    if not moves:
+        return
+
+    def publish():
+        try:
+            get_broadcaster().publish(queue_moves_message(moves))
+        except Exception:
+            logger.exception("Could not publish %d queue move(s).", len(moves))
+
+    transaction.on_commit(publish)
+
+
+async def event_stream(broadcaster, heartbeat=LIVE_HEARTBEAT_SECONDS):
+    """
+    The body of a dashboard's event stream: the reconnect delay, then every message `broadcaster`
+    publishes, with a keep-alive comment after `heartbeat` idle seconds so proxies keep the
+    connection open. Subscribes on the event loop that serves the stream.
+    """
+    subscription = broadcaster.subscribe()
+    try:
+        yield f"retry: {LIVE_RETRY_MS}\n\n".encode('utf-8')
+        while True:
+            message = await subscription.get(timeout=heartbeat)
+            yield message if message is not None else b": keep-alive\n\n"
+    finally:
+        subscription.close()
@@ -0,0 +1,37 @@
+# tvf_app/test_requests/management/commands/archive_audit_logs.py
+from django.core.management.base import BaseCommand, CommandError
+
+from test_requests.audit_archive import ARCHIVE_BATCH_SIZE, archive_audit_logs, archive_cutoff, archive_dir, retention_days
+
+
+class Command(BaseCommand):
+    help = (
+        "Moves audit log rows older than the retention period into compressed, date-partitioned "
+        "JSONL archive files (TVF_AUDIT_ARCHIVE_DIR), indexed by model and record."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--days', type=int, default=None,
+            help="Keep this many days in the table (default TVF_AUDIT_RETENTION_DAYS).",
+        )
+        parser.add_argument('--batch-size', type=int, default=ARCHIVE_BATCH_SIZE, help="Rows moved per batch.")
+        parser.add_argument('--dry-run', action='store_true', help="Report how many rows would be archived without moving them.")
+
+    def handle(self, *args, **options):
+        days = retention_days() if options['days'] is None else options['days']
+        if days < 0:
+            raise CommandError("--days must not be negative.")
+        cutoff = archive_cutoff(days)
+
+        def progress(moved):
+            self.stdout.write(f"  {moved} row(s) archived")
+
+        moved = archive_audit_logs(
+            cutoff, batch_size=options['batch_size'], dry_run=options['dry_run'],
+            progress=None if options['dry_run'] else progress,
+        )
+        verb = "Would archive" if options['dry_run'] else "Archived"
+        self.stdout.write(self.style.SUCCESS(
+            f"{verb} {moved} audit log row(s) older than {cutoff:%Y-%m-%d} into {archive_dir()}."
+        ))
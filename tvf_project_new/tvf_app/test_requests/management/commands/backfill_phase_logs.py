@@ -0,0 +1,66 @@
+# tvf_app/test_requests/management/commands/backfill_phase_logs.py
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from test_requests.models import TestRequest, TestRequestPhaseDefinition, TestRequestPhaseLog
+from test_requests.phase_logs import parse_comment_events, reconstruct_phase_history
+
+
+class Command(BaseCommand):
+    help = (
+        "Reconstructs the phase logs of TVFs that have none, from their comments and their "
+        "received, rejected, completed and last status update dates."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=500, help="TVFs read and log rows written per batch.")
+        parser.add_argument('--dry-run', action='store_true', help="Report how many log rows would be written without saving.")
+
+    def handle(self, *args, **options):
+        batch_size = options['batch_size']
+        phase_ids = dict(TestRequestPhaseDefinition.objects.values_list('name', 'pk'))
+        tvfs = TestRequest.objects.filter(phase_logs__isnull=True).only(
+            'pk', 'comments', 'tvf_initiator_id', 'current_phase_id', 'request_received_date',
+            'rejected_date', 'tvf_completed_date', 'last_status_update',
+        ).order_by('pk')
+
+        batch = []
+        tvf_count = log_count = undated = 0
+        for chunk in self._chunks(tvfs.iterator(chunk_size=batch_size), batch_size):
+            # Usernames in the comments are resolved once per chunk of TVFs
+            usernames = {event[1] for tvf in chunk for event in parse_comment_events(tvf.comments)}
+            user_ids = dict(User.objects.filter(username__in=usernames).values_list('username', 'pk')) if usernames else {}
+            for tvf in chunk:
+                logs, skipped = reconstruct_phase_history(tvf, phase_ids, user_ids)
+                tvf_count += 1 if logs else 0
+                undated += skipped
+                batch.extend(logs)
+            if len(batch) >= batch_size:
+                log_count += self._write(batch, batch_size, options['dry_run'])
+                batch = []
+        if batch:
+            log_count += self._write(batch, batch_size, options['dry_run'])
+
+        verb = "Would write" if options['dry_run'] else "Wrote"
+        self.stdout.write(self.style.SUCCESS(f"{verb} {log_count} phase log(s) for {tvf_count} TVF(s)."))
+        if undated:
+            self.stdout.write(self.style.WARNING(
+                f"{undated} transition(s) found in comments had no matching date and were left out."
+            ))
+
+    def _chunks(self, iterable, size):
+        chunk = []
+        for item in iterable:
+            chunk.append(item)
+            if len(chunk) >= size:
+                yield chunk
+                chunk = []
+        if chunk:
+            yield chunk
+
+    def _write(self, batch, batch_size, dry_run):
+        if not dry_run:
+            with transaction.atomic():
+                TestRequestPhaseLog.objects.bulk_create(batch, batch_size=batch_size)
+        return len(batch)
@@ -0,0 +1,57 @@
+# tvf_app/test_requests/management/commands/check_queues.py
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from django.db.models import F
+
+from test_requests import dashboard, live
+from test_requests.models import TestRequest, TVFQueue
+from test_requests.queue_counters import reconcile_counters
+from test_requests.workflow import registry
+
+
+class Command(BaseCommand):
+    help = (
+        "Checks that every TVF's denormalised queue column matches its phase, status and rejected flag. "
+        "Exits with an error when some do not, unless --fix rewrites them (and recounts the queue counters)."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--fix', action='store_true', help="Rewrite the queue of the TVFs that are out of step.")
+        parser.add_argument('--batch-size', type=int, default=500, help="Rows rewritten per UPDATE batch.")
+        parser.add_argument('--show', type=int, default=20, help="How many mismatched TVFs to list.")
+
+    def handle(self, *args, **options):
+        mismatched = TestRequest.objects.annotate(expected_queue=registry.queue_expression()).exclude(
+            queue=F('expected_queue')
+        ).order_by('pk').values_list('pk', 'tvf_number', 'queue', 'expected_queue')
+        rows = list(mismatched)
+        if not rows:
+            self.stdout.write(self.style.SUCCESS("Every TVF is in the right queue."))
+            return
+
+        for pk, tvf_number, queue, expected in rows[:options['show']]:
+            self.stdout.write(f"TVF {tvf_number}: queue is {TVFQueue(queue).label!r}, expected {TVFQueue(expected).label!r}")
+        if len(rows) > options['show']:
+            self.stdout.write(f"... and {len(rows) - options['show']} more")
+
+        if not options['fix']:
+            raise CommandError(f"{len(rows)} TVF(s) are in the wrong queue; run with --fix to rewrite them.")
+
+        ids = [row[0] for row in rows]
+        for start in range(0, len(ids), options['batch_size']):
+            with transaction.atomic():
+                batch = TestRequest.objects.filter(pk__in=ids[start:start + options['batch_size']])
+                # Locked and re-read, so TVFs moved since the check are rewritten from their current state
+                moves = list(batch.select_for_update().annotate(expected_queue=registry.queue_expression()).values_list(
+                    'pk', 'queue', 'expected_queue'
+                ))
+                batch.update(queue=registry.queue_expression())
+                dashboard.invalidate_buckets(moves)
+                live.publish_queue_moves(moves)
+        self.stdout.write(self.style.SUCCESS(f"Rewrote the queue of {len(ids)} TVF(s)."))
+
+        # The counters may have followed the wrong queue or never seen it, so they are recounted
+        # rather than moved with the TVFs
+        drift = reconcile_counters()
+        if drift:
+            self.stdout.write(self.style.SUCCESS(f"Corrected {len(drift)} queue counter(s)."))
@@ -0,0 +1,41 @@
+# tvf_app/test_requests/management/commands/fill_sla_due_dates.py
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from test_requests.models import TestRequest
+from test_requests.pdf_cache import invalidate_tvf_pdfs
+from test_requests.sla import open_tvfs, sla_due_date
+
+
+class Command(BaseCommand):
+    help = "Fills the SLA due date (request_ship_date) of open TVFs that have none, from the business-day calendar."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=500, help="Rows written per UPDATE batch.")
+        parser.add_argument('--dry-run', action='store_true', help="Report how many TVFs would change without saving.")
+
+    def handle(self, *args, **options):
+        tvfs = open_tvfs().filter(request_ship_date__isnull=True).select_related('customer').only(
+            'pk', 'request_received_date', 'customer__sla_days'
+        )
+        batch = []
+        updated = 0
+        for tvf in tvfs.iterator(chunk_size=options['batch_size']):
+            tvf.request_ship_date = sla_due_date(tvf.request_received_date, tvf.customer.sla_days)
+            batch.append(tvf)
+            if len(batch) >= options['batch_size']:
+                updated += self._write(batch, options['dry_run'])
+                batch = []
+        if batch:
+            updated += self._write(batch, options['dry_run'])
+
+        verb = "Would fill" if options['dry_run'] else "Filled"
+        self.stdout.write(self.style.SUCCESS(f"{verb} the SLA due date of {updated} open TVF(s)."))
+
+    def _write(self, batch, dry_run):
+        if not dry_run:
+            with transaction.atomic():
+                TestRequest.objects.bulk_update(batch, ['request_ship_date'])
+                # bulk_update leaves last_status_update alone, so the PDFs showing the old date are invalidated here
+                invalidate_tvf_pdfs(*(tvf.pk for tvf in batch))
+        return len(batch)
@@ -0,0 +1,47 @@
+# tvf_app/test_requests/management/commands/import_pans.py
+from django.core.files import File
+from django.core.management.base import BaseCommand, CommandError
+
+from test_requests.imports import FORMAT_AUTO, FORMAT_CSV, FORMAT_ZC_TVFPANS, PAN_IMPORT_BATCH_SIZE, import_pans
+from test_requests.models import TestRequestInputFile
+
+
+class Command(BaseCommand):
+    help = "Streams truncated PANs from a CSV or zc_tvfpans export into a TVF input file."
+
+    def add_arguments(self, parser):
+        parser.add_argument('input_file_id', type=int, help="Primary key of the TestRequestInputFile.")
+        parser.add_argument('path', help="CSV or zc_tvfpans text file to import.")
+        parser.add_argument(
+            '--format', dest='file_format', default=FORMAT_AUTO,
+            choices=[FORMAT_AUTO, FORMAT_CSV, FORMAT_ZC_TVFPANS],
+        )
+        parser.add_argument('--batch-size', type=int, default=PAN_IMPORT_BATCH_SIZE, help="PANs inserted per batch.")
+
+    def handle(self, *args, **options):
+        try:
+            input_file = TestRequestInputFile.objects.get(pk=options['input_file_id'])
+        except TestRequestInputFile.DoesNotExist:
+            raise CommandError(f"Input file {options['input_file_id']} does not exist.")
+
+        def progress(result):
+            self.stdout.write(
+                f"  line {result.lines}: {result.created} created, {result.duplicates} duplicate(s), {result.invalid} invalid"
+            )
+
+        try:
+            handle = open(options['path'], 'rb')
+        except OSError as e:
+            raise CommandError(f"Cannot read {options['path']}: {e}")
+        with handle:
+            result = import_pans(
+                input_file, File(handle, name=options['path']), options['file_format'],
+                batch_size=options['batch_size'], progress=progress,
+            )
+
+        for error in result.errors:
+            self.stderr.write(error)
+        self.stdout.write(self.style.SUCCESS(
+            f"Imported {result.created} PAN(s) into {input_file}; "
+            f"skipped {result.duplicates} duplicate(s) and {result.invalid} invalid line(s)."
+        ))
@@ -0,0 +1,95 @@
+# tvf_app/test_requests/management/commands/live_fanout_benchmark.py
+import asyncio
+import json
+import threading
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+from test_requests import live
+
+
+def _percentile(values, fraction):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+
+class Command(BaseCommand):
+    help = (
+        "Measures how long live dashboard events take to reach connected streams: subscribes --clients "
+        "event streams on one event loop, publishes --events messages from another thread (as committing "
+        "transactions do) and reports the delivery latency."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--clients', type=int, default=500, help="Number of connected streams.")
+        parser.add_argument('--events', type=int, default=50, help="Number of messages published.")
+        parser.add_argument('--interval', type=float, default=0.02, help="Seconds between messages.")
+        parser.add_argument(
+            '--configured', action='store_true',
+            help="Use the broadcaster named by TVF_LIVE_BROADCASTER (e.g. Redis) instead of a fresh in-process one.",
+        )
+
+    def handle(self, *args, **options):
+        if options['clients'] < 1 or options['events'] < 1:
+            raise CommandError("--clients and --events must be at least 1.")
+        broadcaster = live.get_broadcaster() if options['configured'] else live.LocalBroadcaster()
+        latencies, delivered, elapsed = asyncio.run(self._run(broadcaster, options))
+
+        expected = options['clients'] * options['events']
+        self.stdout.write(f"{type(broadcaster).__name__}: {options['clients']} clients, {options['events']} events")
+        self.stdout.write(f"Delivered {delivered} of {expected} messages in {elapsed:.2f}s")
+        if latencies:
+            self.stdout.write(
+                "Latency ms: p50 {:.2f}, p95 {:.2f}, p99 {:.2f}, max {:.2f}".format(
+                    *(1000 * _percentile(latencies, fraction) for fraction in (0.5, 0.95, 0.99, 1.0))
+                )
+            )
+        if delivered < expected:
+            self.stdout.write(self.style.WARNING(f"{expected - delivered} message(s) were not delivered."))
+        else:
+            self.stdout.write(self.style.SUCCESS("Every client received every message."))
+
+    async def _run(self, broadcaster, options):
+        clients, events = options['clients'], options['events']
+        latencies = []
+        received = [0] * clients
+        ready = asyncio.Event()
+        connected = 0
+
+        async def client(index):
+            nonlocal connected
+            stream = live.event_stream(broadcaster)
+            try:
+                await stream.__anext__() # The retry line: subscribed from here on
+                connected += 1
+                if connected == clients:
+                    ready.set()
+                while received[index] < events:
+                    message = await stream.__anext__()
+                    if not message.startswith(b'event: benchmark'):
+                        continue # Keep-alive or resync
+                    data = json.loads(message.split(b'data: ', 1)[1])
+                    latencies.append(time.perf_counter() - data['sent'])
+                    received[index] += 1
+            finally:
+                await stream.aclose()
+
+        def publish():
+            for seq in range(events):
+                broadcaster.publish(live.format_sse('benchmark', {'seq': seq, 'sent': time.perf_counter()}))
+                time.sleep(options['interval'])
+
+        tasks = [asyncio.create_task(client(index)) for index in range(clients)]
+        await ready.wait()
+        started = time.perf_counter()
+        publisher = threading.Thread(target=publish, name='tvf-live-benchmark')
+        publisher.start()
+        timeout = events * options['interval'] + 10
+        done, pending = await asyncio.wait(tasks, timeout=timeout)
+        for task in pending:
+            task.cancel()
+        await asyncio.gather(*pending, return_exceptions=True)
+        elapsed = time.perf_counter() - started
+        await asyncio.to_thread(publisher.join)
+        return latencies, sum(received), elapsed
@@ -0,0 +1,66 @@
+# tvf_app/test_requests/management/commands/pdf_worker.py
+import multiprocessing
+import os
+import socket
+
+from django.core.management.base import BaseCommand
+from django.db import connections
+
+
+def _worker_main(worker_name, poll_interval, once, stop_event):
+    # Runs in a child process; with the 'spawn' start method Django has to be set up again
+    import django
+    django.setup()
+    from test_requests.pdf import work
+
+    try:
+        work(worker_name, poll_interval=poll_interval, once=once, stop_event=stop_event)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        connections.close_all()
+
+
+class Command(BaseCommand):
+    help = "Runs a pool of worker processes that render queued TVF PDFs (see PDFRenderJob)."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--processes', type=int, default=os.cpu_count() or 2, help="Number of worker processes.")
+        parser.add_argument('--poll-interval', type=float, default=1.0, help="Seconds to wait when the queue is empty.")
+        parser.add_argument('--once', action='store_true', help="Exit once the queue is empty instead of polling.")
+
+    def handle(self, *args, **options):
+        from test_requests.pdf import run_maintenance
+
+        # The workers repeat this while they poll
+        requeued, purged = run_maintenance()
+        if requeued:
+            self.stdout.write(self.style.WARNING(f"Re-queued {requeued} job(s) left running by a stopped worker."))
+        if purged:
+            self.stdout.write(f"Purged {purged} finished job(s) past their retention period.")
+
+        # Children must not inherit the parent's open database connections
+        connections.close_all()
+        stop_event = multiprocessing.Event()
+        host = socket.gethostname()
+        workers = [
+            multiprocessing.Process(
+                target=_worker_main,
+                args=(f"{host}:{os.getpid()}:{i}", options['poll_interval'], options['once'], stop_event),
+                daemon=True,
+            )
+            for i in range(max(1, options['processes']))
+        ]
+        for worker in workers:
+            worker.start()
+        self.stdout.write(f"Started {len(workers)} PDF worker process(es).")
+
+        try:
+            for worker in workers:
+                worker.join()
+        except KeyboardInterrupt:
+            self.stdout.write("Stopping workers after their current job...")
+            stop_event.set()
+            for worker in workers:
+                worker.join()
+        self.stdout.write(self.style.SUCCESS("PDF workers stopped."))
@@ -0,0 +1,27 @@
+# tvf_app/test_requests/management/commands/reconcile_queue_counters.py
+from django.core.management.base import BaseCommand
+
+from test_requests.models import Customer, TVFQueue
+from test_requests.queue_counters import reconcile_counters
+
+
+class Command(BaseCommand):
+    help = (
+        "Recounts the TVFs in every work queue and corrects the queue counters that drifted. "
+        "Meant to run periodically (e.g. nightly from cron)."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--dry-run', action='store_true', help="Report the drift without correcting it.")
+
+    def handle(self, *args, **options):
+        drift = reconcile_counters(dry_run=options['dry_run'])
+        if not drift:
+            self.stdout.write(self.style.SUCCESS("Every queue counter matches."))
+            return
+
+        customers = dict(Customer.objects.filter(pk__in={row[1] for row in drift}).values_list('pk', 'name'))
+        for queue, customer_id, stored, actual in drift:
+            self.stdout.write(f"{TVFQueue(queue).label} / {customers.get(customer_id, customer_id)}: counted {stored}, actually {actual}")
+        verb = "Would correct" if options['dry_run'] else "Corrected"
+        self.stdout.write(self.style.SUCCESS(f"{verb} {len(drift)} queue counter(s)."))
@@ -0,0 +1,20 @@
+# tvf_app/test_requests/middleware.py
+from django.utils.functional import SimpleLazyObject
+
+from .roles import get_user_roles
+
+
+class RoleMiddleware:
+    """
+    Attaches the user's role set to `request.roles`.
+    The set is resolved lazily, so requests that never check a role pay nothing.
+    Must come after SessionMiddleware and AuthenticationMiddleware.
+    """
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        request.roles = SimpleLazyObject(
+            lambda: get_user_roles(request.user, getattr(request, 'session', None))
+        )
+        return self.get_response(request)
@@ -0,0 +1,34 @@
+# Generated by Django 5.2.18 on 2026-10-17 11:20
+
+from django.db import migrations, models
+from django.db.models import Max
+
+
+def seed_tvf_number_sequence(apps, schema_editor):
+    TestRequest = apps.get_model('test_requests', 'TestRequest')
+    TVFNumberSequence = apps.get_model('test_requests', 'TVFNumberSequence')
+    max_tvf_number = TestRequest.objects.aggregate(Max('tvf_number'))['tvf_number__max']
+    TVFNumberSequence.objects.get_or_create(name='tvf_number', defaults={'last_value': max_tvf_number or 7554})
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('test_requests', '0009_alter_customer_options_alter_project_options_and_more'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='TVFNumberSequence',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(help_text="Name of the sequence (e.g., 'tvf_number')", max_length=50, unique=True)),
+                ('last_value', models.IntegerField(help_text='Last number handed out by this sequence')),
+            ],
+            options={
+                'verbose_name': 'TVF Number Sequence',
+                'verbose_name_plural': 'TVF Number Sequences',
+            },
+        ),
+        migrations.RunPython(seed_tvf_number_sequence, migrations.RunPython.noop),
+    ]
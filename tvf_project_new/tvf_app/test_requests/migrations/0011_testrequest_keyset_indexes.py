@@ -0,0 +1,31 @@
+# Generated by Django 5.2.18 on 2026-10-17 11:25
+
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('test_requests', '0010_tvfnumbersequence'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='testrequest',
+            index=models.Index(fields=['request_received_date', 'tvf_number'], name='tvf_received_keyset_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='testrequest',
+            index=models.Index(fields=['request_ship_date', 'tvf_number'], name='tvf_ship_date_keyset_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='testrequest',
+            index=models.Index(fields=['status', 'tvf_completed_date', 'tvf_number'], name='tvf_status_completed_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='testrequest',
+            index=models.Index(fields=['customer', 'request_received_date', 'tvf_number'], name='tvf_customer_received_idx'),
+        ),
+    ]
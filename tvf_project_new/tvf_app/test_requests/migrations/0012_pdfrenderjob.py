@@ -0,0 +1,38 @@
+# Generated by Django 5.2.18 on 2026-10-17 11:26
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('test_requests', '0011_testrequest_keyset_indexes'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='PDFRenderJob',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('status', models.CharField(choices=[('pending', 'Pending'), ('running', 'Running'), ('done', 'Done'), ('failed', 'Failed')], default='pending', help_text='Current state of the job', max_length=20)),
+                ('pdf_file', models.FileField(blank=True, help_text='The rendered PDF once the job is done', null=True, upload_to='pdf_jobs/')),
+                ('error', models.TextField(blank=True, help_text='Error details if rendering failed', null=True)),
+                ('worker', models.CharField(blank=True, help_text='Worker process that claimed the job', max_length=100, null=True)),
+                ('attempts', models.PositiveSmallIntegerField(default=0, help_text='Number of times a worker has claimed the job')),
+                ('created_at', models.DateTimeField(auto_now_add=True, help_text='When the job was queued')),
+                ('started_at', models.DateTimeField(blank=True, help_text='When a worker claimed the job', null=True)),
+                ('finished_at', models.DateTimeField(blank=True, help_text='When the job finished or failed', null=True)),
+                ('requested_by', models.ForeignKey(blank=True, help_text='User who requested the PDF', null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='pdf_jobs', to=settings.AUTH_USER_MODEL)),
+                ('test_request', models.ForeignKey(help_text='The TVF to render', on_delete=django.db.models.deletion.CASCADE, related_name='pdf_jobs', to='test_requests.testrequest')),
+            ],
+            options={
+                'verbose_name': 'PDF Render Job',
+                'verbose_name_plural': 'PDF Render Jobs',
+                'ordering': ['-created_at'],
+                'indexes': [models.Index(fields=['status', 'created_at'], name='pdf_job_queue_idx')],
+            },
+        ),
+    ]
@@ -0,0 +1,26 @@
+# Generated by Django 5.2.18 on 2026-10-17 11:36
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('test_requests', '0012_pdfrenderjob'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Holiday',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('date', models.DateField(help_text='Date of the holiday', unique=True)),
+                ('name', models.CharField(help_text="Name of the holiday (e.g., 'Canada Day')", max_length=255)),
+            ],
+            options={
+                'verbose_name': 'Holiday',
+                'verbose_name_plural': 'Holidays',
+                'ordering': ['date'],
+            },
+        ),
+    ]
@@ -0,0 +1,19 @@
+# Generated by Django 5.2.18 on 2026-10-17 12:02
+
+import django.utils.timezone
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('test_requests', '0013_holiday'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='auditlog',
+            name='timestamp',
+            field=models.DateTimeField(default=django.utils.timezone.now, help_text='When the change occurred'),
+        ),
+    ]
@@ -0,0 +1,23 @@
+# Generated by Django 5.2.18 on 2026-10-17 12:11
+
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('test_requests', '0015_auditlog_indexes'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='testrequestphaselog',
+            index=models.Index(fields=['start_time'], name='phaselog_start_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='testrequestphaselog',
+            index=models.Index(fields=['test_request', 'end_time'], name='phaselog_open_idx'),
+        ),
+    ]
@@ -0,0 +1,51 @@
+# Generated by Django 5.2.18 on 2026-10-17 12:17
+
+from django.conf import settings
+from django.db import migrations, models
+from django.db.models import Q
+
+# models.QUEUE_STATES as of this migration: (phase name, status name, rejected only, queue)
+QUEUE_STATES = [
+    ('PM_DRAFT', 'Draft', False, 1),
+    ('TVF_RELEASED', 'TVF_SUBMITTED', False, 2),
+    ('PROJECT_MANAGER', 'Rejected to PM', True, 3),
+    ('REWORK_AT_PM', 'Rejected to PM', True, 3),
+    ('REWORK_AT_PROD', 'Rejected to NPI', True, 4),
+    ('TVF_DP_DONE', 'DP Done', False, 5),
+    ('TVF_PROCESSED_AT_NPI', 'TVF Processed', False, 6),
+    ('TVF_OPEN_AT_QA', 'Open at QA', False, 7),
+    ('REWORK_AT_QA', 'Rejected to Quality', True, 8),
+    ('TVF_VALIDATED_AT_QA', 'Validated', False, 9),
+    ('TVF_OPEN_AT_LOGISTICS', 'Open at Logistics', False, 10),
+    ('REWORK_AT_LOGISTICS', 'Rejected to Logistics', True, 11),
+]
+
+
+def fill_queues(apps, schema_editor):
+    TestRequest = apps.get_model('test_requests', 'TestRequest')
+    for phase, status, rejected_only, queue in QUEUE_STATES:
+        condition = Q(current_phase__name=phase, status__name=status)
+        if rejected_only:
+            condition &= Q(is_rejected=True)
+        TestRequest.objects.filter(condition).update(queue=queue)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('test_requests', '0016_workflow_queue_indexes'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='testrequest',
+            name='queue',
+            field=models.PositiveSmallIntegerField(choices=[(0, 'Not queued'), (1, 'PM draft'), (2, 'Released to NPI'), (3, 'Rejected to PM'), (4, 'Rework at NPI'), (5, 'DP done'), (6, 'Processed at NPI'), (7, 'Open at QA'), (8, 'Rework at QA'), (9, 'Validated at QA'), (10, 'Open at Logistics'), (11, 'Rework at Logistics')], default=0, editable=False, help_text='Work queue the TVF is waiting in, derived from its phase, status and rejected flag'),
+        ),
+        migrations.AddIndex(
+            model_name='testrequest',
+            index=models.Index(fields=['queue', 'request_ship_date', 'tvf_number'], name='tvf_queue_sla_idx'),
+        ),
+        migrations.RunPython(fill_queues, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,39 @@
+# Generated by Django 5.2.18 on 2026-10-17 12:22
+
+import django.db.models.deletion
+from django.db import migrations, models
+from django.db.models import Count
+
+
+def count_queues(apps, schema_editor):
+    TestRequest = apps.get_model('test_requests', 'TestRequest')
+    QueueCounter = apps.get_model('test_requests', 'QueueCounter')
+    counts = TestRequest.objects.exclude(queue=0).values_list('queue', 'customer_id').annotate(count=Count('pk')).order_by()
+    QueueCounter.objects.bulk_create([
+        QueueCounter(queue=queue, customer_id=customer_id, count=count) for queue, customer_id, count in counts
+    ])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('test_requests', '0017_testrequest_queue'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='QueueCounter',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('queue', models.PositiveSmallIntegerField(choices=[(0, 'Not queued'), (1, 'PM draft'), (2, 'Released to NPI'), (3, 'Rejected to PM'), (4, 'Rework at NPI'), (5, 'DP done'), (6, 'Processed at NPI'), (7, 'Open at QA'), (8, 'Rework at QA'), (9, 'Validated at QA'), (10, 'Open at Logistics'), (11, 'Rework at Logistics')], help_text='Work queue being counted')),
+                ('count', models.IntegerField(default=0, help_text="Number of the customer's TVFs in the queue")),
+                ('customer', models.ForeignKey(help_text='Customer whose TVFs are counted', on_delete=django.db.models.deletion.CASCADE, related_name='queue_counters', to='test_requests.customer')),
+            ],
+            options={
+                'verbose_name': 'Queue Counter',
+                'verbose_name_plural': 'Queue Counters',
+                'unique_together': {('queue', 'customer')},
+            },
+        ),
+        migrations.RunPython(count_queues, migrations.RunPython.noop),
+    ]
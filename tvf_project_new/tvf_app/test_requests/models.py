@@ -1,9 +1,9 @@
 # tvf_app/test_requests/models.py
-from django.db import models
+from django.db import models, transaction, IntegrityError
 from django.contrib.auth.models import User
 from django.db.models.signals import pre_save
 from django.dispatch import receiver
-from django.db.models import Max
+from django.db.models import F, Max
 from django.utils import timezone
 
 # --- Lookup / Reference Models ---
@@ -172,6 +172,58 @@ class RejectReason(models.Model):
     def __str__(self):
         return self.reason
 
+class Holiday(models.Model):
+    """
+    A non-working day skipped by SLA business-day calculations (weekends are always skipped).
+    """
+    date = models.DateField(unique=True, help_text="Date of the holiday")
+    name = models.CharField(max_length=255, help_text="Name of the holiday (e.g., 'Canada Day')")
+
+    class Meta:
+        verbose_name = "Holiday"
+        verbose_name_plural = "Holidays"
+        ordering = ['date']
+
+    def __str__(self):
+        return f"{self.date}: {self.name}"
+
+# --- Workflow Queues ---
+
+class TVFQueue(models.IntegerChoices):
+    """
+    The work queue a TVF is waiting in, stored on TestRequest.queue so every dashboard
+    bucket is one index range scan instead of a join on phase and status names.
+    """
+    NONE = 0, "Not queued"
+    PM_DRAFT = 1, "PM draft"
+    RELEASED = 2, "Released to NPI"
+    REJECTED_TO_PM = 3, "Rejected to PM"
+    REWORK_AT_NPI = 4, "Rework at NPI"
+    DP_DONE = 5, "DP done"
+    PROCESSED_AT_NPI = 6, "Processed at NPI"
+    OPEN_AT_QA = 7, "Open at QA"
+    REWORK_AT_QA = 8, "Rework at QA"
+    VALIDATED_AT_QA = 9, "Validated at QA"
+    OPEN_AT_LOGISTICS = 10, "Open at Logistics"
+    REWORK_AT_LOGISTICS = 11, "Rework at Logistics"
+
+
+# (phase name, status name, rejected only) -> queue; a TVF in no listed state is TVFQueue.NONE
+QUEUE_STATES = [
+    ('PM_DRAFT', 'Draft', False, TVFQueue.PM_DRAFT),
+    ('TVF_RELEASED', 'TVF_SUBMITTED', False, TVFQueue.RELEASED),
+    ('PROJECT_MANAGER', 'Rejected to PM', True, TVFQueue.REJECTED_TO_PM),
+    ('REWORK_AT_PM', 'Rejected to PM', True, TVFQueue.REJECTED_TO_PM),
+    ('REWORK_AT_PROD', 'Rejected to NPI', True, TVFQueue.REWORK_AT_NPI),
+    ('TVF_DP_DONE', 'DP Done', False, TVFQueue.DP_DONE),
+    ('TVF_PROCESSED_AT_NPI', 'TVF Processed', False, TVFQueue.PROCESSED_AT_NPI),
+    ('TVF_OPEN_AT_QA', 'Open at QA', False, TVFQueue.OPEN_AT_QA),
+    ('REWORK_AT_QA', 'Rejected to Quality', True, TVFQueue.REWORK_AT_QA),
+    ('TVF_VALIDATED_AT_QA', 'Validated', False, TVFQueue.VALIDATED_AT_QA),
+    ('TVF_OPEN_AT_LOGISTICS', 'Open at Logistics', False, TVFQueue.OPEN_AT_LOGISTICS),
+    ('REWORK_AT_LOGISTICS', 'Rejected to Logistics', True, TVFQueue.REWORK_AT_LOGISTICS),
+]
+
 # --- Main Test Request Model ---
 
 class TestRequest(models.Model):
@@ -210,6 +262,10 @@ class TestRequest(models.Model):
     status = models.ForeignKey(TVFStatus, on_delete=models.PROTECT, related_name='test_requests_by_status', help_text="Current status of the TVF")
     current_phase = models.ForeignKey(TestRequestPhaseDefinition, on_delete=models.PROTECT, blank=True, null=True, related_name='current_tvfs', help_text="Current phase of the TVF lifecycle")
     last_status_update = models.DateTimeField(auto_now=True, help_text="Automatically updated timestamp of the last status change")
+    queue = models.PositiveSmallIntegerField(
+        choices=TVFQueue.choices, default=TVFQueue.NONE, editable=False,
+        help_text="Work queue the TVF is waiting in, derived from its phase, status and rejected flag",
+    )
 
     # Rejection Fields
     is_rejected = models.BooleanField(default=False, help_text="Indicates if the TVF has been rejected")
@@ -224,25 +280,99 @@ class TestRequest(models.Model):
         verbose_name_plural = "Test Requests (TVFs)"
         ordering = ['-tvf_number']
         permissions = []
+        # Keyset pagination indexes for the TVF list: every sortable column paired with the tvf_number tie-break
+        indexes = [
+            models.Index(fields=['request_received_date', 'tvf_number'], name='tvf_received_keyset_idx'),
+            models.Index(fields=['request_ship_date', 'tvf_number'], name='tvf_ship_date_keyset_idx'),
+            models.Index(fields=['status', 'tvf_completed_date', 'tvf_number'], name='tvf_status_completed_idx'),
+            models.Index(fields=['customer', 'request_received_date', 'tvf_number'], name='tvf_customer_received_idx'),
+            # Workflow queues (dashboard.BUCKETS): rows already in SLA due-date order within each queue
+            models.Index(fields=['queue', 'request_ship_date', 'tvf_number'], name='tvf_queue_sla_idx'),
+        ]
 
     def __str__(self):
         return f"TVF {self.tvf_number}: {self.tvf_name} ({self.customer.name})"
 
     def save(self, *args, **kwargs):
+        from .workflow import registry # Imported here to avoid a circular import
+
         # Set initial status if not already set (e.g., 'Pending' or 'New')
         if not self.status_id:
-            self.status, created = TVFStatus.objects.get_or_create(name='Pending')
+            self.status_id = registry.status_id('Pending')
         # Set initial phase if not already set
         if not self.current_phase_id:
-            self.current_phase, created = TestRequestPhaseDefinition.objects.get_or_create(name='Data Entry', order=1)
+            self.current_phase_id = registry.phase_id('Data Entry', order=1)
+        self.queue = registry.queue_value(self.current_phase_id, self.status_id, self.is_rejected)
+        # Every TVF gets an SLA due date, so open TVFs can be checked against it in bulk
+        if not self.request_ship_date and self.request_received_date and self.customer_id:
+            from .sla import sla_due_date
+            self.request_ship_date = sla_due_date(self.request_received_date, self.customer.sla_days)
         super().save(*args, **kwargs)
 
+# --- Queue Counters ---
+
+class QueueCounter(models.Model):
+    """
+    Number of TVFs waiting in one work queue for one customer. Kept in step by every
+    status or phase change, in the same transaction (see queue_counters.py), so queue
+    counts are read from this small table instead of counting TestRequest rows.
+    """
+    queue = models.PositiveSmallIntegerField(choices=TVFQueue.choices, help_text="Work queue being counted")
+    customer = models.ForeignKey(Customer, on_delete=models.CASCADE, related_name='queue_counters', help_text="Customer whose TVFs are counted")
+    count = models.IntegerField(default=0, help_text="Number of the customer's TVFs in the queue")
+
+    class Meta:
+        verbose_name = "Queue Counter"
+        verbose_name_plural = "Queue Counters"
+        unique_together = ('queue', 'customer')
+
+    def __str__(self):
+        return f"{self.get_queue_display()} / {self.customer_id}: {self.count}"
+
+# --- TVF Number Allocation ---
+
+TVF_NUMBER_START = 7555 # First TVF number handed out on an empty database
+
+class TVFNumberSequence(models.Model):
+    """
+    Counter row that hands out TVF numbers.
+    Incrementing this single row serializes concurrent allocations on its row lock,
+    instead of reading Max(tvf_number) over the whole TestRequest table.
+    """
+    name = models.CharField(max_length=50, unique=True, help_text="Name of the sequence (e.g., 'tvf_number')")
+    last_value = models.IntegerField(help_text="Last number handed out by this sequence")
+
+    class Meta:
+        verbose_name = "TVF Number Sequence"
+        verbose_name_plural = "TVF Number Sequences"
+
+    def __str__(self):
+        return f"{self.name}: {self.last_value}"
+
+def allocate_tvf_number():
+    """
+    Returns the next TVF number.
+    The UPDATE takes the counter row's lock before the value is read back,
+    so two concurrent callers can never be handed the same number.
+    """
+    sequence = TVFNumberSequence.objects.filter(name='tvf_number')
+    with transaction.atomic():
+        if not sequence.update(last_value=F('last_value') + 1):
+            # No counter row yet (normally seeded by migration): start after the highest existing number
+            max_tvf_number = TestRequest.objects.aggregate(Max('tvf_number'))['tvf_number__max']
+            try:
+                with transaction.atomic():
+                    TVFNumberSequence.objects.create(name='tvf_number', last_value=(max_tvf_number or TVF_NUMBER_START - 1) + 1)
+            except IntegrityError:
+                # Another process seeded the row first
+                sequence.update(last_value=F('last_value') + 1)
+        return sequence.values_list('last_value', flat=True).get()
+
 # Signal to auto-increment tvf_number
 @receiver(pre_save, sender=TestRequest)
 def set_tvf_number(sender, instance, **kwargs):
     if not instance.tvf_number:
-        max_tvf_number = sender.objects.all().aggregate(Max('tvf_number'))['tvf_number__max']
-        instance.tvf_number = (max_tvf_number or 7554) + 1 # Start from 7555 if no existing TVFs
+        instance.tvf_number = allocate_tvf_number() # Starts from 7555 if no existing TVFs
 
 # --- Related Models (One-to-Many) ---
 
@@ -376,6 +506,12 @@ class TestRequestPhaseLog(models.Model):
         verbose_name = "TVF Phase Log"
         verbose_name_plural = "TVF Phase Logs"
         ordering = ['start_time']
+        indexes = [
+            # Analytics windows (analytics.load_phase_log_columns)
+            models.Index(fields=['start_time'], name='phaselog_start_idx'),
+            # The open log of a TVF, closed on every transition (phase_logs.record_phase_changes)
+            models.Index(fields=['test_request', 'end_time'], name='phaselog_open_idx'),
+        ]
 
     def __str__(self):
         return f"TVF {self.test_request.tvf_number} - Phase: {self.phase_name.name} ({self.start_time.strftime('%Y-%m-%d %H:%M')})"
@@ -392,7 +528,8 @@ class AuditLog(models.Model):
     A generic audit log to track changes to any model instance.
     This model will be managed by Django's migrations.
     """
-    timestamp = models.DateTimeField(auto_now_add=True, help_text="When the change occurred")
+    # Set when the change is captured, not when the buffered row is written (see audit.py)
+    timestamp = models.DateTimeField(default=timezone.now, help_text="When the change occurred")
     user = models.ForeignKey(User, on_delete=models.SET_NULL, null=True, blank=True, help_text="User who made the change")
     action = models.CharField(max_length=255, help_text="Type of action (e.g., 'created', 'updated', 'deleted')")
     model_name = models.CharField(max_length=255, help_text="Name of the model that was changed")
@@ -406,6 +543,57 @@ class AuditLog(models.Model):
         verbose_name = "Audit Log"
         verbose_name_plural = "Audit Logs"
         ordering = ['-timestamp']
+        indexes = [
+            # Newest-first listing and the retention cut-off (archive_audit_logs)
+            models.Index(fields=['timestamp'], name='auditlog_timestamp_idx'),
+            # A record's history
+            models.Index(fields=['model_name', 'record_id', 'timestamp'], name='auditlog_record_idx'),
+        ]
 
     def __str__(self):
-        return f"[{self.timestamp.strftime('%Y-%m-%d %H:%M')}] {self.user or 'System'} - {self.action} {self.model_name} (ID: {self.record_id})"
\ No newline at end of file
+        return f"[{self.timestamp.strftime('%Y-%m-%d %H:%M')}] {self.user or 'System'} - {self.action} {self.model_name} (ID: {self.record_id})"
+
+
+# --- Background PDF Rendering ---
+
+class PDFRenderJob(models.Model):
+    """
+    A queued request to render a TVF's PDF, drained by the `pdf_worker` management command.
+    The table itself is the queue, so no external broker is needed.
+    """
+    STATUS_PENDING = 'pending'
+    STATUS_RUNNING = 'running'
+    STATUS_DONE = 'done'
+    STATUS_FAILED = 'failed'
+    STATUS_CHOICES = [
+        (STATUS_PENDING, 'Pending'),
+        (STATUS_RUNNING, 'Running'),
+        (STATUS_DONE, 'Done'),
+        (STATUS_FAILED, 'Failed'),
+    ]
+
+    test_request = models.ForeignKey(TestRequest, on_delete=models.CASCADE, related_name='pdf_jobs', help_text="The TVF to render")
+    requested_by = models.ForeignKey(User, on_delete=models.SET_NULL, null=True, blank=True, related_name='pdf_jobs', help_text="User who requested the PDF")
+    status = models.CharField(max_length=20, choices=STATUS_CHOICES, default=STATUS_PENDING, help_text="Current state of the job")
+    pdf_file = models.FileField(upload_to='pdf_jobs/', blank=True, null=True, help_text="The rendered PDF once the job is done")
+    error = models.TextField(blank=True, null=True, help_text="Error details if rendering failed")
+    worker = models.CharField(max_length=100, blank=True, null=True, help_text="Worker process that claimed the job")
+    attempts = models.PositiveSmallIntegerField(default=0, help_text="Number of times a worker has claimed the job")
+    created_at = models.DateTimeField(auto_now_add=True, help_text="When the job was queued")
+    started_at = models.DateTimeField(blank=True, null=True, help_text="When a worker claimed the job")
+    finished_at = models.DateTimeField(blank=True, null=True, help_text="When the job finished or failed")
+
+    class Meta:
+        verbose_name = "PDF Render Job"
+        verbose_name_plural = "PDF Render Jobs"
+        ordering = ['-created_at']
+        indexes = [
+            models.Index(fields=['status', 'created_at'], name='pdf_job_queue_idx'),
+        ]
+
+    def __str__(self):
+        return f"PDF job {self.pk} for TVF {self.test_request.tvf_number} ({self.status})"
+
+    @property
+    def is_finished(self):
+        return self.status in (self.STATUS_DONE, self.STATUS_FAILED)
@@ -0,0 +1,245 @@
+# tvf_app/test_requests/pdf.py
+import io
+import os
+import time
+from datetime import timedelta
+
+from django.conf import settings
+from django.db.models import F
+from django.template.loader import get_template, render_to_string
+from django.utils import timezone
+from xhtml2pdf import pisa
+
+from .models import PDFRenderJob, TestRequest
+from .pdf_cache import PDFCache, pdf_cache, tvf_content_version
+from .reference_data import REFERENCE_DATA_VERSION
+from .versioning import get_versions
+from .workflow import REGISTRY_VERSION
+
+PDF_TEMPLATE = 'test_requests/test_request_pdf_template.html'
+
+# A running job not finished within this time is assumed lost with its worker and queued again
+STALE_JOB_TIMEOUT = timedelta(minutes=10)
+MAX_ATTEMPTS = 3
+# Workers look for stale jobs and purge old finished ones this often while polling
+MAINTENANCE_INTERVAL = timedelta(minutes=1)
+DEFAULT_JOB_RETENTION_DAYS = 7
+
+
+class PDFRenderError(Exception):
+    """
+    Raised when xhtml2pdf reports errors while rendering a document.
+    """
+
+
+def tvf_pdf_queryset():
+    """
+    TestRequests with every related row the PDF template reads.
+    """
+    return TestRequest.objects.select_related(
+        'customer', 'project', 'tvf_initiator', 'tvf_type', 'tvf_environment', 'status', 'current_phase', 'trustport_folder_actual'
+    ).prefetch_related(
+        'plastic_codes_entries__plastic_code_lookup',
+        'input_files_entries__pans',
+        'quality_details__quality_sign_off_by',
+        'shipping_details__dispatch_method',
+        'shipping_details__shipping_sign_off_by'
+    )
+
+
+def render_tvf_html(test_request):
+    return render_to_string(PDF_TEMPLATE, {'test_request': test_request})
+
+
+def html_to_pdf(html):
+    """
+    Converts rendered HTML to PDF bytes.
+    """
+    output = io.BytesIO()
+    pisa_status = pisa.CreatePDF(html, dest=output)
+    if pisa_status.err:
+        raise PDFRenderError(f"xhtml2pdf reported {pisa_status.err} error(s).")
+    return output.getvalue()
+
+
+def pdf_versions(tvf_id):
+    """
+    The version tokens a TVF's PDF depends on besides its own row: its child rows, and the
+    reference data and workflow names it shows. Read them before the row, so a change committed
+    in between gives a new key rather than caching old content under it.
+    """
+    return get_versions(tvf_content_version(tvf_id), REFERENCE_DATA_VERSION, REGISTRY_VERSION)
+
+
+def pdf_cache_key(test_request, versions):
+    """
+    The PDF cache key of `test_request` (which needs only pk and last_status_update loaded),
+    computed without rendering anything. Saves and transitions move last_status_update; the
+    `versions` from pdf_versions() cover everything else, and a template change is a new key too.
+    """
+    template_mtime = os.path.getmtime(get_template(PDF_TEMPLATE).origin.name)
+    updated = test_request.last_status_update.isoformat() if test_request.last_status_update else ''
+    return PDFCache.key_for('|'.join([PDF_TEMPLATE, str(template_mtime), str(test_request.pk), updated, *versions]))
+
+
+def pdf_filename(test_request):
+    return f"TVF_{test_request.tvf_number}.pdf"
+
+
+# --- Job queue ---
+
+def cached_pdf_job(test_request, user, key):
+    """
+    A finished job for a PDF served from the cache: the user's latest job for that file if there
+    is one, so repeated downloads of an unchanged TVF do not add a job each.
+    """
+    pdf_file = pdf_cache.relative_name(key)
+    job = PDFRenderJob.objects.filter(
+        test_request=test_request, requested_by=user, status=PDFRenderJob.STATUS_DONE, pdf_file=pdf_file,
+    ).first()
+    if job is None:
+        now = timezone.now()
+        job = PDFRenderJob.objects.create(
+            test_request=test_request, requested_by=user, status=PDFRenderJob.STATUS_DONE,
+            pdf_file=pdf_file, started_at=now, finished_at=now,
+        )
+    return job
+
+
+def enqueue_pdf_job(test_request, user):
+    """
+    Queues a PDF render for `test_request` and returns the job.
+    A job the same user already has waiting for this TVF is reused rather than duplicated.
+    """
+    job = PDFRenderJob.objects.filter(
+        test_request=test_request, requested_by=user,
+        status__in=[PDFRenderJob.STATUS_PENDING, PDFRenderJob.STATUS_RUNNING],
+    ).first()
+    if job is None:
+        job = PDFRenderJob.objects.create(test_request=test_request, requested_by=user)
+    return job
+
+
+def enqueue_pdf_jobs(tvf_ids, user):
+    """
+    Queues PDF renders for several TVFs at once and returns {TVF id: job id}. Jobs the user already
+    has waiting are reused; the rest are inserted together, so the queries do not grow with the TVFs.
+    """
+    waiting = PDFRenderJob.objects.filter(
+        test_request_id__in=tvf_ids, requested_by=user,
+        status__in=[PDFRenderJob.STATUS_PENDING, PDFRenderJob.STATUS_RUNNING],
+    ).order_by('pk')
+    jobs = dict(waiting.values_list('test_request_id', 'pk'))
+    missing = [tvf_id for tvf_id in tvf_ids if tvf_id not in jobs]
+    if missing:
+        PDFRenderJob.objects.bulk_create([PDFRenderJob(test_request_id=tvf_id, requested_by=user) for tvf_id in missing])
+        # MySQL does not return the ids of bulk-inserted rows, so they are read back
+        jobs.update(waiting.filter(test_request_id__in=missing).values_list('test_request_id', 'pk'))
+    return jobs
+
+
+def claim_next_job(worker_name):
+    """
+    Claims the oldest pending job for `worker_name` and returns it, or None if the queue is empty.
+    The claim is a conditional UPDATE, so two workers can never take the same job.
+    """
+    while True:
+        job_id = PDFRenderJob.objects.filter(
+            status=PDFRenderJob.STATUS_PENDING
+        ).order_by('created_at', 'pk').values_list('pk', flat=True).first()
+        if job_id is None:
+            return None
+        claimed = PDFRenderJob.objects.filter(pk=job_id, status=PDFRenderJob.STATUS_PENDING).update(
+            status=PDFRenderJob.STATUS_RUNNING, worker=worker_name,
+            started_at=timezone.now(), attempts=F('attempts') + 1,
+        )
+        if claimed:
+            return PDFRenderJob.objects.get(pk=job_id)
+        # Another worker got there first; try the next job
+
+
+def requeue_stale_jobs():
+    """
+    Returns jobs left running by a worker that died to the queue, failing those out of attempts.
+    Returns the number of jobs queued again.
+    """
+    now = timezone.now()
+    stale = PDFRenderJob.objects.filter(status=PDFRenderJob.STATUS_RUNNING, started_at__lt=now - STALE_JOB_TIMEOUT)
+    stale.filter(attempts__gte=MAX_ATTEMPTS).update(
+        status=PDFRenderJob.STATUS_FAILED, error="The worker did not finish the job.", finished_at=now,
+    )
+    return stale.update(status=PDFRenderJob.STATUS_PENDING, worker=None)
+
+
+def purge_finished_jobs():
+    """
+    Deletes done and failed jobs that finished more than TVF_PDF_JOB_RETENTION_DAYS ago, with any
+    file of their own under pdf_jobs/. Files in the PDF cache are shared between jobs and left to
+    its eviction. Returns the number of jobs deleted.
+    """
+    cutoff = timezone.now() - timedelta(days=getattr(settings, 'TVF_PDF_JOB_RETENTION_DAYS', DEFAULT_JOB_RETENTION_DAYS))
+    expired = PDFRenderJob.objects.filter(
+        status__in=[PDFRenderJob.STATUS_DONE, PDFRenderJob.STATUS_FAILED], finished_at__lt=cutoff,
+    )
+    job_field = PDFRenderJob._meta.get_field('pdf_file')
+    names = set(expired.filter(pdf_file__startswith=job_field.upload_to).values_list('pdf_file', flat=True))
+    deleted, _ = expired.delete()
+    # A file is only removed once no remaining job points at it
+    names -= set(PDFRenderJob.objects.filter(pdf_file__in=names).values_list('pdf_file', flat=True))
+    for name in names:
+        job_field.storage.delete(name)
+    return deleted
+
+
+def run_maintenance():
+    """
+    Housekeeping the workers run between jobs: requeues stale jobs and purges old finished ones.
+    Returns (jobs requeued, jobs purged).
+    """
+    return requeue_stale_jobs(), purge_finished_jobs()
+
+
+def run_job(job):
+    """
+    Renders the PDF for a claimed job and stores it. Returns True on success.
+    """
+    try:
+        versions = pdf_versions(job.test_request_id)
+        test_request = tvf_pdf_queryset().get(pk=job.test_request_id)
+        key = pdf_cache_key(test_request, versions)
+        # The unchanged TVF may already have been rendered for an earlier job
+        if not pdf_cache.path_for(key).exists():
+            pdf_cache.put(key, html_to_pdf(render_tvf_html(test_request)))
+    except Exception as e: # Any failure is recorded on the job rather than killing the worker
+        PDFRenderJob.objects.filter(pk=job.pk).update(
+            status=PDFRenderJob.STATUS_FAILED, error=str(e), finished_at=timezone.now(),
+        )
+        return False
+
+    PDFRenderJob.objects.filter(pk=job.pk, status=PDFRenderJob.STATUS_RUNNING).update(
+        status=PDFRenderJob.STATUS_DONE, pdf_file=pdf_cache.relative_name(key), error=None, finished_at=timezone.now(),
+    )
+    return True
+
+
+def work(worker_name, poll_interval=1.0, once=False, stop_event=None):
+    """
+    Worker loop: claims and renders jobs until stopped, or until the queue is empty when `once`.
+    Every MAINTENANCE_INTERVAL it also requeues stale jobs and purges old finished ones.
+    Returns the number of jobs processed.
+    """
+    processed = 0
+    next_maintenance = 0
+    while stop_event is None or not stop_event.is_set():
+        if time.monotonic() >= next_maintenance:
+            run_maintenance()
+            next_maintenance = time.monotonic() + MAINTENANCE_INTERVAL.total_seconds()
+        job = claim_next_job(worker_name)
+        if job is None:
+            if once:
+                break
+            time.sleep(poll_interval)
+            continue
+        run_job(job)
+        processed += 1
+    return processed
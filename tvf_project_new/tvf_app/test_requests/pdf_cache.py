@@ -0,0 +1,168 @@
+# tvf_app/test_requests/pdf_cache.py
+import hashlib
+import os
+import tempfile
+from pathlib import Path
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction
+from django.db.models.signals import post_delete, post_save
+
+from .models import TestRequestInputFile, TestRequestPAN, TestRequestPlasticCode, TestRequestQuality, TestRequestShipping
+from .versioning import bump_version
+
+PDF_CACHE_DIRNAME = 'pdf_cache'
+DEFAULT_MAX_BYTES = 500 * 1024 * 1024
+
+HITS_KEY = 'tvf:pdf_cache:hits'
+MISSES_KEY = 'tvf:pdf_cache:misses'
+
+
+def _incr(key):
+    # cache.incr() fails on a missing key, so seed it first; add() is a no-op if it exists
+    cache.add(key, 0, None)
+    try:
+        cache.incr(key)
+    except ValueError: # Evicted between add() and incr()
+        cache.set(key, 1, None)
+
+
+class PDFCache:
+    """
+    Disk cache of rendered PDFs, keyed by the SHA-256 of the HTML they were rendered from.
+    Files live under MEDIA_ROOT/pdf_cache/<2-char prefix>/<key>.pdf. Each hit refreshes a
+    file's mtime, and once the directory grows past `max_bytes` the least recently used
+    files are removed.
+    """
+    def __init__(self, directory=None, max_bytes=None):
+        self._directory = directory
+        self._max_bytes = max_bytes
+
+    @property
+    def directory(self):
+        # Resolved lazily so MEDIA_ROOT overrides (e.g. in tests) are honoured
+        return Path(self._directory or Path(settings.MEDIA_ROOT) / PDF_CACHE_DIRNAME)
+
+    @property
+    def max_bytes(self):
+        if self._max_bytes is not None:
+            return self._max_bytes
+        return getattr(settings, 'TVF_PDF_CACHE_MAX_BYTES', DEFAULT_MAX_BYTES)
+
+    @staticmethod
+    def key_for(html):
+        return hashlib.sha256(html.encode('utf-8')).hexdigest()
+
+    def path_for(self, key):
+        return self.directory / key[:2] / f'{key}.pdf'
+
+    def relative_name(self, key):
+        """
+        The cached file's name relative to MEDIA_ROOT, for storing in a FileField.
+        """
+        return os.path.relpath(self.path_for(key), settings.MEDIA_ROOT).replace(os.sep, '/')
+
+    def get(self, key):
+        """
+        Returns the path of the cached PDF for `key`, or None, counting the hit or miss.
+        """
+        path = self.path_for(key)
+        try:
+            os.utime(path) # Mark as recently used
+        except FileNotFoundError:
+            _incr(MISSES_KEY)
+            return None
+        _incr(HITS_KEY)
+        return path
+
+    def put(self, key, pdf):
+        """
+        Stores the PDF bytes under `key` and returns the path, evicting old files if needed.
+        """
+        path = self.path_for(key)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        # Write to a temporary file and rename, so readers never see a half-written PDF
+        fd, tmp_path = tempfile.mkstemp(dir=path.parent, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as tmp:
+                tmp.write(pdf)
+            os.replace(tmp_path, path)
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
+        self.evict()
+        return path
+
+    def evict(self):
+        """
+        Removes the least recently used PDFs until the cache fits in `max_bytes`.
+        Returns the number of files removed.
+        """
+        entries = []
+        total = 0
+        for path in self.directory.glob('*/*.pdf'):
+            try:
+                stat = path.stat()
+            except FileNotFoundError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, path))
+            total += stat.st_size
+        if total <= self.max_bytes:
+            return 0
+
+        removed = 0
+        for _, size, path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            try:
+                path.unlink()
+            except FileNotFoundError:
+                pass
+            total -= size
+            removed += 1
+        return removed
+
+    def stats(self):
+        counts = cache.get_many([HITS_KEY, MISSES_KEY])
+        return {'hits': counts.get(HITS_KEY, 0), 'misses': counts.get(MISSES_KEY, 0)}
+
+
+pdf_cache = PDFCache()
+
+
+# --- Invalidation ---
+# A TVF's PDF is keyed on its own row's last_status_update (see pdf.pdf_cache_key) plus this version
+# of the rows hanging off it, which change without touching the TVF row.
+
+def tvf_content_version(tvf_id):
+    return f'pdf:tvf:{tvf_id}'
+
+
+def invalidate_tvf_pdfs(*tvf_ids):
+    """
+    Gives the cached PDFs of the given TVFs new keys: at once, and again when the transaction
+    commits, so a PDF rendered from the rows before the commit is not cached under the new key.
+    """
+    names = sorted({tvf_content_version(tvf_id) for tvf_id in tvf_ids if tvf_id is not None})
+    if not names:
+        return
+    bump_version(*names)
+    transaction.on_commit(lambda: bump_version(*names))
+
+
+def _child_changed(sender, instance, raw=False, **kwargs):
+    if raw:
+        return
+    if sender is TestRequestPAN:
+        tvf_id = TestRequestInputFile.objects.filter(pk=instance.test_request_input_file_id).values_list(
+            'test_request_id', flat=True
+        ).first() # None once a cascade has removed the input file, whose own delete invalidated the TVF
+    else:
+        tvf_id = instance.test_request_id
+    invalidate_tvf_pdfs(tvf_id)
+
+
+for _model in (TestRequestPlasticCode, TestRequestInputFile, TestRequestPAN, TestRequestQuality, TestRequestShipping):
+    post_save.connect(_child_changed, sender=_model, dispatch_uid=f'pdf_cache_{_model._meta.model_name}_saved')
+    post_delete.connect(_child_changed, sender=_model, dispatch_uid=f'pdf_cache_{_model._meta.model_name}_deleted')
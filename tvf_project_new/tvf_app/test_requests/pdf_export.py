@@ -0,0 +1,168 @@
+# tvf_app/test_requests/pdf_export.py
+import asyncio
+import time
+import zipfile
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+
+from .models import PDFRenderJob, TestRequest
+from .pdf import enqueue_pdf_jobs, pdf_cache_key, pdf_filename, pdf_versions
+from .pdf_cache import pdf_cache
+
+# Most TVFs a single export may contain
+MAX_EXPORT_TVFS = 200
+# TVFs looked up, rendered and zipped per round; bounds how many PDFs are held in memory at once
+EXPORT_BATCH_SIZE = 8
+# Seconds between checks on a batch's render jobs
+EXPORT_POLL_INTERVAL = 0.5
+# Seconds an export waits for the pdf_worker to render a batch before writing error entries instead
+DEFAULT_EXPORT_WAIT_SECONDS = 120
+
+
+class ZipStream:
+    """
+    Write-only, unseekable file object that collects what ZipFile writes
+    so it can be handed out chunk by chunk.
+    """
+    def __init__(self):
+        self._chunks = []
+
+    def write(self, data):
+        self._chunks.append(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def pop(self):
+        data = b''.join(self._chunks)
+        self._chunks.clear()
+        return data
+
+
+def _read_cached(key):
+    cached_path = pdf_cache.get(key)
+    if cached_path is None:
+        return None
+    try:
+        with open(cached_path, 'rb') as cached:
+            return cached.read()
+    except FileNotFoundError: # Evicted since the lookup
+        return None
+
+
+class ExportBatch:
+    """
+    One round of an export: the PDFs found in the cache, and render jobs queued for the rest.
+    """
+    def __init__(self, tvfs, results, waiting, wait_seconds):
+        self.tvfs = tvfs
+        self.results = results # TVF id -> PDF bytes, or the message written in place of the PDF
+        self.waiting = waiting # Job id -> TVF id
+        self.deadline = time.monotonic() + wait_seconds
+
+    @property
+    def done(self):
+        return not self.waiting
+
+    def poll(self):
+        """
+        Collects the batch's finished jobs in one query; past the deadline the rest are given up on.
+        """
+        finished = PDFRenderJob.objects.filter(
+            pk__in=list(self.waiting), status__in=[PDFRenderJob.STATUS_DONE, PDFRenderJob.STATUS_FAILED],
+        ).values_list('pk', 'status', 'pdf_file', 'error')
+        storage = PDFRenderJob._meta.get_field('pdf_file').storage
+        for job_id, status, pdf_file, error in finished:
+            tvf_id = self.waiting.pop(job_id)
+            if status == PDFRenderJob.STATUS_FAILED:
+                self.results[tvf_id] = f"could not be rendered: {error}"
+                continue
+            try:
+                with storage.open(pdf_file, 'rb') as rendered:
+                    self.results[tvf_id] = rendered.read()
+            except FileNotFoundError: # Evicted from the PDF cache since the worker wrote it
+                self.results[tvf_id] = "was rendered but evicted from the PDF cache before it was exported; please export again."
+        if self.waiting and time.monotonic() >= self.deadline:
+            for tvf_id in self.waiting.values():
+                self.results[tvf_id] = "was not rendered in time; check that the pdf_worker command is running."
+            self.waiting.clear()
+
+
+class PDFExport:
+    """
+    Builds a ZIP archive of TVF PDFs batch by batch. PDFs come from the PDF cache; the rest are
+    queued as PDFRenderJobs for the pdf_worker processes, so nothing is rendered in the web
+    process. Driven by stream_pdf_zip() under WSGI and astream_pdf_zip() under ASGI.
+    """
+    def __init__(self, tvf_ids, user, batch_size=EXPORT_BATCH_SIZE):
+        self.tvf_ids = list(tvf_ids)
+        self.user = user
+        self.batch_size = batch_size
+        self.wait_seconds = getattr(settings, 'TVF_PDF_EXPORT_WAIT_SECONDS', DEFAULT_EXPORT_WAIT_SECONDS)
+        self.stream = ZipStream()
+        self.archive = zipfile.ZipFile(self.stream, mode='w', compression=zipfile.ZIP_DEFLATED)
+
+    def batches(self):
+        for start in range(0, len(self.tvf_ids), self.batch_size):
+            yield self.tvf_ids[start:start + self.batch_size]
+
+    def start_batch(self, batch_ids):
+        versions = {tvf_id: pdf_versions(tvf_id) for tvf_id in batch_ids}
+        tvfs = list(TestRequest.objects.filter(pk__in=batch_ids).only('pk', 'tvf_number', 'last_status_update').order_by('tvf_number'))
+        results = {}
+        for test_request in tvfs:
+            pdf = _read_cached(pdf_cache_key(test_request, versions[test_request.pk]))
+            if pdf is not None:
+                results[test_request.pk] = pdf
+        uncached = [test_request.pk for test_request in tvfs if test_request.pk not in results]
+        jobs = enqueue_pdf_jobs(uncached, self.user) if uncached else {}
+        return ExportBatch(tvfs, results, {job_id: tvf_id for tvf_id, job_id in jobs.items()}, self.wait_seconds)
+
+    def write(self, batch):
+        """
+        Adds the batch's PDFs (or error entries) to the archive and returns the bytes written.
+        """
+        for test_request in batch.tvfs:
+            result = batch.results[test_request.pk]
+            if isinstance(result, bytes):
+                self.archive.writestr(pdf_filename(test_request), result)
+            else: # One broken TVF should not abort the whole export
+                self.archive.writestr(f"TVF_{test_request.tvf_number}_ERROR.txt", f"TVF {test_request.tvf_number} {result}")
+        return self.stream.pop()
+
+    def close(self):
+        # Closing the archive writes the central directory
+        self.archive.close()
+        return self.stream.pop()
+
+
+def stream_pdf_zip(tvf_ids, user, batch_size=EXPORT_BATCH_SIZE, poll_interval=EXPORT_POLL_INTERVAL):
+    """
+    Generator of ZIP archive chunks holding one PDF per TVF id, for a StreamingHttpResponse under WSGI.
+    Each batch is written out as soon as its PDFs are in, before the next one is looked up.
+    """
+    export = PDFExport(tvf_ids, user, batch_size)
+    for batch_ids in export.batches():
+        batch = export.start_batch(batch_ids)
+        while not batch.done:
+            time.sleep(poll_interval)
+            batch.poll()
+        yield export.write(batch)
+    yield export.close()
+
+
+async def astream_pdf_zip(tvf_ids, user, batch_size=EXPORT_BATCH_SIZE, poll_interval=EXPORT_POLL_INTERVAL):
+    """
+    stream_pdf_zip() for ASGI, where a StreamingHttpResponse consumes a sync iterator in full before
+    sending anything. Database work runs through sync_to_async and no thread is held while waiting.
+    """
+    export = PDFExport(tvf_ids, user, batch_size)
+    for batch_ids in export.batches():
+        batch = await sync_to_async(export.start_batch)(batch_ids)
+        while not batch.done:
+            await asyncio.sleep(poll_interval)
+            await sync_to_async(batch.poll)()
+        yield export.write(batch)
+    yield export.close()
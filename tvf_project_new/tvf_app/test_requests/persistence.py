@@ -0,0 +1,138 @@
+# tvf_app/test_requests/persistence.py
+from . import audit
+from .models import TestRequestInputFile, TestRequestPAN, TestRequestPlasticCode
+from .pdf_cache import invalidate_tvf_pdfs
+
+
+def _has_data(form):
+    """
+    True if a formset row needs saving: it changed, or it is a new row with something filled in.
+    """
+    return form.has_changed() or (not form.instance.pk and any(form.cleaned_data.values()))
+
+
+class ChildChanges:
+    """
+    Pending inserts, updates and deletes for one child model of the TVF aggregate.
+    """
+    def __init__(self, model, update_fields):
+        self.model = model
+        self.update_fields = update_fields
+        self.inserts = []
+        self.updates = []
+        self.delete_pks = []
+        self.forms = [] # (form, created) pairs, audited once the rows are written
+
+    def save(self, instance, form):
+        created = not instance.pk
+        (self.inserts if created else self.updates).append(instance)
+        self.forms.append((form, created))
+
+    def delete(self, instance):
+        if instance.pk:
+            self.delete_pks.append(instance.pk)
+
+    def audit_entries(self):
+        # Deletes go through the ORM's collector, whose post_delete signals audit them (cascades included)
+        return [entry for form, created in self.forms for entry in audit.form_changes(form, created)]
+
+    def apply_deletes(self):
+        if self.delete_pks:
+            # One DELETE ... IN (plus one per cascaded child table)
+            self.model.objects.filter(pk__in=self.delete_pks).delete()
+
+    def apply_writes(self):
+        if self.updates:
+            self.model.objects.bulk_update(self.updates, self.update_fields)
+        if self.inserts:
+            self.model.objects.bulk_create(self.inserts)
+
+
+class TVFAggregateWriter:
+    """
+    Saves a TVF's plastic code, input file and PAN formsets as one unit. Changes are collected
+    per child model and applied with one DELETE, one bulk_update and one bulk_create each, so
+    the number of statements does not grow with the number of rows. Call save() inside the
+    view's transaction, after the TestRequest itself has been saved.
+    """
+    def __init__(self, test_request):
+        self.test_request = test_request
+        self.plastic_codes = ChildChanges(
+            TestRequestPlasticCode, ['plastic_code_lookup', 'manual_plastic_code', 'quantity', 'thermal_colour'],
+        )
+        self.input_files = ChildChanges(
+            TestRequestInputFile,
+            ['file_name', 'date_file_received', 'card_co', 'card_wo', 'card_qty', 'pin_co', 'pin_wo', 'pin_qty'],
+        )
+        self.pans = ChildChanges(TestRequestPAN, ['pan_truncated', 'is_available'])
+
+    def add_plastic_code_formset(self, formset):
+        for form in formset.forms:
+            if form.cleaned_data.get('DELETE'):
+                self.plastic_codes.delete(form.instance)
+            elif _has_data(form):
+                plastic_code = form.save(commit=False)
+                plastic_code.test_request = self.test_request
+                # A row holds either a lookup code or a manual one (enforced by the form)
+                if plastic_code.plastic_code_lookup_id:
+                    plastic_code.manual_plastic_code = None
+                else:
+                    plastic_code.plastic_code_lookup = None
+                self.plastic_codes.save(plastic_code, form)
+
+    def add_input_file_formset(self, formset, pan_formsets):
+        """
+        `pan_formsets[i]` holds the PANs of `formset.forms[i]`. PANs of deleted input files
+        are left to the cascade.
+        """
+        for i, form in enumerate(formset.forms):
+            if form.cleaned_data.get('DELETE'):
+                self.input_files.delete(form.instance)
+                continue
+            input_file = form.instance
+            if _has_data(form):
+                input_file = form.save(commit=False)
+                input_file.test_request = self.test_request
+                self.input_files.save(input_file, form)
+            if i < len(pan_formsets) and (input_file.pk or _has_data(form)):
+                self._add_pan_formset(pan_formsets[i], input_file)
+
+    def _add_pan_formset(self, formset, input_file):
+        for form in formset.forms:
+            if form.cleaned_data.get('DELETE'):
+                self.pans.delete(form.instance)
+            elif _has_data(form):
+                pan = form.save(commit=False)
+                pan.test_request_input_file = input_file # Its pk is filled in once the file is inserted
+                self.pans.save(pan, form)
+
+    def save(self):
+        # Deletes first, so a row removed and re-added in the same submission does not hit a unique constraint
+        self.pans.apply_deletes()
+        self.input_files.apply_deletes()
+        self.plastic_codes.apply_deletes()
+
+        self.input_files.apply_writes()
+        self._resolve_input_file_pks()
+        self.pans.apply_writes()
+        self.plastic_codes.apply_writes()
+        # Bulk writes send no post_save, so the TVF's cached PDF is invalidated here
+        invalidate_tvf_pdfs(self.test_request.pk)
+
+        # Queued for the audit writer once the view's transaction commits
+        audit.record([
+            entry for changes in (self.input_files, self.pans, self.plastic_codes) for entry in changes.audit_entries()
+        ])
+
+    def _resolve_input_file_pks(self):
+        new_files = [input_file for input_file in self.input_files.inserts if input_file.pk is None]
+        if not new_files:
+            return
+        # MySQL does not return the ids of bulk-inserted rows; look them up by the (TVF, file name) key
+        pks = dict(TestRequestInputFile.objects.filter(
+            test_request=self.test_request, file_name__in=[input_file.file_name for input_file in new_files],
+        ).values_list('file_name', 'pk'))
+        for input_file in new_files:
+            input_file.pk = pks[input_file.file_name]
+        for pan in self.pans.inserts:
+            pan.test_request_input_file_id = pan.test_request_input_file.pk
@@ -0,0 +1,95 @@
+# tvf_app/test_requests/phase_logs.py
+import re
+
+from django.db.models.signals import post_save
+from django.dispatch import receiver
+
+from .models import TestRequest, TestRequestPhaseLog
+
+# Labels perform_transition appends to a TVF's comments ("\n\nREJECTED by alice: text (To PHASE)")
+COMMENT_EVENT = re.compile(
+    r'\n\n(?P<label>COMPLETED|CANCELLED|REJECTED) by (?P<username>\S+): (?P<text>.*?)(?: \(To (?P<phase>\w+)\))?'
+    r'(?=\n\n(?:COMPLETED|CANCELLED|REJECTED) by |\Z)',
+    re.DOTALL,
+)
+LABEL_PHASES = {'COMPLETED': 'TVF_COMPLETED', 'CANCELLED': 'TVF_CANCELLED'}
+
+# Phase a submitted TVF starts in, and the one a draft stays in until it is submitted
+INITIAL_PHASE = 'TVF_RELEASED'
+DRAFT_PHASE = 'PM_DRAFT'
+
+
+def record_phase_changes(tvf_ids, phase_id, user, comments, now):
+    """
+    Closes the open phase log of each TVF and opens one for the phase it just entered:
+    one UPDATE and one INSERT however many TVFs moved. Run it in the transaction that moved them.
+    """
+    if not tvf_ids:
+        return
+    TestRequestPhaseLog.objects.filter(test_request_id__in=tvf_ids, end_time__isnull=True).update(end_time=now)
+    TestRequestPhaseLog.objects.bulk_create([
+        TestRequestPhaseLog(
+            test_request_id=tvf_id, phase_name_id=phase_id, start_time=now,
+            responsible_user=user if user and user.is_authenticated else None, comments=comments or None,
+        )
+        for tvf_id in tvf_ids
+    ])
+
+
+@receiver(post_save, sender=TestRequest)
+def open_initial_phase_log(sender, instance, created, raw=False, **kwargs):
+    """
+    Opens the first phase log of a new TVF; later phases are logged by the workflow transitions.
+    """
+    if created and not raw and instance.current_phase_id:
+        TestRequestPhaseLog.objects.create(
+            test_request=instance, phase_name_id=instance.current_phase_id,
+            start_time=instance.last_status_update, responsible_user_id=instance.tvf_initiator_id,
+        )
+
+
+def parse_comment_events(comments):
+    """
+    Yields (label, username, text, target phase or None) for each transition recorded in a TVF's comments.
+    """
+    for match in COMMENT_EVENT.finditer(comments or ''):
+        yield match['label'], match['username'], match['text'].strip(), match['phase']
+
+
+def reconstruct_phase_history(tvf, phase_ids, user_ids):
+    """
+    Best-effort phase history for a TVF recorded before phase logs existed, as unsaved
+    TestRequestPhaseLog rows. Comments say what happened but not when, so only events with a
+    matching date are placed: the TVF's release (request_received_date), its latest rejection
+    (rejected_date), its completion or cancellation (tvf_completed_date) and entry into its
+    current phase (last_status_update). Returns (logs, number of events that could not be dated).
+    """
+    initial_phase = DRAFT_PHASE if tvf.current_phase_id and tvf.current_phase_id == phase_ids.get(DRAFT_PHASE) else INITIAL_PHASE
+    events = [(tvf.request_received_date, phase_ids.get(initial_phase), tvf.tvf_initiator_id, None)]
+    rejections = []
+    undated = 0
+    for label, username, text, target_phase in parse_comment_events(tvf.comments):
+        if label == 'REJECTED':
+            rejections.append((phase_ids.get(target_phase), user_ids.get(username), text))
+        elif tvf.tvf_completed_date:
+            events.append((tvf.tvf_completed_date, phase_ids.get(LABEL_PHASES[label]), user_ids.get(username), text))
+        else:
+            undated += 1
+    if rejections and tvf.rejected_date:
+        events.append((tvf.rejected_date, *rejections.pop()))
+    undated += len(rejections)
+    if tvf.current_phase_id and tvf.last_status_update:
+        events.append((tvf.last_status_update, tvf.current_phase_id, None, None))
+
+    logs = []
+    for start_time, phase_id, user_id, text in sorted((e for e in events if e[0] and e[1]), key=lambda e: e[0]):
+        if logs and logs[-1].phase_name_id == phase_id:
+            continue # Still in the same phase
+        if logs:
+            logs[-1].end_time = start_time
+        logs.append(TestRequestPhaseLog(
+            test_request_id=tvf.pk, phase_name_id=phase_id, start_time=start_time,
+            responsible_user_id=user_id, comments=text or None,
+        ))
+    # A final phase stays open, as it does for TVFs moved by perform_transition
+    return logs, undated
@@ -0,0 +1,118 @@
+# tvf_app/test_requests/queue_counters.py
+from collections import defaultdict
+
+from django.db import transaction
+from django.db.models import Count, F
+from django.db.models.signals import post_delete, post_save, pre_save
+
+from . import dashboard, live
+from .models import QueueCounter, TestRequest, TVFQueue
+
+
+def _seed_customer(customer_id):
+    """
+    Creates the customer's counter for every queue at once, so later moves only ever UPDATE.
+    """
+    QueueCounter.objects.bulk_create(
+        [QueueCounter(queue=queue, customer_id=customer_id, count=0) for queue in TVFQueue if queue != TVFQueue.NONE],
+        ignore_conflicts=True, # Seeded by a concurrent transaction
+    )
+
+
+def adjust_counters(moves):
+    """
+    Applies `moves`, pairs of ((old queue, old customer id), (new queue, new customer id)), to the
+    counters: one UPDATE per counter whose count changes, in a fixed order so concurrent
+    transitions lock the counter rows in the same order. Run it in the transaction that moved the TVFs.
+    """
+    deltas = defaultdict(int)
+    for old, new in moves:
+        if old == new:
+            continue
+        deltas[old] -= 1
+        deltas[new] += 1
+    counted = sorted(
+        (key, delta) for key, delta in deltas.items()
+        if delta and key[0] != TVFQueue.NONE and key[1] is not None
+    )
+    for (queue, customer_id), delta in counted:
+        counter = QueueCounter.objects.filter(queue=queue, customer_id=customer_id)
+        if not counter.update(count=F('count') + delta):
+            _seed_customer(customer_id)
+            counter.update(count=F('count') + delta)
+
+
+def record_transition(rows, new_queue):
+    """
+    Moves the counts of the TVFs a transition just updated. `rows` hold each TVF's pk, customer_id
+    and queue before the UPDATE; `new_queue` is the queue it wrote, read back when it was an expression.
+    Returns the (tvf id, old queue, new queue) moves.
+    """
+    if hasattr(new_queue, 'resolve_expression'):
+        new_queues = dict(TestRequest.objects.filter(pk__in=[row['pk'] for row in rows]).values_list('pk', 'queue'))
+    else:
+        new_queues = {row['pk']: new_queue for row in rows}
+    adjust_counters(
+        ((row['queue'], row['customer_id']), (new_queues[row['pk']], row['customer_id'])) for row in rows
+    )
+    return [(row['pk'], row['queue'], new_queues[row['pk']]) for row in rows]
+
+
+def reconcile_counters(dry_run=False):
+    """
+    Recounts the TVFs in every queue and corrects the counters that drifted, holding the counter
+    row locks meanwhile so transitions committing during the recount are not lost.
+    Returns [(queue, customer id, stored count, actual count)] for each corrected counter.
+    """
+    with transaction.atomic():
+        stored = {
+            (queue, customer_id): count
+            for queue, customer_id, count in QueueCounter.objects.select_for_update().values_list('queue', 'customer_id', 'count')
+        }
+        actual = {
+            (queue, customer_id): count
+            for queue, customer_id, count in TestRequest.objects.exclude(queue=TVFQueue.NONE)
+            .values_list('queue', 'customer_id').annotate(count=Count('pk')).order_by()
+        }
+        drift = sorted(
+            (queue, customer_id, stored.get((queue, customer_id), 0), actual.get((queue, customer_id), 0))
+            for queue, customer_id in stored.keys() | actual.keys()
+            if stored.get((queue, customer_id), 0) != actual.get((queue, customer_id), 0)
+        )
+        if not dry_run:
+            for queue, customer_id, _, count in drift:
+                QueueCounter.objects.update_or_create(queue=queue, customer_id=customer_id, defaults={'count': count})
+    return drift
+
+
+# --- Signal receivers (TVFs created, edited or deleted through the ORM; transitions call record_transition) ---
+# Each move also invalidates the cached dashboard fragments of its buckets and is published to the
+# live dashboards (see live.py).
+
+def _remember_queue(sender, instance, raw=False, **kwargs):
+    if raw or instance._state.adding or instance.pk is None:
+        instance._counted_queue = None
+        return
+    instance._counted_queue = sender._base_manager.filter(pk=instance.pk).values_list('queue', 'customer_id').first()
+
+
+def _count_save(sender, instance, created, raw=False, **kwargs):
+    if raw:
+        return
+    old = getattr(instance, '_counted_queue', None) or (TVFQueue.NONE, None)
+    adjust_counters([(tuple(old), (instance.queue, instance.customer_id))])
+    moves = [(instance.pk, old[0], instance.queue)]
+    dashboard.invalidate_buckets(moves)
+    live.publish_queue_moves(moves)
+
+
+def _count_delete(sender, instance, **kwargs):
+    adjust_counters([((instance.queue, instance.customer_id), (TVFQueue.NONE, None))])
+    moves = [(instance.pk, instance.queue, TVFQueue.NONE)]
+    dashboard.invalidate_buckets(moves)
+    live.publish_queue_moves(moves)
+
+
+pre_save.connect(_remember_queue, sender=TestRequest, dispatch_uid='queue_counters_pre_save')
+post_save.connect(_count_save, sender=TestRequest, dispatch_uid='queue_counters_post_save')
+post_delete.connect(_count_delete, sender=TestRequest, dispatch_uid='queue_counters_post_delete')
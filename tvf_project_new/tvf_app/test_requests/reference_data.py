@@ -0,0 +1,117 @@
+# tvf_app/test_requests/reference_data.py
+from datetime import timedelta
+
+from django.core.cache import cache
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+from django.utils import timezone
+from django.views.decorators.cache import cache_control
+from django.views.decorators.http import condition
+
+from .models import Customer, DispatchMethod, Holiday, PlasticCodeLookup, Project, TrustportFolder, TVFEnvironment
+from .versioning import bump_version, get_version, version_timestamp
+
+REFERENCE_DATA_VERSION = 'reference_data'
+
+# Browsers may reuse a reference-data response this long before revalidating it with its ETag
+REFERENCE_DATA_MAX_AGE = 300
+
+# Holidays sent to the create form for its client-side ship date calculation
+FORM_BOOTSTRAP_HOLIDAY_SPAN = timedelta(days=2 * 365)
+
+# How long a built form bootstrap document is kept; a version bump makes it unreachable sooner
+FORM_BOOTSTRAP_CACHE_TIMEOUT = 24 * 60 * 60
+
+
+def reference_data_etag(request, *args, **kwargs):
+    return get_version(REFERENCE_DATA_VERSION)
+
+
+def reference_data_last_modified(request, *args, **kwargs):
+    return version_timestamp(get_version(REFERENCE_DATA_VERSION))
+
+
+def reference_data_endpoint(view_func):
+    """
+    Makes a view over reference data HTTP-cacheable: responses carry an ETag and
+    Last-Modified derived from the reference-data version, and conditional requests
+    are answered with 304 Not Modified before the view touches the database.
+    """
+    view_func = condition(etag_func=reference_data_etag, last_modified_func=reference_data_last_modified)(view_func)
+    return cache_control(private=True, max_age=REFERENCE_DATA_MAX_AGE)(view_func)
+
+
+def build_form_bootstrap():
+    """
+    Returns every dropdown the TVF create form filters, as one nested document:
+    customer -> environment -> project -> plastic codes, Trustport folders and dispatch methods.
+    Options are compact [id, label] pairs. Dispatch methods not tied to a customer and project
+    are listed once under 'global_dispatch_methods'. 'holidays' lists the ISO dates the SLA
+    ship date calculation skips around today.
+    """
+    def pairs_by(queryset, key_fields, label_field):
+        grouped = {}
+        for row in queryset.values_list(*key_fields, 'id', label_field):
+            grouped.setdefault(row[:-2], []).append(list(row[-2:]))
+        return grouped
+
+    plastic_codes = pairs_by(
+        PlasticCodeLookup.objects.order_by('code'), ('customer_id', 'project_id', 'tvf_environment_id'), 'code'
+    )
+    folders = pairs_by(TrustportFolder.objects.order_by('folder_path'), ('customer_id', 'project_id'), 'folder_path')
+    dispatch_methods = pairs_by(DispatchMethod.objects.order_by('name'), ('customer_id', 'project_id'), 'name')
+    environment_names = dict(TVFEnvironment.objects.values_list('id', 'name'))
+
+    customers = {
+        customer_id: {'id': customer_id, 'name': name, 'sla_days': sla_days, 'environments': {}}
+        for customer_id, name, sla_days in Customer.objects.order_by('name').values_list('id', 'name', 'sla_days')
+    }
+    projects = Project.objects.order_by('name').values_list('id', 'name', 'customer_id', 'tvf_environment_id')
+    for project_id, name, customer_id, environment_id in projects:
+        environments = customers[customer_id]['environments']
+        environment = environments.setdefault(environment_id, {
+            'id': environment_id, 'name': environment_names[environment_id], 'projects': [],
+        })
+        environment['projects'].append({
+            'id': project_id,
+            'name': name,
+            'plastic_codes': plastic_codes.get((customer_id, project_id, environment_id), []),
+            'folders': folders.get((customer_id, project_id), []),
+            'dispatch_methods': dispatch_methods.get((customer_id, project_id), []),
+        })
+
+    for customer in customers.values():
+        customer['environments'] = sorted(customer['environments'].values(), key=lambda e: e['name'])
+    today = timezone.localdate()
+    return {
+        'version': get_version(REFERENCE_DATA_VERSION),
+        'customers': list(customers.values()),
+        'global_dispatch_methods': dispatch_methods.get((None, None), []),
+        'holidays': [day.isoformat() for day in Holiday.objects.filter(
+            date__range=(today - FORM_BOOTSTRAP_HOLIDAY_SPAN, today + FORM_BOOTSTRAP_HOLIDAY_SPAN)
+        ).values_list('date', flat=True)],
+    }
+
+
+def get_form_bootstrap():
+    """
+    The form bootstrap document, built once per reference-data version and shared across requests.
+    """
+    version = get_version(REFERENCE_DATA_VERSION)
+    return cache.get_or_set(f'tvf:form_bootstrap:{version}', build_form_bootstrap, FORM_BOOTSTRAP_CACHE_TIMEOUT)
+
+
+@receiver(post_save, sender=Customer)
+@receiver(post_delete, sender=Customer)
+@receiver(post_save, sender=TVFEnvironment)
+@receiver(post_delete, sender=TVFEnvironment)
+@receiver(post_save, sender=Project)
+@receiver(post_delete, sender=Project)
+@receiver(post_save, sender=PlasticCodeLookup)
+@receiver(post_delete, sender=PlasticCodeLookup)
+@receiver(post_save, sender=TrustportFolder)
+@receiver(post_delete, sender=TrustportFolder)
+@receiver(post_save, sender=DispatchMethod)
+@receiver(post_delete, sender=DispatchMethod)
+def invalidate_reference_data(sender, **kwargs):
+    bump_version(REFERENCE_DATA_VERSION)
@@ -0,0 +1,108 @@
+# tvf_app/test_requests/roles.py
+from functools import wraps
+
+from django.contrib.auth.models import Group, User
+from django.contrib.auth.views import redirect_to_login
+from django.db.models.signals import m2m_changed, post_delete, post_save
+from django.dispatch import receiver
+
+from .versioning import bump_version, get_versions
+
+# Group names used as roles throughout the workflow
+ROLE_PROJECT_MANAGER = 'Project Managers'
+ROLE_NPI = 'NPI Users'
+ROLE_QUALITY = 'Quality Users'
+ROLE_LOGISTICS = 'Logistics Users'
+ROLE_COACH = 'Coaches'
+
+DASHBOARD_ROLES = frozenset({
+    ROLE_PROJECT_MANAGER, ROLE_NPI, ROLE_QUALITY, ROLE_LOGISTICS, ROLE_COACH,
+})
+
+SESSION_ROLES_KEY = '_tvf_roles'
+SESSION_ROLES_STAMP_KEY = '_tvf_roles_stamp'
+
+GLOBAL_ROLES_VERSION = 'roles'
+
+
+def _user_roles_version(user_id):
+    return f'roles:user:{user_id}'
+
+
+def _roles_stamp(user_id):
+    return ':'.join(get_versions(GLOBAL_ROLES_VERSION, _user_roles_version(user_id)))
+
+
+def get_user_roles(user, session=None):
+    """
+    Returns the user's group names as an immutable set.
+    Groups are loaded at most once per request and reused from the session
+    until the user's group membership (or any group) changes.
+    """
+    if not user.is_authenticated:
+        return frozenset()
+
+    roles = getattr(user, '_tvf_roles', None)
+    if roles is not None:
+        return roles
+
+    stamp = _roles_stamp(user.pk)
+    if session is not None and session.get(SESSION_ROLES_STAMP_KEY) == stamp:
+        roles = frozenset(session.get(SESSION_ROLES_KEY, ()))
+    else:
+        roles = frozenset(user.groups.values_list('name', flat=True))
+        if session is not None:
+            session[SESSION_ROLES_KEY] = sorted(roles)
+            session[SESSION_ROLES_STAMP_KEY] = stamp
+
+    user._tvf_roles = roles
+    return roles
+
+
+def has_role(request, *roles, allow_superuser=False):
+    """
+    True if the requesting user holds any of the given roles.
+    """
+    if allow_superuser and request.user.is_superuser:
+        return True
+    return not request.roles.isdisjoint(roles)
+
+
+def can_view_dashboard(request):
+    return has_role(request, *DASHBOARD_ROLES, allow_superuser=True)
+
+
+def role_required(*roles, allow_superuser=False, login_url='test_requests:access_denied'):
+    """
+    View decorator that checks `request.roles` instead of querying the user's groups.
+    Behaves like `user_passes_test`, redirecting to `login_url` on failure.
+    """
+    def decorator(view_func):
+        @wraps(view_func)
+        def _wrapped_view(request, *args, **kwargs):
+            if has_role(request, *roles, allow_superuser=allow_superuser):
+                return view_func(request, *args, **kwargs)
+            return redirect_to_login(request.get_full_path(), login_url)
+        return _wrapped_view
+    return decorator
+
+
+# --- Invalidation of cached role sets ---
+
+@receiver(m2m_changed, sender=User.groups.through)
+def invalidate_roles_on_membership_change(sender, instance, action, reverse, pk_set, **kwargs):
+    if action not in ('post_add', 'post_remove', 'post_clear'):
+        return
+    if not reverse:
+        bump_version(_user_roles_version(instance.pk))
+    elif pk_set:
+        bump_version(*(_user_roles_version(user_id) for user_id in pk_set))
+    else:
+        # group.user_set.clear() does not report which users were affected
+        bump_version(GLOBAL_ROLES_VERSION)
+
+
+@receiver(post_save, sender=Group)
+@receiver(post_delete, sender=Group)
+def invalidate_roles_on_group_change(sender, instance, **kwargs):
+    bump_version(GLOBAL_ROLES_VERSION)
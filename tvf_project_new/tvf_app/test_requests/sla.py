@@ -0,0 +1,173 @@
+# tvf_app/test_requests/sla.py
+import threading
+from array import array
+from datetime import datetime, timedelta
+
+from django.db.models import BooleanField, Case, DateTimeField, DurationField, ExpressionWrapper, F, Value, When
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+from django.utils import timezone
+
+from .models import Holiday, TestRequest
+from .reference_data import REFERENCE_DATA_VERSION
+from .versioning import bump_version, get_version
+
+HOLIDAYS_VERSION = 'sla:holidays'
+
+# Monday = 0 ... Sunday = 6
+WEEKEND_DAYS = frozenset({5, 6})
+
+# Span of the precomputed calendar around today; it grows on demand for dates outside it
+CALENDAR_SPAN_BACK = timedelta(days=3 * 365)
+CALENDAR_SPAN_AHEAD = timedelta(days=3 * 365)
+
+# TVFs due within this long are flagged as at risk on the dashboards
+SLA_AT_RISK_WINDOW = timedelta(days=1)
+
+
+class BusinessCalendar:
+    """
+    Business days (weekdays that are not holidays) between `start` and `end`, precomputed
+    into lookup tables so that adding business days and counting them are O(1):
+      _before[i] = number of business days strictly before calendar day start + i
+      _days[k]   = the k-th business day of the span
+    """
+    def __init__(self, holidays, start, end):
+        self.start = start
+        self.end = end
+        self._before = array('l')
+        self._days = []
+        for offset in range((end - start).days + 1):
+            day = start + timedelta(days=offset)
+            self._before.append(len(self._days))
+            if day.weekday() not in WEEKEND_DAYS and day not in holidays:
+                self._days.append(day)
+        self._before.append(len(self._days))
+
+    def covers(self, day):
+        return self.start <= day <= self.end
+
+    def _offset(self, day):
+        if not self.covers(day):
+            raise IndexError(f"{day} is outside the calendar ({self.start} to {self.end}).")
+        return (day - self.start).days
+
+    def is_business_day(self, day):
+        offset = self._offset(day)
+        return self._before[offset + 1] > self._before[offset]
+
+    def add_business_days(self, day, count):
+        """
+        Returns the `count`-th business day after `day`; a non-business `day` counts from the next business day.
+        """
+        if count <= 0:
+            return day
+        offset = self._offset(day)
+        index = self._before[offset] + count - (0 if self.is_business_day(day) else 1)
+        if index >= len(self._days):
+            raise IndexError(f"{count} business days after {day} is past the end of the calendar.")
+        return self._days[index]
+
+    def business_days_between(self, first, last):
+        """
+        Number of business days in [first, last).
+        """
+        return self._before[self._offset(last)] - self._before[self._offset(first)]
+
+
+class _CalendarCache:
+    """
+    Process-local BusinessCalendar, rebuilt when holidays change or a date falls outside it.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._version = None
+        self._calendar = None
+
+    def get(self, *days):
+        version = get_version(HOLIDAYS_VERSION)
+        calendar = self._calendar
+        if calendar is not None and self._version == version and all(calendar.covers(day) for day in days):
+            return calendar
+        with self._lock:
+            today = timezone.localdate()
+            start = min([today - CALENDAR_SPAN_BACK, *days])
+            end = max([today + CALENDAR_SPAN_AHEAD, *days])
+            if self._calendar is not None and self._version == version:
+                # Keep the span already built so repeated outliers do not shrink it back
+                start, end = min(start, self._calendar.start), max(end, self._calendar.end)
+            holidays = set(Holiday.objects.filter(date__range=(start, end)).values_list('date', flat=True))
+            self._calendar = BusinessCalendar(holidays, start, end)
+            self._version = version
+            return self._calendar
+
+
+_calendars = _CalendarCache()
+
+
+def get_calendar(*days):
+    """
+    Returns the business calendar, making sure it covers the given dates.
+    """
+    return _calendars.get(*days)
+
+
+def add_business_days(day, count):
+    calendar = get_calendar(day)
+    try:
+        return calendar.add_business_days(day, count)
+    except IndexError:
+        # Far enough ahead that the calendar has to grow; weekends at most double the span
+        return get_calendar(day, day + timedelta(days=count * 2 + 31)).add_business_days(day, count)
+
+
+def sla_due_date(received, sla_days):
+    """
+    SLA due date for a TVF received at `received`: `sla_days` business days later, at the same
+    local wall-clock time. Accepts aware or naive datetimes and returns the same kind.
+    """
+    aware = timezone.is_aware(received)
+    local = timezone.localtime(received) if aware else received
+    due_day = add_business_days(local.date(), sla_days)
+    due = datetime.combine(due_day, local.time())
+    return timezone.make_aware(due) if aware else due
+
+
+def open_tvfs():
+    """
+    TestRequests still inside the workflow (not shipped, completed or cancelled).
+    """
+    from .workflow import FINAL_STATUSES, registry # Imported here to avoid a circular import
+    return TestRequest.objects.exclude(status_id__in=registry.existing_status_ids(FINAL_STATUSES))
+
+
+def annotate_sla(queryset, now=None):
+    """
+    Annotates TestRequests with their SLA state in the database, in the same query:
+      sla_due:       the due date (request_ship_date, filled from the SLA when a TVF is saved)
+      sla_remaining: time left until the due date (negative once breached)
+      sla_breached:  True once the due date has passed
+      sla_at_risk:   True when due within SLA_AT_RISK_WINDOW
+    Order by 'sla_due' to list the TVFs closest to breaching first.
+    """
+    now = now or timezone.now()
+    return queryset.annotate(
+        sla_due=F('request_ship_date'),
+        sla_remaining=ExpressionWrapper(
+            F('request_ship_date') - Value(now, output_field=DateTimeField()), output_field=DurationField()
+        ),
+        sla_breached=Case(
+            When(request_ship_date__lt=now, then=Value(True)), default=Value(False), output_field=BooleanField()
+        ),
+        sla_at_risk=Case(
+            When(request_ship_date__gte=now, request_ship_date__lt=now + SLA_AT_RISK_WINDOW, then=Value(True)),
+            default=Value(False), output_field=BooleanField(),
+        ),
+    )
+
+
+@receiver(post_save, sender=Holiday)
+@receiver(post_delete, sender=Holiday)
+def invalidate_business_calendar(sender, **kwargs):
+    # The create form's bootstrap document carries the holidays too
+    bump_version(HOLIDAYS_VERSION, REFERENCE_DATA_VERSION)
@@ -1,16 +1,29 @@
 # tvf_app/test_requests/templatetags/custom_filters.py
 from django import template
 
+from test_requests import grouping
+
 register = template.Library()
 
 @register.filter
 def get_item(dictionary, key):
     return dictionary.get(key) if hasattr(dictionary, 'get') else dictionary[key]
 
+@register.simple_tag
+def group_tvfs(tvfs, by):
+    """
+    Groups an already fetched list of TVFs by 'phase', 'status' or 'queue' without querying
+    (see grouping.group_tvfs); views can pass the groups in precomputed instead.
+    Usage: {% group_tvfs open_tvfs 'phase' as phases %}{% for phase in phases %}{{ phase.label }}: {{ phase.tvfs|length }}{% endfor %}
+    """
+    return grouping.group_tvfs(tvfs, by)
+
 @register.filter
-def filter_by_current_phase(queryset, phase_name):
+def minutes_as_hours(minutes):
     """
-    Filters a queryset of TestRequest objects by their current_phase.name.
-    Usage: {{ open_tvfs|filter_by_current_phase:'NPI Data Processing' }}
+    Formats a number of minutes as hours with one decimal, e.g. 90 -> '1.5 h'.
+    Usage: {{ row.p50|minutes_as_hours }}
     """
-    return queryset.filter(current_phase__name=phase_name)
\ No newline at end of file
+    if minutes is None:
+        return ''
+    return f"{minutes / 60:.1f} h"
@@ -1,3 +1,1890 @@
-from django.test import TestCase
+from django.test import TestCase, TransactionTestCase, skipUnlessDBFeature
 
 # Create your tests here.
+from django.contrib.auth.models import Group, User
+from django.conf import settings
+from django.core.cache import cache
+import os
+import shutil
+import tempfile
+from pathlib import Path
+import zipfile
+import io
+import gzip
+import json
+import threading
+import time
+from unittest import mock
+
+from datetime import date, datetime
+
+import numpy as np
+
+from asgiref.sync import async_to_sync, sync_to_async
+
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.management import CommandError, call_command
+from django.db import connection, connections, transaction
+from django.template import Context, Template
+from django.test import RequestFactory, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from django.utils import timezone
+
+from .models import (
+    Customer, DispatchMethod, Holiday, PlasticCodeLookup, Project, TrustportFolder, TVFEnvironment, TVFType, TVFStatus, TestRequest,
+    TestRequestPhaseDefinition, PDFRenderJob, TVF_NUMBER_START, TestRequestInputFile, TestRequestPAN, TestRequestPlasticCode,
+    TestRequestPhaseLog, AuditLog, QUEUE_STATES, TVFQueue, QueueCounter,
+)
+from . import audit, fragments, live
+from .audit_archive import ArchivePartition, audit_history, search_archive
+from .dashboard import bucket_version_name
+from .analytics import compute_cycle_time_analytics, grouped_statistics
+from .grouping import group_tvfs
+from .imports import PANImportError, import_input_file_manifest, import_pans, mask_pan
+from .pdf import PDFRenderError, claim_next_job, pdf_versions, purge_finished_jobs, run_job, work
+from .pdf_export import astream_pdf_zip
+from .pdf_cache import PDFCache, pdf_cache
+from .listing import paginate
+from .roles import ROLE_COACH, ROLE_NPI, ROLE_PROJECT_MANAGER, ROLE_QUALITY
+from .sla import BusinessCalendar, annotate_sla, sla_due_date
+from .versioning import check_shared_cache, get_version
+from .workflow import registry, perform_bulk_transition, perform_transition
+
+
+def _make_reference_data():
+    customer = Customer.objects.create(name='Bank', sla_days=5)
+    environment = TVFEnvironment.objects.create(name='PAT')
+    project = Project.objects.create(customer=customer, name='Debit', tvf_environment=environment)
+    tvf_type = TVFType.objects.create(name='EMV Keys')
+    return customer, environment, project, tvf_type
+
+
+def _make_tvf(initiator, customer, environment, project, tvf_type, status='TVF_SUBMITTED', phase='TVF_RELEASED', **kwargs):
+    status_obj, _ = TVFStatus.objects.get_or_create(name=status)
+    order = TestRequestPhaseDefinition.objects.count() + 100
+    phase_obj, _ = TestRequestPhaseDefinition.objects.get_or_create(name=phase, defaults={'order': order})
+    return TestRequest.objects.create(
+        customer=customer, project=project, tvf_environment=environment, tvf_type=tvf_type,
+        tvf_name=kwargs.pop('tvf_name', 'Test TVF'), tvf_initiator=initiator,
+        request_received_date=kwargs.pop('request_received_date', timezone.now()),
+        status=status_obj, current_phase=phase_obj, **kwargs
+    )
+
+
+def _group_queries(queries):
+    return [q for q in queries if 'auth_user_groups' in q['sql']]
+
+
+class RoleResolutionTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.npi_group = Group.objects.create(name=ROLE_NPI)
+        self.quality_group = Group.objects.create(name=ROLE_QUALITY)
+        self.user = User.objects.create_user('npi', password='pw')
+        self.user.groups.add(self.npi_group)
+        self.client.force_login(self.user)
+
+    def test_groups_loaded_once_per_session(self):
+        url = reverse('test_requests:coach_dashboard')
+        with CaptureQueriesContext(connection) as first:
+            response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(_group_queries(first.captured_queries)), 1)
+
+        with CaptureQueriesContext(connection) as second:
+            response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(_group_queries(second.captured_queries), [])
+        self.assertTrue(response.context['is_npi_user'])
+        self.assertFalse(response.context['is_quality_user'])
+
+    def test_membership_change_invalidates_session_roles(self):
+        url = reverse('test_requests:coach_dashboard')
+        self.client.get(url)
+        self.user.groups.add(self.quality_group)
+        response = self.client.get(url)
+        self.assertIn(ROLE_QUALITY, response.context['roles'])
+
+        self.npi_group.user_set.remove(self.user)
+        response = self.client.get(url)
+        self.assertNotIn(ROLE_NPI, response.context['roles'])
+
+    def test_role_required_redirects_without_role(self):
+        self.user.groups.clear()
+        response = self.client.get(reverse('test_requests:coach_dashboard'))
+        self.assertEqual(response.status_code, 302)
+        self.assertIn(reverse('test_requests:access_denied'), response['Location'])
+
+    def test_process_local_cache_is_flagged(self):
+        with override_settings(CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}}):
+            self.assertEqual([warning.id for warning in check_shared_cache(None)], ['test_requests.W001'])
+        with override_settings(CACHES={'default': {'BACKEND': 'django.core.cache.backends.redis.RedisCache', 'LOCATION': 'redis://cache:6379/1'}}):
+            self.assertEqual(check_shared_cache(None), [])
+
+
+class NPIWorkflowTestCase(TestCase):
+    """
+    A logged-in NPI user, the reference data, and `self.request` to hand to the workflow functions.
+    """
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create_user('npi', password='pw')
+        self.user.groups.add(Group.objects.create(name=ROLE_NPI))
+        self.client.force_login(self.user)
+        self.reference = _make_reference_data()
+        # Make sure the target status/phase exist so the registry never needs to create them
+        TVFStatus.objects.create(name='DP Done')
+        TestRequestPhaseDefinition.objects.create(name='TVF_DP_DONE', order=3)
+        # What RoleMiddleware would attach, without going through a view
+        self.request = RequestFactory().get(reverse('test_requests:coach_dashboard'))
+        self.request.user = self.user
+        self.request.roles = frozenset({ROLE_NPI})
+
+
+class WorkflowTransitionTests(NPIWorkflowTestCase):
+    def setUp(self):
+        super().setUp()
+        self.tvf = _make_tvf(self.user, *self.reference)
+
+    def test_transition_is_a_single_conditional_update(self):
+        url = reverse('test_requests:npi_update_tvf', args=[self.tvf.pk])
+        self.client.get(reverse('test_requests:coach_dashboard')) # Warm the session and registry
+        registry.status_id('DP Done')
+
+        with CaptureQueriesContext(connection) as ctx:
+            response = self.client.post(url, {'action': 'dp_done', 'comments': 'done'})
+        self.assertEqual(response.status_code, 302)
+
+        statements = [q['sql'] for q in ctx.captured_queries]
+        self.assertEqual(len([sql for sql in statements if sql.startswith('UPDATE "test_requests_testrequest"')]), 1)
+        self.assertFalse([sql for sql in statements if 'test_requests_tvfstatus' in sql and 'JOIN' not in sql])
+
+        self.tvf.refresh_from_db()
+        self.assertEqual(self.tvf.status.name, 'DP Done')
+        self.assertEqual(self.tvf.current_phase.name, 'TVF_DP_DONE')
+        self.assertEqual(self.tvf.comments, 'done')
+
+    def test_transition_from_wrong_phase_does_not_move(self):
+        self.assertTrue(perform_transition(self.request, self.tvf, 'dp_done'))
+        # A second click finds the TVF already out of its source phase
+        self.assertFalse(perform_transition(self.request, self.tvf, 'dp_done'))
+
+    def test_registry_reloads_when_lookup_tables_change(self):
+        status_id = registry.status_id('DP Done')
+        TVFStatus.objects.filter(pk=status_id).delete()
+        renamed = TVFStatus.objects.create(name='DP Done')
+        self.assertEqual(registry.status_id('DP Done'), renamed.pk)
+
+    def test_cancel_appends_comments_for_coach(self):
+        coach = User.objects.create_user('coach', password='pw')
+        coach.groups.add(Group.objects.create(name=ROLE_COACH))
+        self.client.force_login(coach)
+        response = self.client.post(reverse('test_requests:cancel_tvf', args=[self.tvf.pk]), {'comments': 'dup'})
+        self.assertEqual(response.status_code, 302)
+        self.tvf.refresh_from_db()
+        self.assertEqual(self.tvf.status.name, 'Cancelled')
+        self.assertIsNotNone(self.tvf.tvf_completed_date)
+        self.assertTrue(self.tvf.comments.endswith('CANCELLED by coach: dup'))
+
+
+class TVFNumberAllocatorTests(TransactionTestCase):
+    workers = 8
+    inserts_per_worker = 25
+
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create_user('pm', password='pw')
+        self.reference = _make_reference_data()
+        self.status = TVFStatus.objects.create(name='Draft')
+        self.phase = TestRequestPhaseDefinition.objects.create(name='PM_DRAFT', order=0)
+
+    def _insert(self):
+        return TestRequest.objects.create(
+            customer=self.reference[0], tvf_environment=self.reference[1], project=self.reference[2],
+            tvf_type=self.reference[3], tvf_name='Stress', tvf_initiator=self.user,
+            request_received_date=timezone.now(), status=self.status, current_phase=self.phase,
+        )
+
+    def test_first_number_keeps_starting_offset(self):
+        self.assertEqual(self._insert().tvf_number, TVF_NUMBER_START)
+
+    @skipUnlessDBFeature('has_select_for_update')
+    def test_concurrent_inserts_get_unique_numbers(self):
+        errors = []
+
+        def worker():
+            try:
+                for _ in range(self.inserts_per_worker):
+                    self._insert()
+            except Exception as e: # Surface errors from worker threads in the main thread
+                errors.append(e)
+            finally:
+                connections.close_all()
+
+        threads = [threading.Thread(target=worker) for _ in range(self.workers)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(errors, [])
+        total = self.workers * self.inserts_per_worker
+        numbers = list(TestRequest.objects.values_list('tvf_number', flat=True))
+        self.assertEqual(len(numbers), total)
+        self.assertEqual(len(set(numbers)), total)
+        self.assertEqual(sorted(numbers), list(range(TVF_NUMBER_START, TVF_NUMBER_START + total)))
+
+    def test_allocation_statements_do_not_grow_with_table(self):
+        # Allocation reads the counter row, never the TestRequest table, so it must not slow down as
+        # the table grows
+        self._insert()
+        with CaptureQueriesContext(connection) as early:
+            self._insert()
+        for _ in range(50):
+            self._insert()
+        with CaptureQueriesContext(connection) as late:
+            self._insert()
+        self.assertEqual(len(late.captured_queries), len(early.captured_queries))
+        self.assertFalse(any('MAX(' in query['sql'].upper() for query in late.captured_queries))
+
+
+class DashboardQueryBudgetTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create_user('npi', password='pw')
+        self.user.groups.add(Group.objects.create(name=ROLE_NPI))
+        self.client.force_login(self.user)
+        self.reference = _make_reference_data()
+        self.url = reverse('test_requests:coach_dashboard')
+
+    def _dashboard_queries(self):
+        with CaptureQueriesContext(connection) as ctx:
+            response = self.client.get(self.url)
+        self.assertEqual(response.status_code, 200)
+        return response, len(ctx.captured_queries)
+
+    def test_query_count_does_not_grow_with_open_tvfs(self):
+        _make_tvf(self.user, *self.reference)
+        self.client.get(self.url) # Warm the session and registry
+        response, few = self._dashboard_queries()
+        self.assertEqual(len(response.context['npi_released_tvfs']), 1)
+
+        for i in range(20):
+            _make_tvf(self.user, *self.reference, tvf_name=f'TVF {i}')
+        _make_tvf(self.user, *self.reference, status='DP Done', phase='TVF_DP_DONE')
+        self.client.get(self.url) # The new status/phase reloads the registry once
+        response, many = self._dashboard_queries()
+
+        self.assertEqual(few, many)
+        self.assertEqual(len(response.context['npi_released_tvfs']), 21)
+        self.assertEqual(len(response.context['npi_dp_done_tvfs']), 1)
+        self.assertEqual(response.context['npi_dp_done_tvfs'][0]['customer_name'], 'Bank')
+
+
+class KeysetPaginationTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create_user('pm', password='pw')
+        self.client.force_login(self.user)
+        self.reference = _make_reference_data()
+        received = timezone.now()
+        # Three TVFs share every received date, and every third one has no ship date
+        self.tvfs = [
+            _make_tvf(
+                self.user, *self.reference, tvf_name=f'TVF {i}',
+                request_received_date=received - timezone.timedelta(days=i // 3),
+                request_ship_date=None if i % 3 == 0 else received + timezone.timedelta(days=i % 4),
+            )
+            for i in range(20)
+        ]
+        # Saving fills missing ship dates from the SLA, so clear them afterwards
+        TestRequest.objects.filter(tvf_name__in=[f'TVF {i}' for i in range(0, 20, 3)]).update(request_ship_date=None)
+
+    def _walk(self, field, descending):
+        pages, page = [], paginate(TestRequest.objects.all(), field, descending, page_size=6)
+        pages.append([tvf.tvf_number for tvf in page])
+        while page.has_next:
+            page = paginate(TestRequest.objects.all(), field, descending, after=page.next_cursor, page_size=6)
+            pages.append([tvf.tvf_number for tvf in page])
+        return pages, page
+
+    def test_pages_cover_every_row_once_in_order(self):
+        for field in ('request_received_date', 'request_ship_date', 'tvf_number'):
+            for descending in (True, False):
+                pages, _ = self._walk(field, descending)
+                numbers = [number for page in pages for number in page]
+                expected = paginate(TestRequest.objects.all(), field, descending, page_size=100)
+                self.assertEqual(numbers, [tvf.tvf_number for tvf in expected], (field, descending))
+
+    def test_nullable_sort_lists_undated_rows_last_without_null_ordering(self):
+        tvfs = list(TestRequest.objects.all())
+        dated = sorted((tvf for tvf in tvfs if tvf.request_ship_date), key=lambda tvf: (tvf.request_ship_date, tvf.tvf_number), reverse=True)
+        undated = sorted((tvf.tvf_number for tvf in tvfs if not tvf.request_ship_date), reverse=True)
+        with CaptureQueriesContext(connection) as ctx:
+            pages, _ = self._walk('request_ship_date', True)
+        self.assertEqual([number for page in pages for number in page], [tvf.tvf_number for tvf in dated] + undated)
+        for query in ctx.captured_queries:
+            sql = query['sql'].upper()
+            # Each scan stays within dated or undated rows, so MySQL can read it in index order
+            self.assertNotIn('NULLS', sql)
+            self.assertFalse('IS NULL' in sql and ' OR ' in sql, sql)
+
+    def test_previous_cursor_returns_the_earlier_page(self):
+        for field in ('request_received_date', 'request_ship_date'):
+            pages, page = self._walk(field, True)
+            for expected in reversed(pages[:-1]):
+                page = paginate(TestRequest.objects.all(), field, True, before=page.previous_cursor, page_size=6)
+                self.assertEqual([tvf.tvf_number for tvf in page], expected, field)
+            self.assertFalse(page.has_previous)
+
+    def test_list_view_seeks_instead_of_offsetting(self):
+        url = reverse('test_requests:list')
+        first = self.client.get(url, {'sort': '-received'})
+        self.assertEqual(len(first.context['tvfs']), 20)
+
+        other_customer = Customer.objects.create(name='Other')
+        other_project = Project.objects.create(customer=other_customer, name='Credit', tvf_environment=self.reference[1])
+        _make_tvf(self.user, other_customer, self.reference[1], other_project, self.reference[3])
+        with CaptureQueriesContext(connection) as ctx:
+            response = self.client.get(url, {'customer': other_customer.pk, 'sort': 'number'})
+        self.assertEqual([tvf.customer.name for tvf in response.context['tvfs']], ['Other'])
+        self.assertFalse([q for q in ctx.captured_queries if 'OFFSET' in q['sql']])
+
+
+class PDFTestCase(TestCase):
+    """
+    Renders into a throwaway MEDIA_ROOT.
+    """
+    def setUp(self):
+        cache.clear()
+        self.media_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.media_root, ignore_errors=True)
+        settings_override = override_settings(MEDIA_ROOT=self.media_root)
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+
+        self.user = User.objects.create_user('pm', password='pw')
+        self.client.force_login(self.user)
+        self.tvf = _make_tvf(self.user, *_make_reference_data())
+
+
+class PDFRenderJobTests(PDFTestCase):
+    def test_pdf_endpoint_queues_a_job_without_rendering(self):
+        response = self.client.get(reverse('test_requests:pdf', args=[self.tvf.pk]), HTTP_ACCEPT='application/json')
+        self.assertEqual(response.status_code, 202)
+        payload = response.json()
+        self.assertEqual(payload['status'], PDFRenderJob.STATUS_PENDING)
+        self.assertIsNone(payload['download_url'])
+
+        # Clicking again while the job waits reuses it
+        again = self.client.get(reverse('test_requests:pdf', args=[self.tvf.pk]), HTTP_ACCEPT='application/json')
+        self.assertEqual(again.json()['job_id'], payload['job_id'])
+        self.assertEqual(PDFRenderJob.objects.count(), 1)
+
+    def test_worker_renders_job_and_download_serves_file(self):
+        job_id = self.client.get(reverse('test_requests:pdf', args=[self.tvf.pk]), HTTP_ACCEPT='application/json').json()['job_id']
+        self.assertEqual(work('test-worker', once=True), 1)
+
+        payload = self.client.get(reverse('test_requests:pdf_job_status', args=[job_id])).json()
+        self.assertEqual(payload['status'], PDFRenderJob.STATUS_DONE)
+        response = self.client.get(payload['download_url'])
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(b''.join(response.streaming_content).startswith(b'%PDF'))
+
+    def test_a_job_is_claimed_only_once(self):
+        PDFRenderJob.objects.create(test_request=self.tvf, requested_by=self.user)
+        job = claim_next_job('first')
+        self.assertIsNotNone(job)
+        self.assertIsNone(claim_next_job('second'))
+        self.assertTrue(run_job(job))
+
+    def test_jobs_are_private_to_their_requester(self):
+        job = PDFRenderJob.objects.create(test_request=self.tvf, requested_by=self.user)
+        self.client.force_login(User.objects.create_user('other', password='pw'))
+        response = self.client.get(reverse('test_requests:pdf_job_status', args=[job.pk]))
+        self.assertEqual(response.status_code, 404)
+
+
+    def test_polling_worker_requeues_stale_jobs(self):
+        job = PDFRenderJob.objects.create(test_request=self.tvf, requested_by=self.user)
+        self.assertEqual(claim_next_job('lost-worker').pk, job.pk)
+        PDFRenderJob.objects.filter(pk=job.pk).update(started_at=timezone.now() - timezone.timedelta(hours=1))
+
+        self.assertEqual(work('test-worker', once=True), 1)
+        job.refresh_from_db()
+        self.assertEqual((job.status, job.worker, job.attempts), (PDFRenderJob.STATUS_DONE, 'test-worker', 2))
+
+    @override_settings(TVF_PDF_JOB_RETENTION_DAYS=7)
+    def test_finished_jobs_are_purged_after_retention(self):
+        old = timezone.now() - timezone.timedelta(days=8)
+        storage = PDFRenderJob._meta.get_field('pdf_file').storage
+        own_file = storage.save('pdf_jobs/old.pdf', io.BytesIO(b'%PDF'))
+        expired = PDFRenderJob.objects.create(
+            test_request=self.tvf, status=PDFRenderJob.STATUS_DONE, pdf_file=own_file, finished_at=old,
+        )
+        failed = PDFRenderJob.objects.create(test_request=self.tvf, status=PDFRenderJob.STATUS_FAILED, finished_at=old)
+        cached = PDFRenderJob.objects.create(
+            test_request=self.tvf, status=PDFRenderJob.STATUS_DONE, pdf_file='pdf_cache/ab/shared.pdf', finished_at=old,
+        )
+        recent = PDFRenderJob.objects.create(test_request=self.tvf, status=PDFRenderJob.STATUS_DONE, finished_at=timezone.now())
+        pending = PDFRenderJob.objects.create(test_request=self.tvf)
+
+        self.assertEqual(purge_finished_jobs(), 3)
+        self.assertEqual(set(PDFRenderJob.objects.values_list('pk', flat=True)), {recent.pk, pending.pk})
+        self.assertFalse(storage.exists(own_file))
+        self.assertFalse(PDFRenderJob.objects.filter(pk__in=[expired.pk, failed.pk, cached.pk]).exists())
+
+class PDFCacheTests(PDFTestCase):
+    def test_unchanged_tvf_is_served_from_cache(self):
+        url = reverse('test_requests:pdf', args=[self.tvf.pk])
+        self.client.get(url)
+        work('test-worker', once=True)
+
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['Content-Type'], 'application/pdf')
+        self.assertTrue(b''.join(response.streaming_content).startswith(b'%PDF'))
+        self.assertEqual(PDFRenderJob.objects.count(), 1)
+        self.assertEqual(pdf_cache.stats(), {'hits': 1, 'misses': 1})
+
+        # Saving the TVF is a new cache key
+        self.tvf.tvf_name = 'Renamed'
+        self.tvf.save()
+        response = self.client.get(url, HTTP_ACCEPT='application/json')
+        self.assertEqual(response.status_code, 202)
+        self.assertEqual(pdf_cache.stats()['misses'], 2)
+
+    def test_cache_lookup_renders_nothing(self):
+        url = reverse('test_requests:pdf', args=[self.tvf.pk])
+        self.client.get(url)
+        work('test-worker', once=True)
+
+        with mock.patch('test_requests.pdf.render_to_string') as render:
+            response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        render.assert_not_called()
+
+    def test_cache_hits_reuse_the_finished_job(self):
+        url = reverse('test_requests:pdf', args=[self.tvf.pk])
+        self.client.get(url)
+        work('test-worker', once=True)
+
+        payloads = [self.client.get(url, HTTP_ACCEPT='application/json').json() for _ in range(3)]
+        self.assertEqual({payload['job_id'] for payload in payloads}, {payloads[0]['job_id']})
+        self.assertEqual(PDFRenderJob.objects.count(), 1)
+
+    def test_child_rows_change_the_cache_key(self):
+        url = reverse('test_requests:pdf', args=[self.tvf.pk])
+        self.client.get(url)
+        work('test-worker', once=True)
+
+        # Adding an input file leaves the TVF row itself untouched
+        TestRequestInputFile.objects.create(test_request=self.tvf, file_name='LATE.IN')
+        response = self.client.get(url, HTTP_ACCEPT='application/json')
+        self.assertEqual(response.status_code, 202)
+
+    def test_least_recently_used_files_are_evicted(self):
+        small_cache = PDFCache(directory=self.media_root, max_bytes=250)
+        first, second, third = (PDFCache.key_for(str(i)) for i in range(3))
+        small_cache.put(first, b'x' * 100)
+        small_cache.put(second, b'x' * 100)
+        past = time.time() - 60
+        os.utime(small_cache.path_for(first), (past, past))
+        os.utime(small_cache.path_for(second), (past - 60, past - 60))
+        small_cache.get(second) # Touching the older file makes `first` the LRU entry
+
+        small_cache.put(third, b'x' * 100)
+        self.assertIsNone(small_cache.get(first))
+        self.assertIsNotNone(small_cache.get(second))
+        self.assertIsNotNone(small_cache.get(third))
+
+
+class BulkPDFExportTests(PDFTestCase):
+    def setUp(self):
+        super().setUp()
+        self.user.groups.add(Group.objects.create(name=ROLE_NPI))
+        # The export waits for the pdf_worker; here the worker drains the queue whenever it would sleep
+        sleep = mock.patch('test_requests.pdf_export.time.sleep', side_effect=lambda seconds: work('test-worker', once=True))
+        sleep.start()
+        self.addCleanup(sleep.stop)
+
+    def _export(self, params):
+        with CaptureQueriesContext(connection) as ctx:
+            response = self.client.get(reverse('test_requests:bulk_pdf_export'), params)
+            self.assertEqual(response.status_code, 200)
+            archive = zipfile.ZipFile(io.BytesIO(b''.join(response.streaming_content)))
+        return archive, len(ctx.captured_queries)
+
+    def test_bucket_export_streams_one_pdf_per_tvf(self):
+        extra = _make_tvf(self.user, self.tvf.customer, self.tvf.tvf_environment, self.tvf.project, self.tvf.tvf_type)
+        archive, _ = self._export({'bucket': 'npi_released_tvfs'})
+        self.assertEqual(sorted(archive.namelist()), [f'TVF_{self.tvf.tvf_number}.pdf', f'TVF_{extra.tvf_number}.pdf'])
+        self.assertTrue(archive.read(f'TVF_{extra.tvf_number}.pdf').startswith(b'%PDF'))
+        # The PDFs were rendered by the worker, not the web process
+        self.assertEqual(PDFRenderJob.objects.filter(status=PDFRenderJob.STATUS_DONE).count(), 2)
+
+        # Cached PDFs are looked up per batch, not per TVF
+        _, few_queries = self._export({'bucket': 'npi_released_tvfs'})
+        for i in range(4):
+            _make_tvf(self.user, self.tvf.customer, self.tvf.tvf_environment, self.tvf.project, self.tvf.tvf_type, tvf_name=f'More {i}')
+        self._export({'bucket': 'npi_released_tvfs'})
+        archive, many_queries = self._export({'bucket': 'npi_released_tvfs'})
+        self.assertEqual(len(archive.namelist()), 6)
+        self.assertEqual(few_queries, many_queries)
+
+    def test_list_filters_select_the_exported_tvfs(self):
+        other_customer = Customer.objects.create(name='Other')
+        other_project = Project.objects.create(customer=other_customer, name='Credit', tvf_environment=self.tvf.tvf_environment)
+        other = _make_tvf(self.user, other_customer, self.tvf.tvf_environment, other_project, self.tvf.tvf_type)
+        archive, _ = self._export({'view': 'backlog', 'customer': other_customer.pk})
+        self.assertEqual(archive.namelist(), [f'TVF_{other.tvf_number}.pdf'])
+
+    def test_failed_and_unrendered_tvfs_get_error_entries(self):
+        with mock.patch('test_requests.pdf.html_to_pdf', side_effect=PDFRenderError("bad markup")):
+            archive, _ = self._export({'bucket': 'npi_released_tvfs'})
+        self.assertEqual(archive.namelist(), [f'TVF_{self.tvf.tvf_number}_ERROR.txt'])
+        self.assertIn(b'bad markup', archive.read(f'TVF_{self.tvf.tvf_number}_ERROR.txt'))
+
+        # With no worker running, the export gives up once its wait is over
+        with override_settings(TVF_PDF_EXPORT_WAIT_SECONDS=0), mock.patch('test_requests.pdf_export.time.sleep'):
+            archive, _ = self._export({'bucket': 'npi_released_tvfs'})
+        self.assertIn(b'not rendered in time', archive.read(f'TVF_{self.tvf.tvf_number}_ERROR.txt'))
+
+    def test_asgi_export_streams_asynchronously(self):
+        async def worker_sleep(seconds):
+            await sync_to_async(work)('test-worker', once=True)
+
+        async def collect():
+            return b''.join([chunk async for chunk in astream_pdf_zip([self.tvf.pk], self.user)])
+
+        with mock.patch('test_requests.pdf_export.asyncio.sleep', worker_sleep):
+            archive = zipfile.ZipFile(io.BytesIO(async_to_sync(collect)()))
+        self.assertTrue(archive.read(f'TVF_{self.tvf.tvf_number}.pdf').startswith(b'%PDF'))
+
+    def test_bucket_outside_the_users_role_is_refused(self):
+        response = self.client.get(reverse('test_requests:bulk_pdf_export'), {'bucket': 'logistics_open_tvfs'})
+        self.assertRedirects(response, reverse('test_requests:coach_dashboard'), fetch_redirect_response=False)
+
+    def test_anonymous_users_are_sent_to_log_in(self):
+        self.client.logout()
+        response = self.client.get(reverse('test_requests:bulk_pdf_export'), {'bucket': 'npi_released_tvfs'})
+        self.assertTrue(response['Location'].startswith(settings.LOGIN_URL))
+
+
+class ReferenceDataCachingTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create_user('pm', password='pw')
+        self.client.force_login(self.user)
+        self.customer, self.environment, self.project, _ = _make_reference_data()
+        self.url = reverse('test_requests:get_filtered_projects')
+        self.params = {'customer_id': self.customer.pk, 'environment_id': self.environment.pk}
+
+    def test_conditional_request_is_answered_without_querying(self):
+        response = self.client.get(self.url, self.params)
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('max-age', response['Cache-Control'])
+        self.assertIn('Last-Modified', response)
+        etag = response['ETag']
+
+        with CaptureQueriesContext(connection) as ctx:
+            response = self.client.get(self.url, self.params, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+        self.assertFalse([q for q in ctx.captured_queries if 'test_requests_project' in q['sql']])
+
+    def test_reference_data_changes_invalidate_the_etag(self):
+        for change in (
+            lambda: Project.objects.create(customer=self.customer, name='Credit', tvf_environment=self.environment),
+            lambda: DispatchMethod.objects.create(name='COURIER'),
+            lambda: Project.objects.filter(name='Credit').get().delete(),
+        ):
+            etag = self.client.get(self.url, self.params)['ETag']
+            change()
+            response = self.client.get(self.url, self.params, HTTP_IF_NONE_MATCH=etag)
+            self.assertEqual(response.status_code, 200)
+            self.assertNotEqual(response['ETag'], etag)
+
+
+class FormBootstrapTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create_user('pm', password='pw')
+        self.client.force_login(self.user)
+        self.customer, self.environment, self.project, _ = _make_reference_data()
+        PlasticCodeLookup.objects.create(customer=self.customer, project=self.project, tvf_environment=self.environment, code='0120')
+        TrustportFolder.objects.create(customer=self.customer, project=self.project, folder_path='/bank/debit')
+        DispatchMethod.objects.create(customer=self.customer, project=self.project, name='FEDEX')
+        DispatchMethod.objects.create(name='XPRESSPOST')
+        self.url = reverse('test_requests:form_bootstrap')
+
+    def test_bootstrap_holds_the_whole_reference_tree(self):
+        data = self.client.get(self.url).json()
+        customer = data['customers'][0]
+        self.assertEqual((customer['name'], customer['sla_days']), ('Bank', 5))
+        project = customer['environments'][0]['projects'][0]
+        self.assertEqual(project['name'], 'Debit')
+        self.assertEqual([code for _, code in project['plastic_codes']], ['0120'])
+        self.assertEqual([path for _, path in project['folders']], ['/bank/debit'])
+        self.assertEqual([name for _, name in project['dispatch_methods']], ['FEDEX'])
+        self.assertEqual([name for _, name in data['global_dispatch_methods']], ['XPRESSPOST'])
+
+    def test_bootstrap_is_built_once_per_reference_data_version(self):
+        self.client.get(self.url)
+        with CaptureQueriesContext(connection) as ctx:
+            self.client.get(self.url)
+        self.assertFalse([q for q in ctx.captured_queries if 'test_requests_customer' in q['sql']])
+
+        self.customer.sla_days = 10
+        self.customer.save()
+        self.assertEqual(self.client.get(self.url).json()['customers'][0]['sla_days'], 10)
+
+
+class SLATests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create_user('npi', password='pw')
+        self.user.groups.add(Group.objects.create(name=ROLE_NPI))
+        self.reference = _make_reference_data()
+
+    def test_business_calendar_skips_weekends_and_holidays(self):
+        # 2026-07-01 (Wednesday) is Canada Day
+        calendar = BusinessCalendar({date(2026, 7, 1)}, date(2026, 6, 1), date(2026, 7, 31))
+        self.assertEqual(calendar.add_business_days(date(2026, 6, 26), 1), date(2026, 6, 29)) # Friday -> Monday
+        self.assertEqual(calendar.add_business_days(date(2026, 6, 27), 1), date(2026, 6, 29)) # Saturday -> Monday
+        self.assertEqual(calendar.add_business_days(date(2026, 6, 29), 3), date(2026, 7, 3))
+        self.assertEqual(calendar.business_days_between(date(2026, 6, 29), date(2026, 7, 6)), 4)
+        self.assertFalse(calendar.is_business_day(date(2026, 7, 1)))
+
+    def test_due_date_follows_holiday_changes(self):
+        received = timezone.make_aware(datetime(2026, 6, 29, 9, 30))
+        self.assertEqual(sla_due_date(received, 5), timezone.make_aware(datetime(2026, 7, 6, 9, 30)))
+        Holiday.objects.create(date=date(2026, 7, 1), name='Canada Day')
+        self.assertEqual(sla_due_date(received, 5), timezone.make_aware(datetime(2026, 7, 7, 9, 30)))
+
+    def test_ship_date_endpoint_uses_business_days(self):
+        self.client.force_login(self.user)
+        response = self.client.get(reverse('test_requests:get_sla_and_calculate_ship_date'), {
+            'received_date': '2026-06-26T10:00', 'customer_id': self.reference[0].pk,
+        })
+        self.assertEqual(response.json()['ship_date'], '2026-07-03T10:00')
+
+    def test_open_tvfs_are_annotated_in_one_query(self):
+        now = timezone.now()
+        overdue = _make_tvf(self.user, *self.reference, request_ship_date=now - timezone.timedelta(hours=1))
+        soon = _make_tvf(self.user, *self.reference, request_ship_date=now + timezone.timedelta(hours=2))
+        later = _make_tvf(self.user, *self.reference, request_ship_date=now + timezone.timedelta(days=5))
+
+        with self.assertNumQueries(1):
+            rows = {tvf.pk: tvf for tvf in annotate_sla(TestRequest.objects.all(), now=now)}
+        self.assertTrue(rows[overdue.pk].sla_breached)
+        self.assertTrue(rows[soon.pk].sla_at_risk)
+        self.assertFalse(rows[later.pk].sla_breached or rows[later.pk].sla_at_risk)
+        self.assertLess(rows[overdue.pk].sla_remaining.total_seconds(), 0)
+
+        # The dashboard lists the most urgent TVFs first, with the flags from the same query
+        self.client.force_login(self.user)
+        released = self.client.get(reverse('test_requests:coach_dashboard')).context['npi_released_tvfs']
+        self.assertEqual([row['pk'] for row in released], [overdue.pk, soon.pk, later.pk])
+        self.assertTrue(released[0]['sla_breached'])
+
+    def test_fill_sla_due_dates_command(self):
+        tvf = _make_tvf(self.user, *self.reference, request_received_date=timezone.make_aware(datetime(2026, 6, 26, 10, 0)))
+        TestRequest.objects.filter(pk=tvf.pk).update(request_ship_date=None)
+        call_command('fill_sla_due_dates', stdout=io.StringIO())
+        tvf.refresh_from_db()
+        self.assertEqual(tvf.request_ship_date, timezone.make_aware(datetime(2026, 7, 3, 10, 0)))
+
+
+class PANImportTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create_user('npi', password='pw')
+        self.user.groups.add(Group.objects.create(name=ROLE_NPI))
+        tvf = _make_tvf(self.user, *_make_reference_data())
+        self.input_file = TestRequestInputFile.objects.create(test_request=tvf, file_name='CARDS.IN')
+
+    def _pans(self):
+        return dict(self.input_file.pans.values_list('pan_truncated', 'is_available'))
+
+    def test_mask_pan(self):
+        self.assertEqual(mask_pan('4111 1111-1111 7067'), 'XXXXXXXXXXXX7067')
+        self.assertEqual(mask_pan('******7067'.rjust(16, '*')), 'XXXXXXXXXXXX7067')
+        for value in ('', '4111', '41111111111111XXXX', 'ABCD111111117067'):
+            with self.assertRaises(PANImportError):
+                mask_pan(value)
+
+    def test_zc_tvfpans_export_in_batches(self):
+        lines = ['ZC_TVFPANS REPORT', '----------------']
+        lines += [f'41111111{i:08d}   {"Avble" if i % 2 else "Used"}' for i in range(25)]
+        lines += ['4111111100000003   Avble', 'not-a-pan', '12345 Avble']
+        upload = SimpleUploadedFile('pans.txt', '\r\n'.join(lines).encode())
+        batches = []
+
+        with self.assertNumQueries(9): # 3 batches x (existing lookup + insert + audited ids)
+            result = import_pans(self.input_file, upload, batch_size=10, progress=lambda r: batches.append(r.created))
+
+        self.assertEqual((result.created, result.duplicates), (25, 1))
+        self.assertEqual(batches, [10, 20, 25])
+        self.assertEqual(result.invalid, 1) # '12345 Avble' looks like a PAN line but is too short
+        pans = self._pans()
+        self.assertEqual(len(pans), 25)
+        self.assertTrue(pans['XXXXXXXXXXXX0003'])
+        self.assertFalse(pans['XXXXXXXXXXXX0004'])
+
+    def test_csv_reimport_counts_duplicates(self):
+        TestRequestPAN.objects.create(test_request_input_file=self.input_file, pan_truncated='XXXXXXXXXXXX0001')
+        content = 'Status,PAN\nAvble,4111111111110001\nAvble,4111111111110002\n,XXXXXXXXXXXX0003\n,bad\n'
+        result = import_pans(self.input_file, SimpleUploadedFile('pans.csv', content.encode()))
+        self.assertEqual(result.as_dict()['created'], 2)
+        self.assertEqual(result.duplicates, 1)
+        self.assertEqual(result.errors, ["Line 5: 'bad' is not a PAN (12-19 digits, optionally masked with X)."])
+        self.assertEqual(self._pans(), {
+            'XXXXXXXXXXXX0001': False, 'XXXXXXXXXXXX0002': True, 'XXXXXXXXXXXX0003': False,
+        })
+
+    def test_import_invalidates_the_cached_pdf(self):
+        versions = pdf_versions(self.input_file.test_request_id)
+        import_pans(self.input_file, SimpleUploadedFile('pans.csv', b'PAN\n4111111111110001\n'))
+        self.assertNotEqual(pdf_versions(self.input_file.test_request_id), versions)
+
+    def test_imported_pans_are_audited(self):
+        TestRequestPAN.objects.create(test_request_input_file=self.input_file, pan_truncated='XXXXXXXXXXXX0001')
+        content = '4111111111110001\n4111111111110002 Avble\n'
+        with self.captureOnCommitCallbacks(execute=True):
+            import_pans(self.input_file, SimpleUploadedFile('pans.txt', content.encode()))
+        created = AuditLog.objects.get(model_name='testrequestpan', action='created')
+        self.assertEqual(created.record_id, str(self.input_file.pans.get(pan_truncated='XXXXXXXXXXXX0002').pk))
+        self.assertEqual(json.loads(created.change_details)['is_available'], 'True')
+
+    def test_import_view_and_command(self):
+        url = reverse('test_requests:import_pans', args=[self.input_file.pk])
+        self.assertTrue(self.client.post(url)['Location'].startswith(settings.LOGIN_URL))
+        self.client.force_login(self.user)
+        response = self.client.post(url, {
+            'file_format': 'csv', 'pan_file': SimpleUploadedFile('pans', b'4111111111110001\n4111111111110002\n'),
+        }, HTTP_ACCEPT='application/json')
+        self.assertEqual(response.json()['created'], 2)
+
+        with tempfile.NamedTemporaryFile('w', suffix='.txt', delete=False) as export:
+            export.write('4111111111110002 Avble\n4111111111110003 Avble\n')
+        self.addCleanup(os.unlink, export.name)
+        out = io.StringIO()
+        call_command('import_pans', self.input_file.pk, export.name, stdout=out)
+        self.assertIn('Imported 1 PAN(s)', out.getvalue())
+        self.assertEqual(len(self._pans()), 3)
+
+
+class InputFileManifestTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create_user('npi', password='pw')
+        self.user.groups.add(Group.objects.create(name=ROLE_NPI))
+        self.tvf = _make_tvf(self.user, *_make_reference_data())
+        TestRequestInputFile.objects.create(test_request=self.tvf, file_name='A.IN', card_co='CO1', card_qty=10, pin_qty=4)
+
+    def _files(self):
+        return {f.file_name: f for f in self.tvf.input_files_entries.all()}
+
+    def test_csv_manifest_upserts_and_reports_bad_rows(self):
+        manifest = (
+            'file_name,card_wo,card_qty\n'
+            'A.IN,WO1,20\n'        # existing: updated, untouched columns keep their values
+            'B.IN,WO2,5\n'         # new
+            'C.IN,WO3,many\n'      # invalid quantity
+            'B.IN,WO4,6\n'         # listed twice
+        )
+        with CaptureQueriesContext(connection) as queries:
+            result = import_input_file_manifest(self.tvf, SimpleUploadedFile('files.csv', manifest.encode()))
+        inserts = [q for q in queries if q['sql'].startswith('INSERT')]
+        self.assertEqual(len(inserts), 1)
+
+        self.assertEqual((result.created, result.updated), (1, 1))
+        self.assertEqual(sorted(result.errors), [3, 4])
+        self.assertIn('card_qty', result.errors[3])
+        files = self._files()
+        self.assertEqual(sorted(files), ['A.IN', 'B.IN'])
+        self.assertEqual((files['A.IN'].card_co, files['A.IN'].card_wo, files['A.IN'].card_qty, files['A.IN'].pin_qty), ('CO1', 'WO1', 20, 4))
+        self.assertEqual((files['B.IN'].card_wo, files['B.IN'].card_qty, files['B.IN'].pin_qty), ('WO2', 5, 0))
+
+    def test_manifest_changes_are_audited(self):
+        manifest = 'file_name,card_wo,card_qty\nA.IN,WO1,20\nB.IN,WO2,5\n'
+        with self.captureOnCommitCallbacks(execute=True):
+            import_input_file_manifest(self.tvf, SimpleUploadedFile('files.csv', manifest.encode()))
+        files = self._files()
+        logs = AuditLog.objects.filter(model_name='testrequestinputfile')
+        created = logs.get(action='created')
+        self.assertEqual(created.record_id, str(files['B.IN'].pk))
+        self.assertEqual(json.loads(created.change_details)['card_wo'], 'WO2')
+        updates = {log.field_name: (log.record_id, log.old_value, log.new_value) for log in logs.filter(action='updated')}
+        self.assertEqual(updates, {
+            'card_wo': (str(files['A.IN'].pk), None, 'WO1'), 'card_qty': (str(files['A.IN'].pk), '10', '20'),
+        })
+
+    def test_json_manifest_view(self):
+        url = reverse('test_requests:import_input_files', args=[self.tvf.pk])
+        self.assertTrue(self.client.post(url)['Location'].startswith(settings.LOGIN_URL))
+        self.client.force_login(self.user)
+        manifest = json.dumps({'input_files': [
+            {'file_name': 'B.IN', 'date_file_received': '2026-06-29T09:30', 'pin_co': 'P1', 'pin_qty': 8},
+            {'card_qty': 3},
+        ]})
+        response = self.client.post(reverse('test_requests:import_input_files', args=[self.tvf.pk]), {
+            'file_format': 'auto', 'manifest': SimpleUploadedFile('files.json', manifest.encode()),
+        }, HTTP_ACCEPT='application/json')
+        self.assertEqual(response.status_code, 200)
+        payload = response.json()
+        self.assertEqual((payload['created'], payload['updated']), (1, 0))
+        self.assertEqual(payload['errors'], [{'row': 2, 'errors': {'file_name': ['This field is required.']}}])
+        self.assertEqual(self._files()['B.IN'].pin_qty, 8)
+
+        response = self.client.post(reverse('test_requests:import_input_files', args=[self.tvf.pk]), {
+            'file_format': 'json', 'manifest': SimpleUploadedFile('files.json', b'{not json'),
+        }, HTTP_ACCEPT='application/json')
+        self.assertEqual(response.status_code, 400)
+
+
+def _formset_data(prefix, rows, initial=0):
+    data = {f'{prefix}-TOTAL_FORMS': len(rows), f'{prefix}-INITIAL_FORMS': initial,
+            f'{prefix}-MIN_NUM_FORMS': 0, f'{prefix}-MAX_NUM_FORMS': 1000}
+    for i, row in enumerate(rows):
+        data.update({f'{prefix}-{i}-{field}': value for field, value in row.items()})
+    return data
+
+
+class TVFAggregatePersistenceTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create_user('coach', password='pw')
+        self.user.groups.add(Group.objects.create(name=ROLE_COACH))
+        self.customer, self.environment, self.project, self.tvf_type = _make_reference_data()
+        self.client.force_login(self.user)
+
+    def _post_data(self, plastic_codes, input_files, initial_plastic_codes=0, initial_input_files=0):
+        """
+        input_files: list of (input file row, PAN rows, number of PANs already saved)
+        """
+        data = {
+            'customer': self.customer.pk, 'tvf_environment': self.environment.pk, 'project': self.project.pk,
+            'tvf_name': 'Bulk TVF', 'tvf_type': self.tvf_type.pk, 'request_received_date': '2026-06-29T09:30',
+            'action': 'submit',
+        }
+        data.update(_formset_data('plastic_codes', plastic_codes, initial_plastic_codes))
+        data.update(_formset_data('input_files', [row for row, _, _ in input_files], initial_input_files))
+        for i, (_, pans, initial_pans) in enumerate(input_files):
+            data.update(_formset_data(f'input_files-{i}-pans', pans, initial_pans))
+        return data
+
+    def _create(self, size):
+        data = self._post_data(
+            [{'manual_plastic_code': f'PC{i}', 'quantity': i + 1} for i in range(size)],
+            [({'file_name': f'F{i}.IN', 'card_qty': 10, 'pin_qty': 0},
+              [{'pan_truncated': f'XXXXXXXXXXXX{i:02d}{j:02d}', 'is_available': 'on'} for j in range(2)], 0)
+             for i in range(size)],
+        )
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.post(reverse('test_requests:create_tvf'), data)
+        self.assertEqual(response.status_code, 302)
+        return TestRequest.objects.latest('tvf_number'), _write_statements(queries)
+
+    def _update(self, tvf):
+        """
+        Deletes the first plastic code and input file, edits the rest and adds one new row of each.
+        """
+        plastic_codes = list(tvf.plastic_codes_entries.order_by('pk'))
+        input_files = list(tvf.input_files_entries.order_by('pk'))
+        plastic_rows = [{'id': pc.pk, 'manual_plastic_code': pc.manual_plastic_code, 'quantity': pc.quantity + 100,
+                         'DELETE': 'on' if i == 0 else ''} for i, pc in enumerate(plastic_codes)]
+        plastic_rows.append({'manual_plastic_code': 'NEW', 'quantity': 1})
+        file_rows = []
+        for i, input_file in enumerate(input_files):
+            pans = list(input_file.pans.order_by('pk'))
+            file_rows.append((
+                {'id': input_file.pk, 'file_name': input_file.file_name, 'card_qty': 99, 'pin_qty': 0,
+                 'DELETE': 'on' if i == 0 else ''},
+                [{'id': pans[0].pk, 'pan_truncated': pans[0].pan_truncated, 'DELETE': 'on'},
+                 {'id': pans[1].pk, 'pan_truncated': pans[1].pan_truncated}], # Unavailable now
+                len(pans),
+            ))
+        file_rows.append(({'file_name': 'NEW.IN', 'card_qty': 1, 'pin_qty': 0}, [{'pan_truncated': 'XXXXXXXXXXXX9999'}], 0))
+        data = self._post_data(plastic_rows, file_rows, len(plastic_codes), len(input_files))
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.post(reverse('test_requests:update', args=[tvf.pk]), data)
+        self.assertEqual(response.status_code, 302)
+        return _write_statements(queries)
+
+    def test_statement_count_does_not_grow_with_rows(self):
+        self._create(1) # Warm the workflow registry
+
+        small_tvf, small_create = self._create(2)
+        large_tvf, large_create = self._create(25)
+        self.assertEqual(len(small_create), len(large_create), [sql[:60] for sql in small_create + ['----'] + large_create])
+        self.assertEqual(TestRequestPlasticCode.objects.filter(test_request=large_tvf).count(), 25)
+        self.assertEqual(TestRequestPAN.objects.filter(test_request_input_file__test_request=large_tvf).count(), 50)
+
+        small_update = self._update(small_tvf)
+        large_update = self._update(large_tvf)
+        self.assertEqual(len(small_update), len(large_update), [sql[:60] for sql in small_update + ['----'] + large_update])
+
+        files = {f.file_name: f for f in large_tvf.input_files_entries.all()}
+        self.assertNotIn('F0.IN', files)
+        self.assertEqual(files['F1.IN'].card_qty, 99)
+        self.assertEqual(list(files['F1.IN'].pans.values_list('pan_truncated', 'is_available')), [('XXXXXXXXXXXX0101', False)])
+        self.assertEqual(list(files['NEW.IN'].pans.values_list('pan_truncated', flat=True)), ['XXXXXXXXXXXX9999'])
+        quantities = sorted(large_tvf.plastic_codes_entries.values_list('quantity', flat=True))
+        self.assertEqual(quantities, [1] + [i + 101 for i in range(1, 25)])
+        self.assertFalse(TestRequestPAN.objects.filter(test_request_input_file__test_request=large_tvf, pan_truncated__startswith='XXXXXXXXXXXX00').exists())
+
+
+    def test_bulk_formset_writes_are_audited(self):
+        tvf, _ = self._create(2)
+        audit.writer.drain()
+        AuditLog.objects.all().delete()
+        with self.captureOnCommitCallbacks(execute=True):
+            self._update(tvf)
+        audit.writer.drain()
+
+        logs = AuditLog.objects.filter(user=self.user)
+        self.assertEqual(logs.filter(model_name='testrequestplasticcode', action='deleted').count(), 1)
+        self.assertEqual(logs.filter(model_name='testrequestplasticcode', action='created').count(), 1)
+        quantity = logs.get(model_name='testrequestplasticcode', action='updated', field_name='quantity')
+        self.assertEqual((quantity.old_value, quantity.new_value), ('2', '102'))
+        self.assertTrue(logs.filter(model_name='testrequestpan', action='updated', field_name='is_available',
+                                    old_value='True', new_value='False').exists())
+        self.assertEqual(logs.filter(model_name='testrequestinputfile', action='updated', field_name='card_qty').count(), 1)
+
+def _write_statements(queries):
+    # Session writes depend on what the previous request left in the session, not on the TVF
+    return [q['sql'] for q in queries
+            if q['sql'].split(' ', 1)[0] in ('INSERT', 'UPDATE', 'DELETE') and 'django_session' not in q['sql']]
+
+
+class SharedChoicesTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create_user('coach', password='pw')
+        self.user.groups.add(Group.objects.create(name=ROLE_COACH))
+        customer, environment, project, tvf_type = _make_reference_data()
+        self.codes = [
+            PlasticCodeLookup.objects.create(customer=customer, project=project, tvf_environment=environment, code=f'0120{i}')
+            for i in range(3)
+        ]
+        DispatchMethod.objects.create(name='XPRESSPOST')
+        self.tvf = _make_tvf(self.user, customer, environment, project, tvf_type)
+        TestRequestPlasticCode.objects.bulk_create([
+            TestRequestPlasticCode(test_request=self.tvf, plastic_code_lookup=self.codes[i % 3], quantity=i + 1)
+            for i in range(50)
+        ])
+        self.client.force_login(self.user)
+        self.url = reverse('test_requests:update', args=[self.tvf.pk])
+
+    def _queries_on(self, queries, table):
+        return [q for q in queries if f'FROM "{table}"' in q['sql']]
+
+    def test_choice_lists_are_evaluated_once_per_page(self):
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(self.url)
+        self.assertEqual(response.status_code, 200)
+        self.assertContains(response, '<option value="%d" selected>01200</option>' % self.codes[0].pk, count=17)
+        self.assertEqual(len(self._queries_on(queries, 'test_requests_plasticcodelookup')), 1)
+        self.assertEqual(len(self._queries_on(queries, 'test_requests_dispatchmethod')), 1)
+        # Quality and shipping sign-off lists share one query
+        self.assertEqual(len([q for q in queries if 'WHERE "auth_user"."is_active"' in q['sql']]), 1)
+
+        # Reference-data lists come from the cache on the next page
+        with CaptureQueriesContext(connection) as queries:
+            self.client.get(self.url)
+        self.assertEqual(self._queries_on(queries, 'test_requests_plasticcodelookup'), [])
+        self.assertEqual(self._queries_on(queries, 'test_requests_dispatchmethod'), [])
+
+        # ...until a plastic code changes
+        self.codes[2].code = '09999'
+        self.codes[2].save()
+        response = self.client.get(self.url)
+        self.assertContains(response, '>09999</option>')
+
+    def test_validation_uses_the_shared_list(self):
+        rows = [{'id': pc.pk, 'plastic_code_lookup': pc.plastic_code_lookup_id, 'quantity': pc.quantity}
+                for pc in self.tvf.plastic_codes_entries.order_by('pk')]
+        rows[0]['plastic_code_lookup'] = 999999 # Not one of the TVF's codes
+        data = {
+            'customer': self.tvf.customer_id, 'tvf_environment': self.tvf.tvf_environment_id, 'project': self.tvf.project_id,
+            'tvf_name': 'Test TVF', 'tvf_type': self.tvf.tvf_type_id, 'request_received_date': '2026-06-29T09:30',
+        }
+        data.update(_formset_data('plastic_codes', rows, len(rows)))
+        data.update(_formset_data('input_files', []))
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.post(self.url, data)
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('plastic_code_lookup', response.context['plastic_formset'].forms[0].errors)
+        self.assertEqual(len(self._queries_on(queries, 'test_requests_plasticcodelookup')), 1)
+
+
+class PhaseLogTests(NPIWorkflowTestCase):
+    def test_new_tvf_opens_its_first_log(self):
+        tvf = _make_tvf(self.user, *self.reference)
+        log = tvf.phase_logs.get()
+        self.assertEqual(log.phase_name.name, 'TVF_RELEASED')
+        self.assertEqual(log.responsible_user, self.user)
+        self.assertIsNone(log.end_time)
+
+    def test_transition_closes_open_log_and_opens_next(self):
+        tvf = _make_tvf(self.user, *self.reference)
+        self.assertTrue(perform_transition(self.request, tvf, 'dp_done', comments='keys generated'))
+
+        released, dp_done = tvf.phase_logs.select_related('phase_name').order_by('pk')
+        self.assertEqual(released.end_time, tvf.last_status_update)
+        self.assertEqual(dp_done.phase_name.name, 'TVF_DP_DONE')
+        self.assertEqual(dp_done.start_time, tvf.last_status_update)
+        self.assertEqual(dp_done.responsible_user, self.user)
+        self.assertEqual(dp_done.comments, 'keys generated')
+        self.assertIsNone(dp_done.end_time)
+
+        # A transition that does not match writes no log
+        self.assertFalse(perform_transition(self.request, tvf, 'dp_done'))
+        self.assertEqual(tvf.phase_logs.count(), 2)
+
+    def test_bulk_transition_statement_count_does_not_grow(self):
+        def move(count):
+            tvfs = [_make_tvf(self.user, *self.reference, tvf_name=f'TVF {i}') for i in range(count)]
+            with CaptureQueriesContext(connection) as ctx:
+                moved = perform_bulk_transition(self.request, [tvf.pk for tvf in tvfs], 'dp_done', comments='batch')
+            self.assertEqual(sorted(moved), sorted(tvf.pk for tvf in tvfs))
+            return _write_statements(ctx.captured_queries)
+
+        small, large = move(2), move(30)
+        self.assertEqual(len(small), len(large), small + ['----'] + large)
+        self.assertEqual(TestRequestPhaseLog.objects.filter(end_time__isnull=True, phase_name__name='TVF_DP_DONE').count(), 32)
+        self.assertFalse(TestRequestPhaseLog.objects.filter(end_time__isnull=True, phase_name__name='TVF_RELEASED').exists())
+
+    def test_backfill_reconstructs_history_from_comments_and_dates(self):
+        coach = User.objects.create_user('coach', password='pw')
+        received = timezone.make_aware(datetime(2026, 3, 2, 9, 0))
+        rejected = timezone.make_aware(datetime(2026, 3, 4, 9, 0))
+        cancelled = timezone.make_aware(datetime(2026, 3, 6, 9, 0))
+        TestRequestPhaseDefinition.objects.create(name='TVF_RELEASED', order=2)
+        TestRequestPhaseDefinition.objects.create(name='REWORK_AT_PM', order=10)
+        TestRequestPhaseDefinition.objects.create(name='TVF_CANCELLED', order=9)
+        tvf = _make_tvf(
+            self.user, *self.reference, status='Cancelled', phase='TVF_CANCELLED',
+            request_received_date=received, rejected_date=rejected, tvf_completed_date=cancelled,
+            comments="\n\nREJECTED by coach: old rework (To REWORK_AT_PROD)"
+                     "\n\nREJECTED by npi: wrong BIN (To REWORK_AT_PM)"
+                     "\n\nCANCELLED by coach: duplicate",
+        )
+        TestRequest.objects.filter(pk=tvf.pk).update(last_status_update=cancelled)
+        TestRequestPhaseLog.objects.all().delete() # As if the TVF predates phase logs
+
+        out = io.StringIO()
+        call_command('backfill_phase_logs', stdout=out)
+        logs = list(tvf.phase_logs.select_related('phase_name', 'responsible_user').order_by('start_time'))
+        self.assertEqual(
+            [(log.phase_name.name, log.start_time, log.end_time, log.responsible_user) for log in logs],
+            [('TVF_RELEASED', received, rejected, self.user),
+             ('REWORK_AT_PM', rejected, cancelled, self.user),
+             ('TVF_CANCELLED', cancelled, None, coach)],
+        )
+        self.assertEqual(logs[1].comments, 'wrong BIN')
+        self.assertIn('1 transition(s)', out.getvalue()) # The earlier rejection has no date
+
+        # TVFs that already have logs are left alone
+        call_command('backfill_phase_logs', stdout=io.StringIO())
+        self.assertEqual(tvf.phase_logs.count(), 3)
+
+
+class CycleTimeAnalyticsTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create_user('coach', password='pw')
+        self.user.groups.add(Group.objects.create(name=ROLE_COACH))
+        self.client.force_login(self.user)
+        self.customer, self.environment, self.project, self.tvf_type = _make_reference_data()
+        self.other_customer = Customer.objects.create(name='Acme', sla_days=5)
+        self.other_project = Project.objects.create(customer=self.other_customer, name='Credit', tvf_environment=self.environment)
+        self.released = TestRequestPhaseDefinition.objects.create(name='TVF_RELEASED', order=2)
+        self.dp_done = TestRequestPhaseDefinition.objects.create(name='TVF_DP_DONE', order=3)
+        self.now = timezone.now()
+
+    def _tvf_with_logs(self, customer, project, released_hours, dp_done_hours=None):
+        """
+        A TVF received `released_hours + dp_done_hours` hours ago that spent those hours in TVF_RELEASED
+        then TVF_DP_DONE, and was completed now if it left TVF_DP_DONE.
+        """
+        received = self.now - timezone.timedelta(hours=released_hours + (dp_done_hours or 0))
+        tvf = _make_tvf(self.user, customer, self.environment, project, self.tvf_type, request_received_date=received,
+                        tvf_completed_date=self.now if dp_done_hours else None)
+        tvf.phase_logs.all().delete()
+        left_released = received + timezone.timedelta(hours=released_hours)
+        TestRequestPhaseLog.objects.create(test_request=tvf, phase_name=self.released, start_time=received, end_time=left_released)
+        TestRequestPhaseLog.objects.create(
+            test_request=tvf, phase_name=self.dp_done, start_time=left_released,
+            end_time=self.now if dp_done_hours else None,
+        )
+        return tvf
+
+    def test_grouped_percentiles_match_numpy(self):
+        rng = np.random.default_rng(7)
+        keys = rng.integers(0, 4, size=(500, 2))
+        values = rng.exponential(300, size=500)
+        unique_keys, counts, percentiles, histograms = grouped_statistics(keys, values)
+        for key, count, row, histogram in zip(unique_keys, counts, percentiles, histograms):
+            group_values = values[(keys == key).all(axis=1)]
+            self.assertEqual(count, len(group_values))
+            np.testing.assert_allclose(row, np.percentile(group_values, [50, 90, 99]))
+            self.assertEqual(histogram.sum(), count)
+
+    def test_time_in_phase_and_cycle_time(self):
+        for hours in (1, 2, 3, 10):
+            self._tvf_with_logs(self.customer, self.project, hours, dp_done_hours=5)
+        self._tvf_with_logs(self.other_customer, self.other_project, 30) # Still in TVF_DP_DONE
+
+        with CaptureQueriesContext(connection) as ctx:
+            analytics = compute_cycle_time_analytics(days=30, now=self.now)
+        self.assertEqual(len([q for q in ctx.captured_queries if 'test_requests_testrequestphaselog' in q['sql']]), 1)
+
+        released, dp_done = analytics['time_in_phase']
+        self.assertEqual((released['phase'], released['count']), ('TVF_RELEASED', 5))
+        self.assertAlmostEqual(released['p50'], 180.0, places=0)
+        self.assertEqual(sum(released['histogram']), 5)
+        self.assertEqual((dp_done['phase'], dp_done['count']), ('TVF_DP_DONE', 4)) # The open visit is not counted
+        self.assertAlmostEqual(dp_done['p90'], 300.0, places=0)
+
+        cycle, = analytics['cycle_time']
+        self.assertEqual(cycle['count'], 4)
+        self.assertAlmostEqual(cycle['p50'], 7.5 * 60, places=0)
+
+    def test_sliced_by_customer(self):
+        self._tvf_with_logs(self.customer, self.project, 2, dp_done_hours=1)
+        self._tvf_with_logs(self.other_customer, self.other_project, 8, dp_done_hours=1)
+        analytics = compute_cycle_time_analytics(days=30, dimension='customer', now=self.now)
+        self.assertEqual(
+            [(row['group']['name'], row['phase'], row['p50']) for row in analytics['time_in_phase']],
+            [('Acme', 'TVF_RELEASED', 480.0), ('Acme', 'TVF_DP_DONE', 60.0),
+             ('Bank', 'TVF_RELEASED', 120.0), ('Bank', 'TVF_DP_DONE', 60.0)],
+        )
+        self.assertEqual([row['group']['name'] for row in analytics['cycle_time']], ['Acme', 'Bank'])
+
+    def test_json_endpoint_is_cached_per_window(self):
+        self._tvf_with_logs(self.customer, self.project, 2, dp_done_hours=1)
+        url = reverse('test_requests:cycle_time_analytics_data')
+        response = self.client.get(url, {'days': 30, 'by': 'project'})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()['time_in_phase'][0]['group']['name'], 'Debit')
+
+        with CaptureQueriesContext(connection) as ctx:
+            self.client.get(url, {'days': 30, 'by': 'project'})
+        self.assertFalse([q for q in ctx.captured_queries if 'test_requests_testrequestphaselog' in q['sql']])
+
+        page = self.client.get(reverse('test_requests:cycle_time_analytics'), {'days': 30, 'by': 'project'})
+        self.assertContains(page, 'TVF_RELEASED')
+
+    def test_analytics_are_for_coaches(self):
+        npi = User.objects.create_user('npi', password='pw')
+        npi.groups.add(Group.objects.create(name=ROLE_NPI))
+        self.client.force_login(npi)
+        response = self.client.get(reverse('test_requests:cycle_time_analytics_data'))
+        self.assertNotEqual(response.status_code, 200)
+
+
+class AuditLogTests(NPIWorkflowTestCase):
+    def setUp(self):
+        audit.writer.drain()
+        AuditLog.objects.all().delete()
+        super().setUp()
+        self.spool_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.spool_dir, ignore_errors=True)
+
+    def _audit_inserts(self, queries):
+        return [q['sql'] for q in queries if q['sql'].startswith('INSERT INTO "test_requests_auditlog"')]
+
+    def test_save_records_field_level_diffs_after_commit(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            tvf = _make_tvf(self.user, *self.reference, tvf_name='Before')
+        with self.captureOnCommitCallbacks(execute=True):
+            tvf.tvf_name = 'After'
+            tvf.save()
+        audit.writer.drain()
+
+        created = AuditLog.objects.get(action='created', model_name='testrequest')
+        self.assertEqual(json.loads(created.change_details)['tvf_name'], 'Before')
+        updated = AuditLog.objects.get(action='updated', model_name='testrequest')
+        self.assertEqual((updated.field_name, updated.old_value, updated.new_value), ('tvf_name', 'Before', 'After'))
+        self.assertEqual(updated.record_id, str(tvf.pk))
+
+    def test_rolled_back_changes_are_not_audited(self):
+        tvf = _make_tvf(self.user, *self.reference)
+        with self.captureOnCommitCallbacks(execute=True):
+            with self.assertRaises(RuntimeError), transaction.atomic():
+                tvf.tvf_name = 'Changed'
+                tvf.save()
+                raise RuntimeError
+        audit.writer.drain()
+        self.assertFalse(AuditLog.objects.filter(action='updated').exists())
+
+    def test_transition_is_audited_without_inserting_during_the_request(self):
+        tvf = _make_tvf(self.user, *self.reference)
+        self.client.get(reverse('test_requests:coach_dashboard'))
+        with self.captureOnCommitCallbacks(execute=True), CaptureQueriesContext(connection) as ctx:
+            response = self.client.post(reverse('test_requests:npi_update_tvf', args=[tvf.pk]), {'action': 'dp_done', 'comments': 'ok'})
+        self.assertEqual(response.status_code, 302)
+        self.assertEqual(self._audit_inserts(ctx.captured_queries), [])
+
+        audit.writer.drain()
+        changes = {log.field_name: log for log in AuditLog.objects.filter(model_name='testrequest', action='updated')}
+        self.assertEqual(changes['current_phase'].new_value, str(registry.phase_id('TVF_DP_DONE')))
+        self.assertEqual(changes['status'].new_value, str(registry.status_id('DP Done')))
+        self.assertEqual(changes['comments'].new_value, 'ok')
+        self.assertEqual(changes['status'].user, self.user)
+
+    def test_writer_spools_when_the_queue_is_full_and_replays_the_spool(self):
+        writer = audit.AuditWriter(batch_size=10, queue_size=1, spool_dir=self.spool_dir)
+        first = audit.make_entry('updated', TestRequest, 1, 'tvf_name', 'a', 'b')
+        second = audit.make_entry('updated', TestRequest, 2, 'tvf_name', 'c', 'd')
+        # As if the background thread were running but had fallen behind
+        with mock.patch.object(audit.AuditWriter, 'running', new_callable=mock.PropertyMock, return_value=True):
+            writer.record([first])
+            writer.record([second]) # Queue full
+        self.assertEqual(len(os.listdir(self.spool_dir)), 1)
+
+        writer.drain()
+        self.assertEqual(AuditLog.objects.count(), 1)
+        self.assertEqual(writer.replay_spool(), 1)
+        self.assertEqual(sorted(AuditLog.objects.values_list('record_id', flat=True)), ['1', '2'])
+        self.assertEqual(os.listdir(self.spool_dir), [])
+
+    def test_without_the_background_thread_nothing_is_left_queued(self):
+        writer = audit.AuditWriter(batch_size=10, spool_dir=self.spool_dir)
+        with mock.patch.object(audit.atexit, 'register') as register:
+            writer.record([audit.make_entry('deleted', TestRequest, 7)])
+        # Written straight away, so no exit hook writes it later against another database
+        self.assertEqual(AuditLog.objects.get().record_id, '7')
+        self.assertTrue(writer._queue.empty())
+        register.assert_not_called()
+
+    def test_failed_write_goes_to_the_spool(self):
+        writer = audit.AuditWriter(batch_size=1, spool_dir=self.spool_dir)
+        with mock.patch.object(AuditLog.objects, 'bulk_create', side_effect=audit.DatabaseError('down')):
+            with self.assertLogs('test_requests.audit', 'ERROR'):
+                writer.record([audit.make_entry('deleted', TestRequest, 5)])
+        self.assertFalse(AuditLog.objects.exists())
+        self.assertEqual(writer.replay_spool(), 1)
+        self.assertEqual(AuditLog.objects.get().record_id, '5')
+
+
+class AuditWriterThreadTests(TransactionTestCase):
+    def test_background_thread_flushes_on_size_and_time(self):
+        spool_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, spool_dir, ignore_errors=True)
+        writer = audit.AuditWriter(batch_size=3, flush_interval=0.2, spool_dir=spool_dir)
+        writer.spool([audit.make_entry('deleted', TestRequest, 0)]) # Left over from a previous run
+        writer.start()
+        try:
+            writer.record([audit.make_entry('updated', TestRequest, i, 'tvf_name', 'x', 'y') for i in range(1, 4)])
+            writer.record([audit.make_entry('updated', TestRequest, 4, 'tvf_name', 'x', 'y')])
+            deadline = time.monotonic() + 5
+            while AuditLog.objects.count() < 5 and time.monotonic() < deadline:
+                time.sleep(0.05)
+        finally:
+            writer.stop()
+        self.assertEqual(sorted(AuditLog.objects.values_list('record_id', flat=True)), ['0', '1', '2', '3', '4'])
+        self.assertEqual(os.listdir(spool_dir), [])
+
+
+class AuditArchiveTests(TestCase):
+    def setUp(self):
+        self.archive_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.archive_dir, ignore_errors=True)
+        settings_override = override_settings(TVF_AUDIT_ARCHIVE_DIR=self.archive_dir)
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+        self.user = User.objects.create_user('coach', password='pw')
+        self.user.groups.add(Group.objects.create(name=ROLE_COACH))
+        now = timezone.now()
+        self.old_day = now - timezone.timedelta(days=100)
+        self.older_day = now - timezone.timedelta(days=101)
+
+        def log(when, record_id, value):
+            return AuditLog.objects.create(
+                timestamp=when, user=self.user, action='updated', model_name='testrequest',
+                record_id=str(record_id), field_name='tvf_name', old_value='x', new_value=value,
+            )
+        self.archived = [log(self.older_day, 1, 'a'), log(self.older_day, 2, 'b'), log(self.old_day, 1, 'c')]
+        self.recent = log(now, 1, 'd')
+
+    def test_command_moves_old_rows_into_partitions(self):
+        out = io.StringIO()
+        call_command('archive_audit_logs', days=30, batch_size=2, stdout=out)
+        self.assertIn('Archived 3 audit log row(s)', out.getvalue())
+        self.assertEqual(list(AuditLog.objects.values_list('pk', flat=True)), [self.recent.pk])
+        self.assertEqual(len(list(Path(self.archive_dir).glob('*/*/audit-*.jsonl.gz'))), 2)
+
+        partition = ArchivePartition(timezone.localtime(self.older_day).date())
+        self.assertEqual(sorted(partition.index), ['testrequest:1', 'testrequest:2'])
+        with gzip.open(partition.data_path, 'rt') as data_file:
+            self.assertEqual(sorted(json.loads(line)['new_value'] for line in data_file), ['a', 'b'])
+
+    def test_dry_run_moves_nothing(self):
+        out = io.StringIO()
+        call_command('archive_audit_logs', days=30, dry_run=True, stdout=out)
+        self.assertIn('Would archive 3', out.getvalue())
+        self.assertEqual(AuditLog.objects.count(), 4)
+
+    def test_history_merges_table_and_archive(self):
+        call_command('archive_audit_logs', days=30, stdout=io.StringIO())
+        history = audit_history('testrequest', 1)
+        self.assertEqual([(row['new_value'], row['archived']) for row in history], [('d', False), ('c', True), ('a', True)])
+        self.assertEqual(history[1]['user_id'], self.user.pk)
+        self.assertEqual([row['new_value'] for row in audit_history('testrequest', 1, limit=2)], ['d', 'c'])
+
+    def test_search_only_decompresses_partitions_holding_the_record(self):
+        call_command('archive_audit_logs', days=30, stdout=io.StringIO())
+        with mock.patch('test_requests.audit_archive.gzip.open', wraps=gzip.open) as opened:
+            rows = search_archive('testrequest', '2')
+        self.assertEqual([row['new_value'] for row in rows], ['b'])
+        self.assertEqual(opened.call_count, 1)
+
+    def test_rerun_after_interrupted_delete_does_not_duplicate(self):
+        rows = list(AuditLog.objects.filter(pk=self.archived[0].pk).values(
+            'id', 'timestamp', 'user_id', 'action', 'model_name', 'record_id', 'field_name', 'old_value', 'new_value', 'change_details',
+        ))
+        ArchivePartition(timezone.localtime(self.older_day).date()).append(rows) # Written, but the DELETE never ran
+        call_command('archive_audit_logs', days=30, stdout=io.StringIO())
+        self.assertEqual([row['new_value'] for row in search_archive('testrequest', '1')], ['c', 'a'])
+
+    def test_history_endpoint_and_admin_page(self):
+        call_command('archive_audit_logs', days=30, stdout=io.StringIO())
+        self.client.force_login(self.user)
+        response = self.client.get(reverse('test_requests:audit_history', args=['testrequest', '1']))
+        self.assertEqual(response.status_code, 200)
+        entries = response.json()['entries']
+        self.assertEqual([(e['new_value'], e['archived'], e['username']) for e in entries],
+                         [('d', False, 'coach'), ('c', True, 'coach'), ('a', True, 'coach')])
+        self.assertEqual(self.client.get(reverse('test_requests:audit_history', args=['user', '1'])).status_code, 404)
+        for limit, expected in (('-1', 1), ('0', 1), ('x', 3), ('2', 2)):
+            response = self.client.get(reverse('test_requests:audit_history', args=['testrequest', '1']), {'limit': limit})
+            self.assertEqual(len(response.json()['entries']), expected, limit)
+
+        admin_user = User.objects.create_superuser('admin', password='pw')
+        self.client.force_login(admin_user)
+        page = self.client.get(reverse('admin:test_requests_auditlog_record_history'), {'model_name': 'testrequest', 'record_id': '1'})
+        self.assertContains(page, '3 change(s)')
+
+
+# Tables large enough in production that reading them without an index is a regression
+LARGE_TABLES = (TestRequest._meta.db_table, TestRequestPhaseLog._meta.db_table)
+
+
+def _full_scans(sql):
+    """
+    Lines of the query plan of `sql` that read a large table without an index.
+    SQLite: 'SCAN <table>' without 'USING ... INDEX'; MySQL: access type 'ALL'.
+    """
+    with connection.cursor() as cursor:
+        if connection.vendor == 'sqlite':
+            cursor.execute('EXPLAIN QUERY PLAN ' + sql)
+            details = [row[-1] for row in cursor.fetchall()]
+            return [
+                detail for detail in details
+                if detail.startswith('SCAN ') and 'USING' not in detail
+                and detail.split()[1] in LARGE_TABLES
+            ]
+        cursor.execute('EXPLAIN ' + sql)
+        columns = [column[0] for column in cursor.description]
+        rows = [dict(zip(columns, row)) for row in cursor.fetchall()]
+        return [str(row) for row in rows if row['type'] == 'ALL' and row['table'] in LARGE_TABLES]
+
+
+class QueryPlanTests(TestCase):
+    """
+    Seeds a realistically skewed dataset (a small open backlog over a long shipped history)
+    and checks through EXPLAIN that the queue, list and analytics queries read
+    TestRequest and its phase logs through an index.
+    """
+    HISTORY = 3000
+    OPEN_PER_STATE = 40
+
+    def setUp(self):
+        cache.clear()
+        self.reference = _make_reference_data()
+        self.pm = User.objects.create_user('pm', password='pw')
+        self.pm.groups.add(Group.objects.create(name=ROLE_PROJECT_MANAGER))
+        self.coach = User.objects.create_user('coach', password='pw')
+        self.coach.groups.add(Group.objects.create(name=ROLE_COACH))
+
+        states = list(QUEUE_STATES)
+        closed = [
+            ('TVF_COMPLETED', 'Shipped', False, TVFQueue.NONE), ('TVF_COMPLETED', 'Completed', False, TVFQueue.NONE),
+            ('TVF_CANCELLED', 'Rejected', False, TVFQueue.NONE),
+        ]
+        for order, (phase, status, _, _) in enumerate(states + closed):
+            TestRequestPhaseDefinition.objects.get_or_create(name=phase, defaults={'order': order})
+            TVFStatus.objects.get_or_create(name=status)
+        phases = dict(TestRequestPhaseDefinition.objects.values_list('name', 'pk'))
+        statuses = dict(TVFStatus.objects.values_list('name', 'pk'))
+
+        customer, environment, project, tvf_type = self.reference
+        now = timezone.now()
+        rows = [(closed[i % len(closed)], now - timezone.timedelta(days=400 + i % 700)) for i in range(self.HISTORY)]
+        rows += [(state, now - timezone.timedelta(days=i % 60)) for state in states for i in range(self.OPEN_PER_STATE)]
+        tvfs = [
+            TestRequest(
+                tvf_number=TVF_NUMBER_START + i, tvf_name=f'TVF {i}', customer=customer, project=project,
+                tvf_environment=environment, tvf_type=tvf_type, tvf_initiator=self.pm if i % 2 else self.coach,
+                status_id=statuses[status], current_phase_id=phases[phase], is_rejected=rejected, queue=queue,
+                request_received_date=received, request_ship_date=received + timezone.timedelta(days=5 + i % 3),
+                tvf_completed_date=received + timezone.timedelta(days=7) if phase == 'TVF_COMPLETED' else None,
+            )
+            for i, ((phase, status, rejected, queue), received) in enumerate(rows)
+        ]
+        TestRequest.objects.bulk_create(tvfs, batch_size=500)
+        TestRequestPhaseLog.objects.bulk_create([
+            TestRequestPhaseLog(
+                test_request_id=tvf.pk, phase_name_id=tvf.current_phase_id, start_time=tvf.request_received_date,
+                end_time=tvf.tvf_completed_date,
+            )
+            for tvf in TestRequest.objects.only('pk', 'current_phase_id', 'request_received_date', 'tvf_completed_date')
+        ], batch_size=500)
+        with connection.cursor() as cursor:
+            if connection.vendor == 'sqlite':
+                cursor.execute('ANALYZE')
+            else:
+                cursor.execute('ANALYZE TABLE ' + ', '.join(connection.ops.quote_name(table) for table in LARGE_TABLES))
+
+    def _assert_indexed(self, user, url, params=None):
+        self.client.force_login(user)
+        with CaptureQueriesContext(connection) as ctx:
+            response = self.client.get(url, params or {})
+        self.assertEqual(response.status_code, 200)
+        statements = [
+            q['sql'] for q in ctx.captured_queries
+            if q['sql'].startswith('SELECT') and any(table in q['sql'] for table in LARGE_TABLES)
+        ]
+        self.assertTrue(statements, url)
+        for sql in statements:
+            self.assertEqual(_full_scans(sql), [], sql)
+        return response
+
+    def test_dashboard_queues_use_the_queue_index(self):
+        url = reverse('test_requests:coach_dashboard')
+        response = self._assert_indexed(self.coach, url)
+        self.assertEqual(len(response.context['npi_released_tvfs']), self.OPEN_PER_STATE * 2)
+        response = self._assert_indexed(self.pm, url)
+        self.assertEqual(len(response.context['pm_draft_tvfs']), self.OPEN_PER_STATE // 2)
+
+    def test_list_views_use_an_index_for_every_sort(self):
+        url = reverse('test_requests:list')
+        for sort in ('-received', 'received', '-due', 'number'):
+            self._assert_indexed(self.pm, url, {'sort': sort})
+        self._assert_indexed(self.pm, url, {'customer': self.reference[0].pk})
+        for sort in ('-completed', 'completed', '-received'):
+            response = self._assert_indexed(self.pm, url, {'view': 'shipped', 'sort': sort})
+            self.assertEqual(response.context['active_view'], 'shipped')
+
+    def test_analytics_and_phase_log_updates_use_an_index(self):
+        self._assert_indexed(self.coach, reverse('test_requests:cycle_time_analytics_data'), {'days': 30})
+        self._assert_indexed(self.coach, reverse('test_requests:cycle_time_analytics_data'), {'days': 90, 'by': 'customer'})
+        open_logs = TestRequestPhaseLog.objects.filter(test_request_id__in=[1, 2, 3], end_time__isnull=True)
+        sql, params = open_logs.query.sql_with_params()
+        with connection.cursor() as cursor:
+            self.assertEqual(_full_scans(connection.ops.last_executed_query(cursor, sql, params)), [])
+
+
+class QueueColumnTests(NPIWorkflowTestCase):
+    def setUp(self):
+        super().setUp()
+        TVFStatus.objects.create(name='Rejected to NPI')
+        TestRequestPhaseDefinition.objects.create(name='REWORK_AT_PROD', order=11)
+
+    def _stored_queue(self, tvf):
+        return TestRequest.objects.values_list('queue', flat=True).get(pk=tvf.pk)
+
+    def test_save_and_transitions_keep_the_queue_in_step(self):
+        tvf = _make_tvf(self.user, *self.reference)
+        self.assertEqual(self._stored_queue(tvf), TVFQueue.RELEASED)
+        draft = _make_tvf(self.user, *self.reference, status='Draft', phase='PM_DRAFT')
+        self.assertEqual(self._stored_queue(draft), TVFQueue.PM_DRAFT)
+
+        self.assertTrue(perform_transition(self.request, tvf, 'dp_done', comments='keys generated'))
+        self.assertEqual(tvf.queue, TVFQueue.DP_DONE)
+        self.assertEqual(self._stored_queue(tvf), TVFQueue.DP_DONE)
+        response = self.client.get(reverse('test_requests:coach_dashboard'))
+        self.assertEqual([row['pk'] for row in response.context['npi_dp_done_tvfs']], [tvf.pk])
+
+        self.assertTrue(perform_transition(self.request, tvf, 'reject', comments='wrong BIN', target_phase='REWORK_AT_PROD', is_rejected=True))
+        self.assertEqual(self._stored_queue(tvf), TVFQueue.REWORK_AT_NPI)
+
+        # Without is_rejected in the UPDATE, the queue is computed from the row's flag
+        other = _make_tvf(self.user, *self.reference)
+        self.assertTrue(perform_transition(self.request, other, 'reject', comments='no flag', target_phase='REWORK_AT_PROD'))
+        self.assertEqual(self._stored_queue(other), TVFQueue.NONE)
+
+        moved = perform_bulk_transition(self.request, [tvf.pk, other.pk], 'dp_done', comments='batch')
+        self.assertEqual(sorted(moved), sorted([tvf.pk, other.pk]))
+        self.assertEqual(set(TestRequest.objects.filter(pk__in=moved).values_list('queue', flat=True)), {TVFQueue.DP_DONE})
+
+    def test_check_queues_reports_and_fixes_drift(self):
+        tvfs = [_make_tvf(self.user, *self.reference, tvf_name=f'TVF {i}') for i in range(3)]
+        call_command('check_queues', stdout=io.StringIO())
+
+        TestRequest.objects.filter(pk__in=[tvf.pk for tvf in tvfs[:2]]).update(queue=TVFQueue.OPEN_AT_QA)
+        out = io.StringIO()
+        with self.assertRaises(CommandError):
+            call_command('check_queues', stdout=out)
+        self.assertIn(f"TVF {tvfs[0].tvf_number}: queue is 'Open at QA', expected 'Released to NPI'", out.getvalue())
+
+        released_version = get_version(bucket_version_name('npi_released_tvfs'))
+        call_command('check_queues', '--fix', stdout=io.StringIO())
+        self.assertEqual({self._stored_queue(tvf) for tvf in tvfs}, {TVFQueue.RELEASED})
+        call_command('check_queues', stdout=io.StringIO())
+        # The rewrite reaches the counters and the cached dashboard buckets
+        self.assertEqual(_counters(), {('RELEASED', self.reference[0].pk): 3})
+        self.assertNotEqual(get_version(bucket_version_name('npi_released_tvfs')), released_version)
+
+
+def _counters():
+    return {
+        (TVFQueue(queue).name, customer_id): count
+        for queue, customer_id, count in QueueCounter.objects.filter(count__gt=0).values_list('queue', 'customer_id', 'count')
+    }
+
+
+class QueueCounterTests(NPIWorkflowTestCase):
+    def setUp(self):
+        super().setUp()
+        self.customer = self.reference[0]
+
+    def test_counters_follow_saves_transitions_and_deletes(self):
+        tvfs = [_make_tvf(self.user, *self.reference, tvf_name=f'TVF {i}') for i in range(4)]
+        self.assertEqual(_counters(), {('RELEASED', self.customer.pk): 4})
+
+        self.assertTrue(perform_transition(self.request, tvfs[0], 'dp_done', comments='done'))
+        perform_bulk_transition(self.request, [tvfs[1].pk, tvfs[2].pk], 'dp_done', comments='batch')
+        self.assertEqual(_counters(), {('RELEASED', self.customer.pk): 1, ('DP_DONE', self.customer.pk): 3})
+
+        # Rolled back with the transition that moved the TVF
+        with self.assertRaises(RuntimeError), transaction.atomic():
+            perform_transition(self.request, tvfs[3], 'dp_done', comments='undone')
+            raise RuntimeError
+        self.assertEqual(_counters()[('RELEASED', self.customer.pk)], 1)
+
+        other = Customer.objects.create(name='Other')
+        tvfs[3].refresh_from_db()
+        tvfs[3].customer = other
+        tvfs[3].save()
+        tvfs[0].delete()
+        self.assertEqual(_counters(), {('RELEASED', other.pk): 1, ('DP_DONE', self.customer.pk): 2})
+
+    def test_stale_instance_moves_from_the_locked_row(self):
+        tvf = _make_tvf(self.user, *self.reference)
+        stale = TestRequest.objects.get(pk=tvf.pk)
+        self.assertTrue(perform_transition(self.request, tvf, 'dp_done', comments='done'))
+        dp_done_version = get_version(bucket_version_name('npi_dp_done_tvfs'))
+
+        # `stale` still says RELEASED; the move must start from the DP_DONE row
+        with self.captureOnCommitCallbacks(execute=True), mock.patch.object(live, 'publish_queue_moves') as publish:
+            self.assertTrue(perform_transition(self.request, stale, 'back_to_released', comments='redo'))
+        self.assertEqual(_counters(), {('RELEASED', self.customer.pk): 1})
+        publish.assert_called_once_with([(tvf.pk, TVFQueue.DP_DONE, TVFQueue.RELEASED)])
+        self.assertNotEqual(get_version(bucket_version_name('npi_dp_done_tvfs')), dp_done_version)
+        self.assertEqual(stale.queue, TVFQueue.RELEASED)
+        status = AuditLog.objects.get(model_name='testrequest', action='updated', field_name='status')
+        self.assertEqual((status.old_value, status.new_value), (str(registry.status_id('DP Done')), str(registry.status_id('TVF_SUBMITTED'))))
+
+    def test_reconcile_corrects_drift(self):
+        for i in range(3):
+            _make_tvf(self.user, *self.reference, tvf_name=f'TVF {i}')
+        QueueCounter.objects.filter(queue=TVFQueue.RELEASED).update(count=7)
+        QueueCounter.objects.filter(queue=TVFQueue.OPEN_AT_QA).update(count=2)
+
+        out = io.StringIO()
+        call_command('reconcile_queue_counters', '--dry-run', stdout=out)
+        self.assertIn("Released to NPI / Bank: counted 7, actually 3", out.getvalue())
+        self.assertIn("Would correct 2 queue counter(s).", out.getvalue())
+        self.assertEqual(_counters()[('RELEASED', self.customer.pk)], 7)
+
+        call_command('reconcile_queue_counters', stdout=io.StringIO())
+        self.assertEqual(_counters(), {('RELEASED', self.customer.pk): 3})
+
+    def test_counts_endpoint_reads_the_counters_once(self):
+        for i in range(3):
+            _make_tvf(self.user, *self.reference, tvf_name=f'TVF {i}')
+        _make_tvf(self.user, *self.reference, status='DP Done', phase='TVF_DP_DONE')
+
+        with CaptureQueriesContext(connection) as ctx:
+            response = self.client.get(reverse('test_requests:queue_counts'))
+        counts = response.json()
+        self.assertEqual(len([q for q in ctx.captured_queries if 'test_requests_queuecounter' in q['sql']]), 1)
+        self.assertFalse([q for q in ctx.captured_queries if 'test_requests_testrequest' in q['sql']])
+
+        self.assertEqual(counts['total'], 4)
+        self.assertEqual(counts['queues']['released'], 3)
+        self.assertEqual(counts['roles'][ROLE_NPI], 4)
+        self.assertEqual(counts['roles'][ROLE_QUALITY], 0)
+        self.assertEqual(counts['customers'], [{
+            'id': self.customer.pk, 'name': 'Bank', 'total': 4,
+            'queues': {'released': 3, 'dp_done': 1},
+            'roles': {**{role: 0 for role in counts['roles']}, ROLE_PROJECT_MANAGER: 3, ROLE_NPI: 4, ROLE_COACH: 4},
+        }])
+
+        # The counts are for dashboard users only
+        self.client.force_login(User.objects.create_user('norole', password='pw'))
+        response = self.client.get(reverse('test_requests:queue_counts'))
+        self.assertRedirects(response, f"{reverse('test_requests:access_denied')}?next={reverse('test_requests:queue_counts')}", fetch_redirect_response=False)
+
+
+class _RecordingBroadcaster:
+    def __init__(self):
+        self.messages = []
+
+    def publish(self, message):
+        self.messages.append(message)
+
+
+def _sse_data(message):
+    return json.loads(message.split(b'data: ', 1)[1])
+
+
+class LiveDashboardTests(NPIWorkflowTestCase):
+    def setUp(self):
+        super().setUp()
+        self.async_client.force_login(self.user)
+
+    def test_broadcaster_fans_out_to_every_subscriber(self):
+        broadcaster = live.LocalBroadcaster()
+
+        async def listen():
+            subscriptions = [broadcaster.subscribe() for _ in range(300)]
+            self.assertEqual(broadcaster.subscriber_count, 300)
+            # Published from another thread, as committing transactions do
+            publisher = threading.Thread(target=broadcaster.publish, args=(b'hello',))
+            publisher.start()
+            received = [await subscription.get(timeout=5) for subscription in subscriptions]
+            publisher.join()
+            for subscription in subscriptions:
+                subscription.close()
+            return received
+
+        self.assertEqual(async_to_sync(listen)(), [b'hello'] * 300)
+        self.assertEqual(broadcaster.subscriber_count, 0)
+
+    def test_slow_subscriber_is_told_to_resync(self):
+        broadcaster = live.LocalBroadcaster()
+
+        async def overflow():
+            subscription = live.Subscription(broadcaster, queue_size=3)
+            for i in range(5):
+                subscription.put(str(i).encode())
+            return [await subscription.get(timeout=1) for _ in range(subscription.queue.qsize())]
+
+        # The backlog is dropped for a resync; later messages follow it
+        self.assertEqual(async_to_sync(overflow)(), [live.RESYNC_MESSAGE, b'4'])
+
+    def test_transitions_publish_moves_on_commit(self):
+        tvfs = [_make_tvf(self.user, *self.reference, tvf_name=f'TVF {i}') for i in range(3)]
+        broadcaster = _RecordingBroadcaster()
+        with mock.patch.object(live, 'get_broadcaster', return_value=broadcaster):
+            with self.captureOnCommitCallbacks(execute=True):
+                with self.assertRaises(RuntimeError), transaction.atomic():
+                    perform_transition(self.request, tvfs[0], 'dp_done', comments='undone')
+                    raise RuntimeError
+            self.assertEqual(broadcaster.messages, [])
+
+            with self.captureOnCommitCallbacks(execute=True):
+                perform_bulk_transition(self.request, [tvfs[1].pk, tvfs[2].pk], 'dp_done', comments='batch')
+        self.assertEqual(len(broadcaster.messages), 1)
+        self.assertTrue(broadcaster.messages[0].startswith(b'event: queue_moves\n'))
+        moves = _sse_data(broadcaster.messages[0])['moves']
+        self.assertEqual(sorted(move['tvf'] for move in moves), [tvfs[1].pk, tvfs[2].pk])
+        self.assertEqual(moves[0]['from'], 'released')
+        self.assertEqual(moves[0]['to'], 'dp_done')
+        self.assertIn('npi_released_tvfs', moves[0]['from_buckets'])
+        self.assertIn('npi_dp_done_tvfs', moves[0]['to_buckets'])
+
+    def test_events_view_streams_under_asgi_only(self):
+        self.assertEqual(self.client.get(reverse('test_requests:dashboard_events')).status_code, 204)
+
+        broadcaster = live.LocalBroadcaster()
+
+        async def stream():
+            with mock.patch.object(live, 'get_broadcaster', return_value=broadcaster):
+                response = await self.async_client.get(reverse('test_requests:dashboard_events'))
+            content = response.streaming_content
+            try:
+                first = await content.__anext__()
+                broadcaster.publish(live.queue_moves_message([(1, TVFQueue.RELEASED, TVFQueue.DP_DONE)]))
+                second = await content.__anext__()
+            finally:
+                await content.aclose()
+            return response, first, second
+
+        response, first, second = async_to_sync(stream)()
+        self.assertEqual(response['Content-Type'], 'text/event-stream')
+        self.assertEqual(response['Cache-Control'], 'no-cache')
+        self.assertTrue(first.startswith(b'retry: '))
+        self.assertEqual(_sse_data(second)['moves'][0]['to'], 'dp_done')
+        self.assertEqual(broadcaster.subscriber_count, 0)
+
+    def test_fanout_benchmark(self):
+        out = io.StringIO()
+        call_command('live_fanout_benchmark', clients=50, events=5, interval=0, stdout=out)
+        self.assertIn("Delivered 250 of 250 messages", out.getvalue())
+        self.assertIn("Latency ms: p50", out.getvalue())
+
+
+class DashboardFragmentTests(NPIWorkflowTestCase):
+    def setUp(self):
+        super().setUp()
+        self.url = reverse('test_requests:coach_dashboard')
+
+    def _tvf_queries(self, url):
+        with CaptureQueriesContext(connection) as ctx:
+            response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        return response, [q for q in ctx.captured_queries if 'test_requests_testrequest' in q['sql']]
+
+    def test_cached_fragments_skip_the_bucket_query(self):
+        tvf = _make_tvf(self.user, *self.reference, tvf_name='Cached TVF')
+        response, queries = self._tvf_queries(self.url)
+        self.assertEqual(len(queries), 1)
+        self.assertContains(response, 'Cached TVF')
+
+        response, queries = self._tvf_queries(self.url)
+        self.assertEqual(queries, [])
+        self.assertContains(response, f'data-tvf="{tvf.pk}"')
+        # The shared fragment carries this user's CSRF token, never the placeholder
+        self.assertNotContains(response, fragments.CSRF_PLACEHOLDER)
+        self.assertContains(response, 'name="csrfmiddlewaretoken"')
+
+        # Still a working form: the cached DP Done button moves the TVF
+        csrf_client = self.client_class(enforce_csrf_checks=True)
+        csrf_client.force_login(self.user)
+        page = csrf_client.get(self.url).content.decode()
+        form_token = page.split('name="csrfmiddlewaretoken" value="', 1)[1].split('"', 1)[0]
+        response = csrf_client.post(
+            reverse('test_requests:npi_update_tvf', args=[tvf.pk]), {'action': 'dp_done', 'csrfmiddlewaretoken': form_token}
+        )
+        self.assertEqual(response.status_code, 302)
+        tvf.refresh_from_db()
+        self.assertEqual(tvf.queue, TVFQueue.DP_DONE)
+
+    def test_moves_only_invalidate_the_buckets_they_touch(self):
+        tvf = _make_tvf(self.user, *self.reference)
+        self.client.get(self.url)
+        names = ['npi_released_tvfs', 'npi_dp_done_tvfs', 'npi_processed_tvfs']
+        before = {name: get_version(bucket_version_name(name)) for name in names}
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.assertTrue(perform_transition(self.request, tvf, 'dp_done', comments='done'))
+        after = {name: get_version(bucket_version_name(name)) for name in names}
+        self.assertNotEqual(before['npi_released_tvfs'], after['npi_released_tvfs'])
+        self.assertNotEqual(before['npi_dp_done_tvfs'], after['npi_dp_done_tvfs'])
+        self.assertEqual(before['npi_processed_tvfs'], after['npi_processed_tvfs'])
+
+        response = self.client.get(reverse('test_requests:dashboard_fragment', args=['npi', 'npi_dp_done_tvfs']))
+        self.assertContains(response, f'data-tvf="{tvf.pk}"')
+        response = self.client.get(reverse('test_requests:dashboard_fragment', args=['npi', 'npi_released_tvfs']))
+        self.assertNotContains(response, f'data-tvf="{tvf.pk}"')
+
+        # An edit that keeps the TVF in its bucket still refreshes it
+        tvf.refresh_from_db()
+        tvf.tvf_name = 'Renamed TVF'
+        tvf.save()
+        response = self.client.get(reverse('test_requests:dashboard_fragment', args=['npi', 'npi_dp_done_tvfs']))
+        self.assertContains(response, 'Renamed TVF')
+
+    def test_fragment_endpoints(self):
+        self.assertEqual(self.client.get(reverse('test_requests:dashboard_fragment', args=['npi', 'npi_processed_tvfs'])).status_code, 200)
+        # Sections the user's roles do not show, and buckets outside the section
+        self.assertEqual(self.client.get(reverse('test_requests:dashboard_fragment', args=['coach', 'npi_processed_tvfs'])).status_code, 404)
+        self.assertEqual(self.client.get(reverse('test_requests:dashboard_fragment', args=['npi', 'quality_open_tvfs'])).status_code, 404)
+
+        _make_tvf(self.user, *self.reference)
+        self.user.groups.add(Group.objects.create(name=ROLE_COACH))
+        response = self.client.get(reverse('test_requests:dashboard_counts_fragment'))
+        self.assertContains(response, '<td>Bank</td>', html=False)
+
+    def test_own_buckets_are_cached_per_user(self):
+        pm_group = Group.objects.create(name=ROLE_PROJECT_MANAGER)
+        first, second = User.objects.create_user('pm1', password='pw'), User.objects.create_user('pm2', password='pw')
+        for user in (first, second):
+            user.groups.add(pm_group)
+        _make_tvf(first, *self.reference, tvf_name='First draft', status='Draft', phase='PM_DRAFT')
+
+        self.client.force_login(first)
+        self.assertContains(self.client.get(self.url), 'First draft')
+        self.client.force_login(second)
+        self.assertNotContains(self.client.get(self.url), 'First draft')
+
+    def test_fragment_expires_when_a_tvf_changes_sla_colour(self):
+        now = timezone.now()
+        rows = [
+            {'request_ship_date': now + fragments.SLA_AT_RISK_WINDOW + timezone.timedelta(minutes=5)}, # At risk in 5 minutes
+            {'request_ship_date': now - timezone.timedelta(hours=1)}, # Already breached
+            {'request_ship_date': None},
+        ]
+        self.assertEqual(fragments._timeout(rows, now), 5 * 60)
+        self.assertEqual(fragments._timeout(rows[1:], now), fragments.fragment_timeout())
+
+
+class GroupingTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create_user('npi', password='pw')
+        self.user.groups.add(Group.objects.create(name=ROLE_NPI))
+        self.client.force_login(self.user)
+        self.reference = _make_reference_data()
+        _make_tvf(self.user, *self.reference, tvf_name='Released 1')
+        _make_tvf(self.user, *self.reference, tvf_name='Done', status='DP Done', phase='TVF_DP_DONE')
+        _make_tvf(self.user, *self.reference, tvf_name='Released 2')
+        _make_tvf(self.user, *self.reference, tvf_name='Done 2', status='DP Done', phase='TVF_DP_DONE')
+        registry.phase_names() # Load the registry
+
+    def _summary(self, groups):
+        return [(group['label'], [tvf['tvf_name'] if isinstance(tvf, dict) else tvf.tvf_name for tvf in group['tvfs']]) for group in groups]
+
+    def test_groups_fetched_tvfs_without_queries(self):
+        tvfs = list(TestRequest.objects.order_by('pk'))
+        with self.assertNumQueries(0):
+            by_phase = group_tvfs(tvfs, 'phase')
+            by_status = group_tvfs(tvfs, 'status')
+            by_queue = group_tvfs(tvfs, 'queue')
+        self.assertEqual(self._summary(by_phase), [
+            ('TVF_RELEASED', ['Released 1', 'Released 2']), ('TVF_DP_DONE', ['Done', 'Done 2']),
+        ])
+        self.assertEqual(self._summary(by_status), [
+            ('TVF_SUBMITTED', ['Released 1', 'Released 2']), ('DP Done', ['Done', 'Done 2']),
+        ])
+        self.assertEqual([group['key'] for group in by_queue], [TVFQueue.RELEASED, TVFQueue.DP_DONE])
+        self.assertEqual(by_queue[0]['label'], 'Released to NPI')
+
+        # Dashboard rows carry the names already; a TVF without a phase gets its own group
+        tvfs[0].current_phase_id = None
+        rows = [{'tvf_name': 'Row', 'phase_name': 'TVF_DP_DONE'}]
+        with self.assertNumQueries(0):
+            self.assertEqual(self._summary(group_tvfs(rows, 'phase')), [('TVF_DP_DONE', ['Row'])])
+            self.assertEqual(group_tvfs(tvfs, 'phase')[0]['label'], 'None')
+        with self.assertRaises(ValueError):
+            group_tvfs(tvfs, 'customer')
+
+    def test_template_tag_iterates_precomputed_groups(self):
+        template = Template(
+            "{% load custom_filters %}{% group_tvfs tvfs 'status' as groups %}"
+            "{% for group in groups %}{{ group.label }}={% for tvf in group.tvfs %}{{ tvf.tvf_name }},{% endfor %};{% endfor %}"
+        )
+        tvfs = list(TestRequest.objects.order_by('pk'))
+        with self.assertNumQueries(0):
+            rendered = template.render(Context({'tvfs': tvfs}))
+        self.assertEqual(rendered, "TVF_SUBMITTED=Released 1,Released 2,;DP Done=Done,Done 2,;")
+
+    def test_list_view_groups_without_extra_queries(self):
+        url = reverse('test_requests:list')
+        self.client.get(url) # Warm the session and registry
+        with CaptureQueriesContext(connection) as flat:
+            self.client.get(url, {'sort': 'number'})
+        with CaptureQueriesContext(connection) as grouped:
+            response = self.client.get(url, {'sort': 'number', 'group': 'phase'})
+        self.assertEqual(len(grouped.captured_queries), len(flat.captured_queries))
+        self.assertEqual(self._summary(response.context['groups']), [
+            ('TVF_RELEASED', ['Released 1', 'Released 2']), ('TVF_DP_DONE', ['Done', 'Done 2']),
+        ])
+        self.assertContains(response, 'TVF_DP_DONE <span class="badge bg-secondary">2</span>', html=False)
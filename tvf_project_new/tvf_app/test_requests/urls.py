@@ -11,13 +11,29 @@ urlpatterns = [
     path('<int:pk>/', views.test_request_detail_view, name='detail'),
     path('<int:pk>/edit/', views.test_request_update_view, name='update'),
     path('<int:pk>/pdf/', views.test_request_pdf_view, name='pdf'),
+    path('pdf_jobs/<int:job_id>/', views.pdf_job_status_view, name='pdf_job_status'),
+    path('pdf_jobs/<int:job_id>/download/', views.pdf_job_download_view, name='pdf_job_download'),
+    path('<int:pk>/import_input_files/', views.import_input_files_view, name='import_input_files'),
+    path('input_files/<int:input_file_id>/import_pans/', views.import_pans_view, name='import_pans'),
+    path('export/pdfs/', views.bulk_pdf_export_view, name='bulk_pdf_export'),
     path('dashboard/', views.coach_dashboard, name='coach_dashboard'),
+    path('dashboard/counts/', views.queue_counts_data, name='queue_counts'),
+    path('dashboard/events/', views.dashboard_events_view, name='dashboard_events'),
+    path('dashboard/fragments/counts/', views.dashboard_counts_fragment_view, name='dashboard_counts_fragment'),
+    path('dashboard/fragments/<slug:section>/<slug:bucket>/', views.dashboard_fragment_view, name='dashboard_fragment'),
+    path('analytics/', views.cycle_time_analytics_view, name='cycle_time_analytics'),
+    path('analytics/data/', views.cycle_time_analytics_data, name='cycle_time_analytics_data'),
+    path('audit/<str:model_name>/<str:record_id>/', views.audit_history_view, name='audit_history'),
     path('tvf/create/', views.create_tvf_view, name='create_tvf'),
     path('tvf/<int:tvf_id>/npi_update/', views.npi_update_tvf_view, name='npi_update_tvf'),
     path('tvf/<int:tvf_id>/quality_update/', views.quality_update_tvf_view, name='quality_update_tvf'),
     path('tvf/<int:tvf_id>/logistics_update/', views.logistics_update_tvf_view, name='logistics_update_tvf'),
     path('tvf/<int:tvf_id>/reject/', views.reject_tvf_view, name='reject_tvf'),
+    path('tvf/<int:tvf_id>/complete/', views.mark_tvf_completed_view, name='mark_tvf_completed'),
+    path('tvf/<int:tvf_id>/cancel/', views.cancel_tvf_view, name='cancel_tvf'),
+    path('tvf/<int:tvf_id>/delete/', views.delete_tvf_view, name='delete_tvf'),
     path('access_denied/', views.access_denied_view, name='access_denied'),
+    path('ajax/form_bootstrap/', views.form_bootstrap, name='form_bootstrap'),
     path('ajax/get_filtered_projects/', views.get_filtered_projects, name='get_filtered_projects'),
     path('ajax/get_filtered_plastic_codes/', views.get_filtered_plastic_codes, name='get_filtered_plastic_codes'),
     path('ajax/get_filtered_trustport_folders/', views.get_filtered_trustport_folders, name='get_filtered_trustport_folders'),
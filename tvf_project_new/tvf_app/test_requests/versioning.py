@@ -0,0 +1,74 @@
+# tvf_app/test_requests/versioning.py
+import time
+from datetime import datetime, timezone
+
+from django.conf import settings
+from django.core import checks
+from django.core.cache import cache
+
+VERSION_KEY_PREFIX = 'tvf:version:'
+
+# Cache backends that are not shared between processes
+PROCESS_LOCAL_CACHES = (
+    'django.core.cache.backends.locmem.LocMemCache',
+    'django.core.cache.backends.dummy.DummyCache',
+)
+
+
+def _new_version():
+    # Time-based tokens never repeat after a cache flush or restart,
+    # so a stale client or session can never match a fresh version.
+    return str(time.time_ns())
+
+
+def get_version(name):
+    """
+    Returns the current version token for `name`, creating one if the cache has none.
+    """
+    return cache.get_or_set(f'{VERSION_KEY_PREFIX}{name}', _new_version, timeout=None)
+
+
+def get_versions(*names):
+    """
+    Returns a tuple of version tokens for several names using a single cache round trip.
+    """
+    keys = [f'{VERSION_KEY_PREFIX}{name}' for name in names]
+    found = cache.get_many(keys)
+    missing = {key: _new_version() for key in keys if key not in found}
+    if missing:
+        cache.set_many(missing, timeout=None)
+        found.update(missing)
+    return tuple(found[key] for key in keys)
+
+
+def bump_version(*names):
+    """
+    Invalidates everything keyed on the given names by giving each a new version token.
+    """
+    version = _new_version()
+    cache.set_many({f'{VERSION_KEY_PREFIX}{name}': version for name in names}, timeout=None)
+    return version
+
+
+def version_timestamp(version):
+    """
+    Returns the moment a version token was minted, as an aware UTC datetime.
+    """
+    return datetime.fromtimestamp(int(version) / 1e9, tz=timezone.utc)
+
+
+@checks.register(checks.Tags.caches)
+def check_shared_cache(app_configs, **kwargs):
+    """
+    Version tokens only invalidate across processes when every process reads the same cache.
+    """
+    backend = settings.CACHES.get('default', {}).get('BACKEND')
+    if backend not in PROCESS_LOCAL_CACHES:
+        return []
+    return [checks.Warning(
+        f"The default cache ({backend}) is local to each process, so version bumps made in one "
+        "process (a web worker, pdf_worker or a management command) do not invalidate the others.",
+        hint="Set the TVF_REDIS_URL environment variable, or configure another shared cache such as "
+             "PyMemcacheCache in CACHES['default'].",
+        id='test_requests.W001',
+    )]
@@ -1,19 +1,19 @@
 # tvf_app/test_requests/views.py
-from django.urls import reverse_lazy
+from django.urls import reverse, reverse_lazy
 from django.views.generic.edit import FormView
 from django.contrib import messages
 from django.shortcuts import render, redirect, get_object_or_404
 from django.db import transaction
 from django.contrib.auth.decorators import login_required, user_passes_test
-from datetime import timedelta
 from django.utils import timezone
+from django.utils.functional import SimpleLazyObject
 from django import forms
 from django.forms import formset_factory
 from django.db.models import Q
 
 # Import your models and forms
 from .models import (
-    TestRequest, Customer, Project, TVFType, TVFEnvironment, TVFStatus,
+    TestRequest, Customer, Project, TVFType, TVFEnvironment,
     PlasticCodeLookup, DispatchMethod, TestRequestPhaseDefinition,
     TestRequestPlasticCode, TestRequestInputFile, TestRequestPAN,
     TestRequestQuality, TestRequestShipping, TrustportFolder, RejectReason,
@@ -29,26 +29,39 @@ from .forms import (
     TestRequestShippingForm,
     PlasticCodeFormSet,
     InputFileFormSet,
-    PanInlineFormSet
+    PanInlineFormSet,
+    TVFListFilterForm,
+    PANImportForm,
+    InputFileManifestForm,
+    CycleTimeAnalyticsForm,
 )
-
-
-# For PDF generation
-from django.http import HttpResponse
-from django.template.loader import get_template
-from xhtml2pdf import pisa
-
-def render_to_pdf(template_src, context_dict={}):
-    template = get_template(template_src)
-    html = template.render(context_dict)
-    response = HttpResponse(content_type='application/pdf')
-    # Use 'attachment' to force download, 'inline' to display in browser
-    response['Content-Disposition'] = 'attachment; filename="test_request.pdf"' 
-    pisa_status = pisa.CreatePDF(
-        html, dest=response)
-    if pisa_status.err:
-        return HttpResponse('We had some errors <pre>' + html + '</pre>')
-    return response
+from .roles import (
+    ROLE_PROJECT_MANAGER, ROLE_NPI, ROLE_QUALITY, ROLE_LOGISTICS, ROLE_COACH,
+    DASHBOARD_ROLES, has_role, can_view_dashboard, role_required,
+)
+from .workflow import registry, perform_transition
+from .dashboard import BUCKETS, buckets_for_roles, fetch_buckets, queue_counts
+from .fragments import SECTION_BUCKETS, render_fragments, visible_fragments, visible_sections
+from . import live # Server-Sent Events for the dashboard (ASGI only)
+from django.core.handlers.asgi import ASGIRequest
+from .listing import parse_sort, date_range_filter, paginate
+from .grouping import group_tvfs
+
+
+# For PDF generation (rendered by the pdf_worker processes, see pdf.py)
+from django.http import FileResponse, Http404, HttpResponse, StreamingHttpResponse
+from .models import PDFRenderJob
+from .pdf import cached_pdf_job, enqueue_pdf_job, pdf_cache_key, pdf_filename, pdf_versions
+from .pdf_cache import pdf_cache
+from .pdf_export import MAX_EXPORT_TVFS, astream_pdf_zip, stream_pdf_zip
+from .reference_data import get_form_bootstrap, reference_data_endpoint
+from .sla import sla_due_date
+from .persistence import TVFAggregateWriter
+from .choices import get_choice_provider
+from .imports import ManifestError, import_input_file_manifest, import_pans
+from .audit import AUDITED_MODELS
+from .audit_archive import add_usernames, audit_history
+from .analytics import DEFAULT_ANALYTICS_WINDOW, HISTOGRAM_EDGES_HOURS, get_cycle_time_analytics
 
 class RegisterView(FormView):
     template_name = 'registration/register.html'
@@ -64,30 +77,11 @@ class RegisterView(FormView):
         messages.error(self.request, 'There was an error with your registration. Please check the form.')
         return super().form_invalid(form)
 
-def is_project_manager(user):
-    return user.groups.filter(name='Project Managers').exists()
-
-def is_npi_user(user):
-    return user.groups.filter(name='NPI Users').exists()
-
-def is_quality_user(user):
-    return user.groups.filter(name='Quality Users').exists()
-
-def is_logistics_user(user):
-    return user.groups.filter(name='Logistics Users').exists()
-
-def is_coach(user):
-    return user.groups.filter(name='Coaches').exists()
-
-def can_view_dashboard(user):
-    return is_project_manager(user) or is_npi_user(user) or \
-           is_quality_user(user) or is_logistics_user(user) or \
-           is_coach(user) or user.is_superuser
-
 # --- AJAX Views for Dynamic Dropdowns ---
 from django.http import JsonResponse
 
 @login_required
+@reference_data_endpoint
 def get_filtered_projects(request):
     customer_id = request.GET.get('customer_id')
     environment_id = request.GET.get('environment_id')
@@ -99,6 +93,7 @@ def get_filtered_projects(request):
     return JsonResponse({'projects': projects})
 
 @login_required
+@reference_data_endpoint
 def get_filtered_plastic_codes(request):
     customer_id = request.GET.get('customer_id')
     project_id = request.GET.get('project_id')
@@ -114,6 +109,7 @@ def get_filtered_plastic_codes(request):
     return JsonResponse({'plastic_codes': plastic_codes})
 
 @login_required
+@reference_data_endpoint
 def get_filtered_trustport_folders(request):
     customer_id = request.GET.get('customer_id')
     project_id = request.GET.get('project_id')
@@ -125,6 +121,7 @@ def get_filtered_trustport_folders(request):
     return JsonResponse({'folders': folders})
 
 @login_required
+@reference_data_endpoint
 def get_filtered_dispatch_methods(request):
     customer_id = request.GET.get('customer_id')
     project_id = request.GET.get('project_id')
@@ -140,6 +137,14 @@ def get_filtered_dispatch_methods(request):
         ).values('id', 'name').order_by('name'))
     return JsonResponse({'methods': methods})
 
+@login_required
+@reference_data_endpoint
+def form_bootstrap(request):
+    """
+    Everything the TVF create form's dropdowns and ship date need, in one cacheable document.
+    """
+    return JsonResponse(get_form_bootstrap())
+
 @login_required
 def get_sla_and_calculate_ship_date(request):
     received_date_str = request.GET.get('received_date')
@@ -152,7 +157,8 @@ def get_sla_and_calculate_ship_date(request):
             customer = Customer.objects.get(pk=customer_id)
             sla_days = customer.sla_days
 
-            calculated_ship_date = received_date + timedelta(days=sla_days)
+            # SLA days are business days (weekends and Holiday rows are skipped)
+            calculated_ship_date = sla_due_date(received_date, sla_days)
             ship_date = calculated_ship_date.isoformat(timespec='minutes')
         except (ValueError, Customer.DoesNotExist) as e:
             print(f"Error calculating ship date: {e}")
@@ -163,161 +169,164 @@ def get_sla_and_calculate_ship_date(request):
 
 # --- Coach View: Dashboard for all roles ---
 @login_required
-@user_passes_test(can_view_dashboard, login_url='test_requests:access_denied')
+@role_required(*DASHBOARD_ROLES, allow_superuser=True)
 def coach_dashboard(request):
-    # Define common statuses and phases
-    # Phases
-    pm_draft_phase_name = 'PM_DRAFT'
-    project_manager_phase_name = 'PROJECT_MANAGER' # From user's DB dump ID 18
-    tvf_released_phase_name = 'TVF_RELEASED'
-    tvf_dp_done_phase_name = 'TVF_DP_DONE'
-    tvf_processed_at_npi_phase_name = 'TVF_PROCESSED_AT_NPI'
-    tvf_open_at_qa_phase_name = 'TVF_OPEN_AT_QA'
-    tvf_validated_at_qa_phase_name = 'TVF_VALIDATED_AT_QA'
-    tvf_open_at_logistics_phase_name = 'TVF_OPEN_AT_LOGISTICS'
-    tvf_shipped_phase_name = 'TVF_SHIPPED' 
-    tvf_completed_phase_name = 'TVF_COMPLETED' # Use phase name for completed
-    tvf_cancelled_phase_name = 'TVF_CANCELLED' # Use phase name for cancelled
-
-    rework_at_pm_phase_name = 'REWORK_AT_PM'
-    rework_at_prod_phase_name = 'REWORK_AT_PROD' 
-    rework_at_logistics_phase_name = 'REWORK_AT_LOGISTICS'
-    rework_at_qa_phase_name = 'REWORK_AT_QA'
-
-    # Statuses
-    status_draft = 'Draft'
-    status_submitted = 'TVF_SUBMITTED'
-    status_dp_done = 'DP Done'
-    status_tvf_processed = 'TVF Processed'
-    status_open_at_qa = 'Open at QA'
-    status_validated = 'Validated'
-    status_open_at_logistics = 'Open at Logistics'
-    status_shipped = 'Shipped'
-    status_completed = 'Completed'
-    status_cancelled = 'Cancelled'
-    status_rejected_pm = 'Rejected to PM'
-    status_rejected_npi = 'Rejected to NPI'
-    status_rejected_quality = 'Rejected to Quality'
-    status_rejected_logistics = 'Rejected to Logistics'
-
-
-    # Initialize all TVF lists as empty
-    pm_draft_tvfs = TestRequest.objects.none()
-    pm_submitted_tvfs = TestRequest.objects.none()
-    npi_released_tvfs = TestRequest.objects.none()
-    npi_dp_done_tvfs = TestRequest.objects.none()
-    npi_processed_tvfs = TestRequest.objects.none()
-    quality_open_tvfs = TestRequest.objects.none()
-    quality_validated_tvfs = TestRequest.objects.none()
-    logistics_open_tvfs = TestRequest.objects.none()
-    
-    # For Coach/Superuser only
-    all_display_tvfs = TestRequest.objects.none()
-    completed_tvfs_list = TestRequest.objects.none()
-
-
-    # Role-based filtering of TVFs
-    if is_project_manager(request.user):
-        user_tvfs = TestRequest.objects.filter(tvf_initiator=request.user)
-        pm_draft_tvfs = user_tvfs.filter(status__name=status_draft, current_phase__name=pm_draft_phase_name)
-        
-        pm_submitted_tvfs = TestRequest.objects.filter(
-            Q(tvf_initiator=request.user, current_phase__name=tvf_released_phase_name, status__name=status_submitted) | 
-            Q(current_phase__name=project_manager_phase_name, status__name=status_rejected_pm, is_rejected=True) | 
-            Q(current_phase__name=rework_at_pm_phase_name, status__name=status_rejected_pm, is_rejected=True) 
-        ).order_by('-request_received_date')
-        
-    elif is_npi_user(request.user):
-        npi_released_tvfs = TestRequest.objects.filter(
-            Q(current_phase__name=tvf_released_phase_name, status__name=status_submitted) |
-            Q(current_phase__name=rework_at_prod_phase_name, status__name=status_rejected_npi, is_rejected=True)
-        ).order_by('-request_received_date')
-
-        npi_dp_done_tvfs = TestRequest.objects.filter(current_phase__name=tvf_dp_done_phase_name, status__name=status_dp_done).order_by('-request_received_date')
-        npi_processed_tvfs = TestRequest.objects.filter(current_phase__name=tvf_processed_at_npi_phase_name, status__name=status_tvf_processed).order_by('-request_received_date')
-        
-    elif is_quality_user(request.user):
-        quality_open_tvfs = TestRequest.objects.filter(
-            Q(current_phase__name=tvf_open_at_qa_phase_name, status__name=status_open_at_qa) |
-            Q(current_phase__name=rework_at_qa_phase_name, status__name=status_rejected_quality, is_rejected=True)
-        ).order_by('-request_received_date')
-
-        quality_validated_tvfs = TestRequest.objects.filter(current_phase__name=tvf_validated_at_qa_phase_name, status__name=status_validated).order_by('-request_received_date')
-        
-    elif is_logistics_user(request.user):
-        logistics_open_tvfs = TestRequest.objects.filter(
-            Q(current_phase__name=tvf_open_at_logistics_phase_name, status__name=status_open_at_logistics) |
-            Q(current_phase__name=rework_at_logistics_phase_name, status__name=status_rejected_logistics, is_rejected=True)
-        ).order_by('-request_received_date')
-        
-    elif is_coach(request.user) or request.user.is_superuser:
-        # Coaches/Superusers main display: All TVFs not yet completed or cancelled
-        all_display_tvfs = TestRequest.objects.select_related(
-            'customer', 'project', 'tvf_initiator', 'status', 'current_phase'
-        ).exclude(
-            Q(current_phase__name=tvf_completed_phase_name) | Q(current_phase__name=tvf_cancelled_phase_name)
-        ).order_by('-request_received_date')
-
-        # Also get completed TVFs for the separate "View Completed TVFs" list
-        completed_tvfs_list = TestRequest.objects.select_related(
-            'customer', 'project', 'tvf_initiator', 'status', 'current_phase'
-        ).filter(
-            Q(current_phase__name=tvf_completed_phase_name) | Q(current_phase__name=tvf_shipped_phase_name) | Q(current_phase__name=tvf_cancelled_phase_name)
-        ).order_by('-tvf_completed_date') # Order by completion date
+    # Role flags come from the request's role set, resolved once per request
+    is_project_manager = ROLE_PROJECT_MANAGER in request.roles
+    is_npi_user = ROLE_NPI in request.roles
+    is_quality_user = ROLE_QUALITY in request.roles
+    is_logistics_user = ROLE_LOGISTICS in request.roles
+    is_coach = ROLE_COACH in request.roles
+
+    # Each bucket the roles see is a fragment cached under the bucket's version (see fragments.py);
+    # the buckets whose fragment is not cached come from one query on TestRequest.queue
+    fragments = render_fragments(request, visible_fragments(request.roles, request.user.is_superuser))
+
+    # The bucket rows stay available to the template, but are only fetched (in one query) if it uses them;
+    # buckets the roles do not see stay empty
+    bucket_names = sorted({bucket for section_fragments in fragments.values() for bucket in section_fragments})
+    rows = SimpleLazyObject(lambda: {**{name: [] for name in BUCKETS}, **fetch_buckets(bucket_names, request.user)})
+    buckets = {name: SimpleLazyObject(lambda name=name: rows[name]) for name in BUCKETS}
 
     # Phase lists for button conditions (used in tables for coach)
-    npi_phases_for_button = [tvf_released_phase_name, tvf_dp_done_phase_name, tvf_processed_at_npi_phase_name, rework_at_prod_phase_name]
-    quality_phases_for_button = [tvf_open_at_qa_phase_name, tvf_validated_at_qa_phase_name, rework_at_qa_phase_name]
-    logistics_phases_for_button = [tvf_open_at_logistics_phase_name, rework_at_logistics_phase_name]
+    npi_phases_for_button = ['TVF_RELEASED', 'TVF_DP_DONE', 'TVF_PROCESSED_AT_NPI', 'REWORK_AT_PROD']
+    quality_phases_for_button = ['TVF_OPEN_AT_QA', 'TVF_VALIDATED_AT_QA', 'REWORK_AT_QA']
+    logistics_phases_for_button = ['TVF_OPEN_AT_LOGISTICS', 'REWORK_AT_LOGISTICS']
 
     context = {
         'role': 'Coach Dashboard',
-        'is_project_manager': is_project_manager(request.user),
-        'is_npi_user': is_npi_user(request.user),
-        'is_quality_user': is_quality_user(request.user),
-        'is_logistics_user': is_logistics_user(request.user),
-        'is_coach': is_coach(request.user),
+        'is_project_manager': is_project_manager,
+        'is_npi_user': is_npi_user,
+        'is_quality_user': is_quality_user,
+        'is_logistics_user': is_logistics_user,
+        'is_coach': is_coach,
         'is_superuser': request.user.is_superuser,
 
-        # For Coach/Superuser: main display list and completed list
-        'all_display_tvfs': all_display_tvfs, 
-        'completed_tvfs_list': completed_tvfs_list, 
-
-        # PM specific lists (empty if not PM)
-        'pm_draft_tvfs': pm_draft_tvfs,
-        'pm_submitted_tvfs': pm_submitted_tvfs, 
-        
-        # NPI specific lists (empty if not NPI)
-        'npi_released_tvfs': npi_released_tvfs,
-        'npi_dp_done_tvfs': npi_dp_done_tvfs,
-        'npi_processed_tvfs': npi_processed_tvfs,
-        
-        # Quality specific lists (empty if not Quality)
-        'quality_open_tvfs': quality_open_tvfs,
-        'quality_validated_tvfs': quality_validated_tvfs,
-
-        # Logistics specific lists (empty if not Logistics)
-        'logistics_open_tvfs': logistics_open_tvfs,
+        # Rendered bucket tables, by section then bucket
+        'fragments': fragments,
+        # Bucket lists: pm_draft_tvfs, pm_submitted_tvfs, npi_released_tvfs, npi_dp_done_tvfs,
+        # npi_processed_tvfs, quality_open_tvfs, quality_validated_tvfs, logistics_open_tvfs
+        **buckets,
 
         # Coach specific lists (empty if not Coach/Superuser)
-        # These categorized lists are now unused for Coach/Superuser as all_display_tvfs is the main list
-        'other_open_tvfs': TestRequest.objects.none(), 
-        'npi_released_tvfs_coach': TestRequest.objects.none(), 
-        'npi_dp_done_tvfs_coach': TestRequest.objects.none(), 
-        'npi_processed_tvfs_coach': TestRequest.objects.none(), 
-        'quality_open_tvfs_coach': TestRequest.objects.none(), 
-        'quality_validated_tvfs_coach': TestRequest.objects.none(), 
-        'logistics_open_tvfs_coach': TestRequest.objects.none(),
-        'pm_submitted_tvfs_coach': TestRequest.objects.none(), # Also unused now
+        # The coach tables reuse the NPI/Quality/Logistics buckets above
+        'other_open_tvfs': [],
+        'npi_phases_for_button': npi_phases_for_button,
+        'quality_phases_for_button': quality_phases_for_button,
+        'logistics_phases_for_button': logistics_phases_for_button,
+
+        # Header counts, read from the queue counters rather than counting TVFs
+        'queue_counts': queue_counts(),
     }
     return render(request, 'test_requests/coach_dashboard.html', context)
 
 
+# --- Dashboard fragments (refreshed on their own by the live dashboard) ---
+@login_required
+@role_required(*DASHBOARD_ROLES, allow_superuser=True)
+def dashboard_fragment_view(request, section, bucket):
+    if section not in visible_sections(request.roles, request.user.is_superuser) or bucket not in SECTION_BUCKETS[section]:
+        raise Http404("No such dashboard fragment.")
+    return HttpResponse(render_fragments(request, [(section, bucket)])[section][bucket])
+
+
+@login_required
+@role_required(*DASHBOARD_ROLES, allow_superuser=True)
+def dashboard_counts_fragment_view(request):
+    return render(request, 'test_requests/dashboard/queue_counts.html', {
+        'is_coach': ROLE_COACH in request.roles,
+        'is_superuser': request.user.is_superuser,
+        'queue_counts': queue_counts(),
+    })
+
+
+# --- Queue counts (dashboard header) ---
+@login_required
+@role_required(*DASHBOARD_ROLES, allow_superuser=True)
+def queue_counts_data(request):
+    return JsonResponse(queue_counts())
+
+
+# --- Live dashboard updates (Server-Sent Events) ---
+@login_required
+@role_required(*DASHBOARD_ROLES, allow_superuser=True)
+def dashboard_events_view(request):
+    """
+    Streams queue moves to the dashboard as they commit (see live.py). Only served by the ASGI
+    application: under WSGI a stream would hold a worker thread for as long as the page is open,
+    so it answers 204, which tells the browser to stop reconnecting.
+    """
+    if not isinstance(request, ASGIRequest):
+        return HttpResponse(status=204)
+    response = StreamingHttpResponse(live.event_stream(live.get_broadcaster()), content_type='text/event-stream')
+    response['Cache-Control'] = 'no-cache'
+    response['X-Accel-Buffering'] = 'no' # Stop nginx buffering the stream
+    return response
+
+
+# --- Coach: Cycle-Time Analytics ---
+def _cycle_time_analytics(request):
+    """
+    The analytics for the window and dimension chosen in the query string (invalid choices fall back to the defaults).
+    """
+    form = CycleTimeAnalyticsForm(request.GET)
+    days, dimension = DEFAULT_ANALYTICS_WINDOW, None
+    if form.is_valid():
+        days = form.cleaned_data['days'] or DEFAULT_ANALYTICS_WINDOW
+        dimension = form.cleaned_data['by'] or None
+    return form, get_cycle_time_analytics(days, dimension)
+
+
+@login_required
+@role_required(ROLE_COACH, allow_superuser=True)
+def cycle_time_analytics_view(request):
+    form, analytics = _cycle_time_analytics(request)
+    return render(request, 'test_requests/cycle_time_analytics.html', {
+        'role': 'Cycle-Time Analytics',
+        'form': form,
+        'analytics': analytics,
+        'histogram_labels': [f"{start}-{end}h" for start, end in zip(HISTOGRAM_EDGES_HOURS, HISTOGRAM_EDGES_HOURS[1:])]
+                            + [f"{HISTOGRAM_EDGES_HOURS[-1]}h+"],
+        'data_url': reverse('test_requests:cycle_time_analytics_data') + ('?' + request.GET.urlencode() if request.GET else ''),
+    })
+
+
+@login_required
+@role_required(ROLE_COACH, allow_superuser=True)
+def cycle_time_analytics_data(request):
+    return JsonResponse(_cycle_time_analytics(request)[1])
+
+
+# --- Coach: audit history (table and archive) ---
+AUDIT_HISTORY_DEFAULT_LIMIT = 200
+AUDIT_HISTORY_MAX_LIMIT = 1000
+
+
+@login_required
+@role_required(ROLE_COACH, allow_superuser=True)
+def audit_history_view(request, model_name, record_id):
+    if model_name not in {model._meta.model_name for model in AUDITED_MODELS}:
+        raise Http404("No audit history for that model.")
+    try:
+        limit = int(request.GET.get('limit', AUDIT_HISTORY_DEFAULT_LIMIT))
+    except ValueError:
+        limit = AUDIT_HISTORY_DEFAULT_LIMIT
+    limit = max(1, min(limit, AUDIT_HISTORY_MAX_LIMIT))
+    entries = add_usernames(audit_history(model_name, record_id, limit=limit))
+    return JsonResponse({
+        'model_name': model_name,
+        'record_id': record_id,
+        'entries': [
+            {**entry, 'timestamp': entry['timestamp'].isoformat()} for entry in entries
+        ],
+    })
+
+
 # --- Coach Action: Mark TVF as Completed ---
 @login_required
-@user_passes_test(lambda u: is_coach(u) or u.is_superuser, login_url='test_requests:access_denied')
+@role_required(ROLE_COACH, allow_superuser=True)
 def mark_tvf_completed_view(request, tvf_id):
-    tvf = get_object_or_404(TestRequest, pk=tvf_id)
+    tvf = get_object_or_404(TestRequest.objects.select_related('status', 'current_phase'), pk=tvf_id)
 
     # Only allow marking as completed if it's currently in 'Shipped' status/phase
     if tvf.current_phase.name != 'TVF_SHIPPED' or tvf.status.name != 'Shipped':
@@ -328,15 +337,11 @@ def mark_tvf_completed_view(request, tvf_id):
         comments_input = request.POST.get('comments', '').strip()
         
         try:
-            with transaction.atomic():
-                tvf.status, _ = TVFStatus.objects.get_or_create(name='Completed')
-                tvf.current_phase, _ = TestRequestPhaseDefinition.objects.get_or_create(name='TVF_COMPLETED', defaults={'order': 8})
-                tvf.tvf_completed_date = timezone.now()
-                # Append completion comments
-                current_comments = tvf.comments if tvf.comments else ""
-                tvf.comments = f"{current_comments}\n\nCOMPLETED by {request.user.username}: {comments_input}"
-                tvf.save()
+            # Appends the completion comments and moves the TVF in one UPDATE
+            if perform_transition(request, tvf, 'complete', comments=comments_input):
                 messages.success(request, f"TVF {tvf.tvf_number} marked as Completed.")
+            else:
+                messages.error(request, f"TVF {tvf.tvf_number} is no longer in 'Shipped' status/phase.")
         except Exception as e:
             messages.error(request, f"Error marking TVF as completed: {e}")
         return redirect('test_requests:coach_dashboard')
@@ -367,9 +372,9 @@ def delete_tvf_view(request, tvf_id):
 
 # --- Coach Action: Cancel TVF ---
 @login_required
-@user_passes_test(lambda u: is_coach(u) or u.is_superuser, login_url='test_requests:access_denied')
+@role_required(ROLE_COACH, allow_superuser=True)
 def cancel_tvf_view(request, tvf_id):
-    tvf = get_object_or_404(TestRequest, pk=tvf_id)
+    tvf = get_object_or_404(TestRequest.objects.select_related('status', 'current_phase'), pk=tvf_id)
 
     # Prevent cancelling already completed/shipped/cancelled TVFs
     if tvf.status.name in ['Completed', 'Shipped', 'Cancelled']: # Check status names
@@ -380,16 +385,11 @@ def cancel_tvf_view(request, tvf_id):
         comments_input = request.POST.get('comments', '').strip()
 
         try:
-            with transaction.atomic():
-                tvf.status, _ = TVFStatus.objects.get_or_create(name='Cancelled') # Set status to 'Cancelled'
-                tvf.current_phase, _ = TestRequestPhaseDefinition.objects.get_or_create(name='TVF_CANCELLED', defaults={'order': 9})
-                tvf.is_rejected = False # Clear rejected status if it was
-                # Append cancellation comments
-                current_comments = tvf.comments if tvf.comments else ""
-                tvf.comments = f"{current_comments}\n\nCANCELLED by {request.user.username}: {comments_input}"
-                tvf.tvf_completed_date = timezone.now() # Mark as completed for archiving purposes
-                tvf.save()
+            # Clears the rejected flag, appends the comments and stamps tvf_completed_date in one UPDATE
+            if perform_transition(request, tvf, 'cancel', comments=comments_input):
                 messages.success(request, f"TVF {tvf.tvf_number} has been cancelled.")
+            else:
+                messages.error(request, f"TVF {tvf.tvf_number} cannot be cancelled as it is already in a final state.")
         except Exception as e:
             messages.error(request, f"Error cancelling TVF: {e}")
         return redirect('test_requests:coach_dashboard')
@@ -402,6 +402,8 @@ def cancel_tvf_view(request, tvf_id):
 @login_required
 # Removed @user_passes_test(is_project_manager, login_url='test_requests:access_denied')
 def create_tvf_view(request):
+    # Choice lists shared by every form and formset row on the page
+    choices = get_choice_provider(request)
     if request.method == 'POST':
         form = TestRequestForm(request.POST)
         customer_id = None
@@ -420,11 +422,11 @@ def create_tvf_view(request):
 
         # Pass customer_id and project_id to the PlasticCodeFormSet
         plastic_formset = PlasticCodeFormSet(request.POST, prefix='plastic_codes',
-                                             form_kwargs={'customer_id': customer_id, 'project_id': project_id})
+                                             form_kwargs={'customer_id': customer_id, 'project_id': project_id, 'choices': choices})
 
         # Initialize InputFileFormSet with POST data
         input_file_formset = InputFileFormSet(request.POST, prefix='input_files')
-        shipping_form = TestRequestShippingForm(request.POST, prefix='shipping')
+        shipping_form = TestRequestShippingForm(request.POST, prefix='shipping', choices=choices)
 
         # Validate main form and primary formsets first
         main_form_is_valid = form.is_valid()
@@ -476,45 +478,21 @@ def create_tvf_view(request):
                     
                     action = request.POST.get('action')
                     if action == 'submit':
-                        initial_status, _ = TVFStatus.objects.get_or_create(name='TVF_SUBMITTED')
-                        released_to_npi_phase, _ = TestRequestPhaseDefinition.objects.get_or_create(name='TVF_RELEASED', defaults={'order': 2})
-                        test_request.status = initial_status
-                        test_request.current_phase = released_to_npi_phase
+                        test_request.status_id = registry.status_id('TVF_SUBMITTED')
+                        test_request.current_phase_id = registry.phase_id('TVF_RELEASED', order=2)
                     else: # 'save_draft'
-                        draft_status, _ = TVFStatus.objects.get_or_create(name='Draft')
+                        test_request.status_id = registry.status_id('Draft')
                         # New: PM_DRAFT phase for drafts, order 0
-                        pm_draft_phase, _ = TestRequestPhaseDefinition.objects.get_or_create(name='PM_DRAFT', defaults={'order': 0})
-                        test_request.status = draft_status
-                        test_request.current_phase = pm_draft_phase
+                        test_request.current_phase_id = registry.phase_id('PM_DRAFT', order=0)
                     
                     test_request.save()
 
-                    plastic_formset.instance = test_request
-                    plastic_formset.save()
-
-                    for i, input_file_form in enumerate(input_file_formset.forms):
-                        if input_file_form.cleaned_data.get('DELETE'):
-                            if input_file_form.instance.pk:
-                                input_file_form.instance.delete()
-                            continue
-                        
-                        if input_file_form.has_changed() or (not input_file_form.instance.pk and any(input_file_form.cleaned_data.values())):
-                            input_file_instance = input_file_form.save(commit=False)
-                            input_file_instance.test_request = test_request
-                            input_file_instance.save()
-
-                            if i < len(processed_pans_formsets):
-                                pan_fs_to_save = processed_pans_formsets[i]
-                                for pan_form_instance in pan_fs_to_save.forms:
-                                    if pan_form_instance.cleaned_data.get('DELETE'):
-                                        if pan_form_instance.instance.pk:
-                                            pan_form_instance.instance.delete()
-                                        continue
-                                    if pan_form_instance.has_changed() or (not pan_form_instance.instance.pk and any(pan_form_instance.cleaned_data.values())):
-                                        pan_item = pan_form_instance.save(commit=False)
-                                        pan_item.test_request_input_file = input_file_instance
-                                        pan_item.save()
-                    
+                    # Plastic codes, input files and PANs are written in a few batched statements
+                    writer = TVFAggregateWriter(test_request)
+                    writer.add_plastic_code_formset(plastic_formset)
+                    writer.add_input_file_formset(input_file_formset, processed_pans_formsets)
+                    writer.save()
+
                     shipping = shipping_form.save(commit=False)
                     shipping.test_request = test_request
                     shipping.save()
@@ -536,9 +514,9 @@ def create_tvf_view(request):
 
     else:
         form = TestRequestForm(initial={'tvf_initiator': request.user, 'request_received_date': timezone.now().strftime('%Y-%m-%dT%H:%M')})
-        plastic_formset = PlasticCodeFormSet(prefix='plastic_codes')
+        plastic_formset = PlasticCodeFormSet(prefix='plastic_codes', form_kwargs={'choices': choices})
         input_file_formset = InputFileFormSet(prefix='input_files')
-        shipping_form = TestRequestShippingForm(prefix='shipping')
+        shipping_form = TestRequestShippingForm(prefix='shipping', choices=choices)
         
         processed_pans_formsets = []
         for i in range(input_file_formset.initial_form_count() + input_file_formset.extra):
@@ -556,10 +534,19 @@ def create_tvf_view(request):
     return render(request, 'test_requests/pm_create_tvf.html', context)
 
 # --- NPI View: Update Data Processing Status ---
+# Dashboard button action -> (transition, success message, message level, message for an invalid phase)
+NPI_ACTIONS = {
+    'dp_done': ('dp_done', "TVF {tvf_number} marked as DP Done.", messages.SUCCESS, "Cannot mark DP Done in the current phase."),
+    'tvf_output': ('tvf_output', "TVF {tvf_number} output processed. Ready for QA.", messages.SUCCESS, "Cannot process TVF Output in the current phase."),
+    'push_to_qa': ('push_to_qa', "TVF {tvf_number} pushed to Quality queue!", messages.SUCCESS, "Cannot push to QA in the current phase."),
+    'back_to_released': ('back_to_released', "TVF {tvf_number} moved back to Released state.", messages.INFO, "Cannot move back to Released from current phase."),
+    'back_to_dp_done': ('back_to_dp_done', "TVF {tvf_number} moved back to DP Done state.", messages.INFO, "Cannot move back to DP Done from current phase."),
+}
+
 @login_required
-@user_passes_test(is_npi_user, login_url='test_requests:access_denied')
+@role_required(ROLE_NPI)
 def npi_update_tvf_view(request, tvf_id):
-    tvf = get_object_or_404(TestRequest, pk=tvf_id)
+    tvf = get_object_or_404(TestRequest.objects.select_related('customer', 'project', 'status', 'current_phase'), pk=tvf_id)
 
     # NPI relevant phases now start with TVF_RELEASED
     npi_relevant_phases = ['TVF_RELEASED', 'TVF_DP_DONE', 'TVF_PROCESSED_AT_NPI', 'REWORK_AT_PROD'] # Include rework phase
@@ -571,65 +558,13 @@ def npi_update_tvf_view(request, tvf_id):
         action = request.POST.get('action')
         comments = request.POST.get('comments', '') 
 
-        if action == 'dp_done':
-            if tvf.current_phase.name in ['TVF_RELEASED', 'REWORK_AT_PROD']: # From TVF_RELEASED or REWORK_AT_PROD to TVF_DP_DONE
-                tvf.status, _ = TVFStatus.objects.get_or_create(name='DP Done')
-                tvf.current_phase, _ = TestRequestPhaseDefinition.objects.get_or_create(name='TVF_DP_DONE', defaults={'order': 3})
-                tvf.comments = comments
-                tvf.is_rejected = False # Clear rejected status
-                tvf.save()
-                messages.success(request, f"TVF {tvf.tvf_number} marked as DP Done.")
+        if action in NPI_ACTIONS:
+            transition, success_message, level, invalid_message = NPI_ACTIONS[action]
+            # The UPDATE only matches if the TVF is still in a valid source phase
+            if perform_transition(request, tvf, transition, comments=comments):
+                messages.add_message(request, level, success_message.format(tvf_number=tvf.tvf_number))
                 return redirect('test_requests:coach_dashboard')
-            else:
-                messages.warning(request, "Cannot mark DP Done in the current phase.")
-
-        elif action == 'tvf_output':
-            if tvf.current_phase.name == 'TVF_DP_DONE': # From TVF_DP_DONE to TVF_PROCESSED_AT_NPI
-                tvf.status, _ = TVFStatus.objects.get_or_create(name='TVF Processed')
-                tvf.current_phase, _ = TestRequestPhaseDefinition.objects.get_or_create(name='TVF_PROCESSED_AT_NPI', defaults={'order': 4})
-                tvf.comments = comments
-                tvf.is_rejected = False # Clear rejected status
-                tvf.save()
-                messages.success(request, f"TVF {tvf.tvf_number} output processed. Ready for QA.")
-                return redirect('test_requests:coach_dashboard')
-            else:
-                 messages.warning(request, "Cannot process TVF Output in the current phase.")
-
-        elif action == 'push_to_qa':
-            if tvf.current_phase.name == 'TVF_PROCESSED_AT_NPI': # From TVF_PROCESSED_AT_NPI to QA
-                tvf.status, _ = TVFStatus.objects.get_or_create(name='Open at QA')
-                tvf.current_phase, _ = TestRequestPhaseDefinition.objects.get_or_create(name='TVF_OPEN_AT_QA', defaults={'order': 5})
-                tvf.comments = comments
-                tvf.is_rejected = False # Clear rejected status
-                tvf.save()
-                messages.success(request, f"TVF {tvf.tvf_number} pushed to Quality queue!")
-                return redirect('test_requests:coach_dashboard')
-            else:
-                messages.warning(request, "Cannot push to QA in the current phase.")
-
-        elif action == 'back_to_released': # New action: Back to Released
-            if tvf.current_phase.name in ['TVF_DP_DONE', 'TVF_PROCESSED_AT_NPI'] or tvf.current_phase.name == 'REWORK_AT_PROD':
-                tvf.status, _ = TVFStatus.objects.get_or_create(name='TVF_SUBMITTED') # Revert status to submitted
-                tvf.current_phase, _ = TestRequestPhaseDefinition.objects.get_or_create(name='TVF_RELEASED', defaults={'order': 2})
-                tvf.comments = comments
-                tvf.is_rejected = False # Clear rejected status
-                tvf.save()
-                messages.info(request, f"TVF {tvf.tvf_number} moved back to Released state.")
-                return redirect('test_requests:coach_dashboard')
-            else:
-                messages.warning(request, "Cannot move back to Released from current phase.")
-
-        elif action == 'back_to_dp_done': # New action: Back to DP Done (from Processed)
-            if tvf.current_phase.name == 'TVF_PROCESSED_AT_NPI' or tvf.current_phase.name == 'REWORK_AT_PROD':
-                tvf.status, _ = TVFStatus.objects.get_or_create(name='DP Done') # Revert status
-                tvf.current_phase, _ = TestRequestPhaseDefinition.objects.get_or_create(name='TVF_DP_DONE', defaults={'order': 3})
-                tvf.comments = comments
-                tvf.is_rejected = False # Clear rejected status
-                tvf.save()
-                messages.info(request, f"TVF {tvf.tvf_number} moved back to DP Done state.")
-                return redirect('test_requests:coach_dashboard')
-            else:
-                messages.warning(request, "Cannot move back to DP Done from current phase.")
+            messages.warning(request, invalid_message)
 
         elif action == 'reject':
             return redirect('test_requests:reject_tvf', tvf_id=tvf.pk)
@@ -639,9 +574,9 @@ def npi_update_tvf_view(request, tvf_id):
 
 # --- Quality View: Update Validation Status ---
 @login_required
-@user_passes_test(is_quality_user, login_url='test_requests:access_denied')
+@role_required(ROLE_QUALITY)
 def quality_update_tvf_view(request, tvf_id):
-    tvf = get_object_or_404(TestRequest, pk=tvf_id)
+    tvf = get_object_or_404(TestRequest.objects.select_related('customer', 'project', 'status', 'current_phase'), pk=tvf_id)
 
     quality_relevant_phases = ['TVF_OPEN_AT_QA', 'TVF_VALIDATED_AT_QA', 'REWORK_AT_QA'] # Include rework phase
     if not (tvf.current_phase.name in quality_relevant_phases or (tvf.is_rejected and tvf.current_phase.name == 'REWORK_AT_QA')):
@@ -654,20 +589,17 @@ def quality_update_tvf_view(request, tvf_id):
 
         if action == 'process': # This button will now advance through QA steps
             if tvf.current_phase.name in ['TVF_OPEN_AT_QA', 'REWORK_AT_QA']: # From TVF_OPEN_AT_QA or REWORK_AT_QA to TVF_VALIDATED_AT_QA
-                tvf.status, _ = TVFStatus.objects.get_or_create(name='Validated')
-                tvf.current_phase, _ = TestRequestPhaseDefinition.objects.get_or_create(name='TVF_VALIDATED_AT_QA', defaults={'order': 6})
-                messages.success(request, f"TVF {tvf.tvf_number} marked as Validated at Quality!")
+                transition, success_message = 'qa_validate', f"TVF {tvf.tvf_number} marked as Validated at Quality!"
             elif tvf.current_phase.name == 'TVF_VALIDATED_AT_QA': # From TVF_VALIDATED_AT_QA to Logistics
-                tvf.status, _ = TVFStatus.objects.get_or_create(name='Open at Logistics')
-                tvf.current_phase, _ = TestRequestPhaseDefinition.objects.get_or_create(name='TVF_OPEN_AT_LOGISTICS', defaults={'order': 7})
-                messages.success(request, f"TVF {tvf.tvf_number} pushed to Logistics queue!")
+                transition, success_message = 'qa_to_logistics', f"TVF {tvf.tvf_number} pushed to Logistics queue!"
             else:
                 messages.warning(request, "Invalid Quality process step for this TVF's current phase.")
                 return redirect('test_requests:coach_dashboard')
-            
-            tvf.comments = comments
-            tvf.is_rejected = False
-            tvf.save()
+
+            if perform_transition(request, tvf, transition, comments=comments):
+                messages.success(request, success_message)
+            else:
+                messages.warning(request, f"TVF {tvf.tvf_number} was moved by someone else; please check its current phase.")
             return redirect('test_requests:coach_dashboard')
         
         elif action == 'reject':
@@ -678,9 +610,9 @@ def quality_update_tvf_view(request, tvf_id):
 
 # --- Logistics View: Update Shipping Status ---
 @login_required
-@user_passes_test(is_logistics_user, login_url='test_requests:access_denied')
+@role_required(ROLE_LOGISTICS)
 def logistics_update_tvf_view(request, tvf_id):
-    tvf = get_object_or_404(TestRequest, pk=tvf_id)
+    tvf = get_object_or_404(TestRequest.objects.select_related('customer', 'project', 'status', 'current_phase'), pk=tvf_id)
 
     logistics_relevant_phases = ['TVF_OPEN_AT_LOGISTICS', 'REWORK_AT_LOGISTICS'] # Include rework phase
     if not (tvf.current_phase.name in logistics_relevant_phases or (tvf.is_rejected and tvf.current_phase.name == 'REWORK_AT_LOGISTICS')):
@@ -704,17 +636,16 @@ def logistics_update_tvf_view(request, tvf_id):
 
         if action == 'process':
             if shipping_form.is_valid():
-                shipping = shipping_form.save(commit=False)
-                shipping.date_shipped = timezone.now()
-                shipping.save()
-
-                tvf.status, _ = TVFStatus.objects.get_or_create(name='Shipped')
-                tvf.current_phase, _ = TestRequestPhaseDefinition.objects.get_or_create(name='TVF_SHIPPED', defaults={'order': 14})
-                tvf.comments = comments
-                tvf.is_rejected = False
-                tvf.tvf_completed_date = timezone.now()
-                tvf.save()
-                messages.success(request, f"TVF {tvf.tvf_number} shipped by Logistics!")
+                with transaction.atomic():
+                    shipped = perform_transition(request, tvf, 'ship', comments=comments)
+                    if shipped:
+                        shipping = shipping_form.save(commit=False)
+                        shipping.date_shipped = tvf.tvf_completed_date
+                        shipping.save()
+                if shipped:
+                    messages.success(request, f"TVF {tvf.tvf_number} shipped by Logistics!")
+                else:
+                    messages.warning(request, f"TVF {tvf.tvf_number} is no longer open at Logistics.")
                 return redirect('test_requests:coach_dashboard')
             else:
                 messages.error(request, "Please correct the errors in the shipping details.")
@@ -735,11 +666,9 @@ def logistics_update_tvf_view(request, tvf_id):
 # --- Common Rejection View ---
 @login_required
 def reject_tvf_view(request, tvf_id):
-    tvf = get_object_or_404(TestRequest, pk=tvf_id)
+    tvf = get_object_or_404(TestRequest.objects.select_related('status', 'current_phase'), pk=tvf_id)
 
-    if not (is_project_manager(request.user) or is_npi_user(request.user) or
-            is_quality_user(request.user) or is_logistics_user(request.user) or
-            is_coach(request.user) or request.user.is_superuser):
+    if not can_view_dashboard(request):
         messages.error(request, "You do not have permission to reject TVFs.")
         return redirect('test_requests:coach_dashboard')
 
@@ -767,39 +696,24 @@ def reject_tvf_view(request, tvf_id):
             })
 
         try:
-            status_map = {
-                'PM_DRAFT': 'Rejected to PM',
-                'PROJECT_MANAGER': 'Rejected to PM', # Rejection to PROJECT_MANAGER phase should also set 'Rejected to PM' status
-                'REWORK_AT_PM': 'Rejected to PM', 
-                'TVF_RELEASED': 'Rejected to NPI',
-                'TVF_DP_DONE': 'Rejected to NPI',
-                'TVF_PROCESSED_AT_NPI': 'Rejected to NPI',
-                'REWORK_AT_PROD': 'Rejected to NPI', 
-                'TVF_OPEN_AT_QA': 'Rejected to Quality',
-                'TVF_VALIDATED_AT_QA': 'Rejected to Quality',
-                'REWORK_AT_QA': 'Rejected to Quality', 
-                'TVF_OPEN_AT_LOGISTICS': 'Rejected to Logistics',
-                'REWORK_AT_LOGISTICS': 'Rejected to Logistics', 
-            }
-            new_status_name = status_map.get(target_phase_name, 'Rejected') # Default to generic 'Rejected' if not mapped
-
-            target_status, _ = TVFStatus.objects.get_or_create(name=new_status_name)
-            target_phase = TestRequestPhaseDefinition.objects.get(name=target_phase_name)
-            reject_reason_obj = RejectReason.objects.get(pk=reject_reason_id)
-
-            current_comments = tvf.comments if tvf.comments else ""
-            tvf.comments = f"{current_comments}\n\nREJECTED by {request.user.username}: {rejection_comments} (To {target_phase_name})" # Added phase name to comment
-            
-            tvf.status = target_status
-            tvf.current_phase = target_phase
-            tvf.is_rejected = True
-            tvf.rejected_by = request.user
-            tvf.rejected_reason = reject_reason_obj
-            tvf.rejected_comments = rejection_comments
-            tvf.rejected_date = timezone.now()
-
-            tvf.save()
-            messages.success(request, f"TVF {tvf.tvf_number} rejected to {target_phase_name} successfully!")
+            if not RejectReason.objects.filter(pk=reject_reason_id).exists():
+                raise RejectReason.DoesNotExist
+
+            # Status comes from REJECT_STATUS_MAP; the comment notes the target phase
+            rejected = perform_transition(
+                request, tvf, 'reject',
+                comments=rejection_comments,
+                target_phase=target_phase_name,
+                is_rejected=True,
+                rejected_by_id=request.user.pk,
+                rejected_reason_id=reject_reason_id,
+                rejected_comments=rejection_comments,
+                rejected_date=timezone.now(),
+            )
+            if rejected:
+                messages.success(request, f"TVF {tvf.tvf_number} rejected to {target_phase_name} successfully!")
+            else:
+                messages.error(request, f"TVF {tvf.tvf_number} cannot be rejected as it is already in a final state.")
             return redirect('test_requests:coach_dashboard')
 
         except TestRequestPhaseDefinition.DoesNotExist:
@@ -832,31 +746,72 @@ def test_request_create_view(request):
     return redirect('test_requests:create_tvf')
 
 
-@login_required
-def test_request_list_view(request):
+def _tvf_list_queryset(request):
+    """
+    Builds the TVF list queryset for the requested view (backlog or shipped) and filters.
+    Returns (queryset, list settings, filter form).
+    """
     view_type = request.GET.get('view', 'backlog') # Default to 'backlog'
 
+    tvfs = TestRequest.objects.select_related(
+        'customer', 'project', 'tvf_initiator', 'status', 'current_phase'
+    )
     if view_type == 'shipped':
-        tvfs_to_display = TestRequest.objects.select_related(
-            'customer', 'project', 'tvf_initiator', 'status', 'current_phase'
-        ).filter(
-            status__name='Shipped'
-        ).order_by('-tvf_completed_date')
-        active_view = 'shipped'
-        title = "Shipped TVFs"
+        tvfs = tvfs.filter(status_id__in=registry.existing_status_ids(['Shipped']))
+        list_settings = {
+            'date_field': 'tvf_completed_date',
+            'default_sort': '-completed',
+            'active_view': 'shipped',
+            'title': "Shipped TVFs",
+        }
     else: # 'backlog' or any other value
-        tvfs_to_display = TestRequest.objects.select_related(
-            'customer', 'project', 'tvf_initiator', 'status', 'current_phase'
-        ).exclude(
-            Q(status__name='Shipped') | Q(status__name='Completed') | Q(status__name='Rejected') | Q(current_phase__name='TVF_CANCELLED')
-        ).order_by('-request_received_date')
-        active_view = 'backlog'
-        title = "Backlog TVFs (Open / Pending)"
+        tvfs = tvfs.exclude(
+            Q(status_id__in=registry.existing_status_ids(['Shipped', 'Completed', 'Rejected'])) |
+            Q(current_phase_id__in=registry.existing_phase_ids(['TVF_CANCELLED']))
+        )
+        list_settings = {
+            'date_field': 'request_received_date',
+            'default_sort': '-received',
+            'active_view': 'backlog',
+            'title': "Backlog TVFs (Open / Pending)",
+        }
+
+    filter_form = TVFListFilterForm(request.GET)
+    if filter_form.is_valid():
+        filters = filter_form.cleaned_data
+        for field in ('customer', 'project', 'tvf_environment', 'tvf_type'):
+            if filters[field]:
+                tvfs = tvfs.filter(**{field: filters[field]})
+        tvfs = tvfs.filter(
+            date_range_filter(list_settings['date_field'], filters['date_from'], filters['date_to'])
+        )
+    return tvfs, list_settings, filter_form
+
+
+@login_required
+def test_request_list_view(request):
+    tvfs_to_display, list_settings, filter_form = _tvf_list_queryset(request)
+
+    # Keyset pagination: each page seeks from the last row shown instead of counting an OFFSET
+    sort, sort_field, descending = parse_sort(request.GET.get('sort'), list_settings['default_sort'])
+    page = paginate(
+        tvfs_to_display, sort_field, descending,
+        after=request.GET.get('after'), before=request.GET.get('before'),
+    )
+
+    # The page's TVFs grouped in memory (no further queries); a single unlabelled group when not grouping
+    group_by = filter_form.cleaned_data['group'] if filter_form.is_valid() else ''
+    groups = group_tvfs(page, group_by) if group_by else [{'key': None, 'label': None, 'tvfs': page}]
 
     context = {
-        'tvfs': tvfs_to_display,
-        'active_view': active_view,
-        'title': title,
+        'tvfs': page,
+        'page': page,
+        'groups': groups,
+        'filter_form': filter_form,
+        'sort': sort,
+        'sort_descending': descending,
+        'active_view': list_settings['active_view'],
+        'title': list_settings['title'],
     }
     return render(request, 'test_requests/test_request_list.html', context)
 
@@ -874,11 +829,88 @@ def test_request_detail_view(request, pk):
 
     context = {
         'test_request': test_request,
-        'is_coach_or_superuser': is_coach(request.user) or request.user.is_superuser,
+        'is_coach_or_superuser': has_role(request, ROLE_COACH, allow_superuser=True),
+        'can_import_files': has_role(request, ROLE_PROJECT_MANAGER, ROLE_NPI, ROLE_COACH, allow_superuser=True),
+        'pan_import_form': PANImportForm(auto_id=False), # Rendered once per input file
+        'manifest_form': InputFileManifestForm(),
         # You can add more context here if certain buttons are only visible based on specific roles
     }
     return render(request, 'test_requests/test_request_detail.html', context)
 
+@login_required
+@role_required(ROLE_PROJECT_MANAGER, ROLE_NPI, ROLE_COACH, allow_superuser=True)
+def import_pans_view(request, input_file_id):
+    """
+    Bulk-loads truncated PANs into one input file from an uploaded CSV or zc_tvfpans export.
+    The file is parsed as a stream and inserted in batches; PANs already on the input file
+    are counted as duplicates. JSON clients get the counts, browsers a summary message.
+    """
+    input_file = get_object_or_404(TestRequestInputFile.objects.select_related('test_request'), pk=input_file_id)
+    detail_url = reverse('test_requests:detail', args=[input_file.test_request_id])
+    if request.method != 'POST':
+        return redirect(detail_url)
+
+    form = PANImportForm(request.POST, request.FILES)
+    if not form.is_valid():
+        if _wants_json(request):
+            return JsonResponse({'errors': form.errors}, status=400)
+        messages.error(request, "Please choose a PAN file to import.")
+        return redirect(detail_url)
+
+    result = import_pans(input_file, form.cleaned_data['pan_file'], form.cleaned_data['file_format'])
+    if _wants_json(request):
+        return JsonResponse(result.as_dict())
+
+    messages.success(
+        request,
+        f"{input_file.file_name}: imported {result.created} PAN(s), skipped {result.duplicates} duplicate(s).",
+    )
+    if result.invalid:
+        messages.warning(
+            request,
+            f"{result.invalid} line(s) were not valid PANs: " + "; ".join(result.errors[:5])
+            + ("..." if result.invalid > 5 else ""),
+        )
+    return redirect(detail_url)
+
+
+@login_required
+@role_required(ROLE_PROJECT_MANAGER, ROLE_NPI, ROLE_COACH, allow_superuser=True)
+def import_input_files_view(request, pk):
+    """
+    Creates or updates all of a TVF's input files from an uploaded CSV/JSON manifest in one
+    transaction. Rows that fail validation are skipped and reported with their row number.
+    """
+    test_request = get_object_or_404(TestRequest, pk=pk)
+    detail_url = reverse('test_requests:detail', args=[pk])
+    if request.method != 'POST':
+        return redirect(detail_url)
+
+    form = InputFileManifestForm(request.POST, request.FILES)
+    if not form.is_valid():
+        if _wants_json(request):
+            return JsonResponse({'errors': form.errors}, status=400)
+        messages.error(request, "Please choose a manifest file to import.")
+        return redirect(detail_url)
+
+    try:
+        result = import_input_file_manifest(test_request, form.cleaned_data['manifest'], form.cleaned_data['file_format'])
+    except ManifestError as e:
+        if _wants_json(request):
+            return JsonResponse({'errors': {'manifest': [str(e)]}}, status=400)
+        messages.error(request, str(e))
+        return redirect(detail_url)
+
+    if _wants_json(request):
+        return JsonResponse(result.as_dict(), status=400 if result.errors and not (result.created or result.updated) else 200)
+
+    messages.success(request, f"Input files: {result.created} created, {result.updated} updated.")
+    for row, errors in sorted(result.errors.items()):
+        details = "; ".join(f"{field}: {' '.join(field_errors)}" for field, field_errors in errors.items())
+        messages.error(request, f"Manifest row {row} was skipped ({details})")
+    return redirect(detail_url)
+
+
 @login_required
 def test_request_update_view(request, pk):
     tvf = get_object_or_404(TestRequest, pk=pk)
@@ -893,92 +925,62 @@ def test_request_update_view(request, pk):
     if request.user == tvf.tvf_initiator and tvf.status.name == 'Draft':
         can_edit = True
     # NPI users can always edit TVFs in their workflow (including rejected ones for NPI)
-    elif is_npi_user(request.user) and tvf.current_phase.name in ['TVF_RELEASED', 'TVF_DP_DONE', 'TVF_PROCESSED_AT_NPI', 'REWORK_AT_PROD']:
+    elif ROLE_NPI in request.roles and tvf.current_phase.name in ['TVF_RELEASED', 'TVF_DP_DONE', 'TVF_PROCESSED_AT_NPI', 'REWORK_AT_PROD']:
         can_edit = True
     # Project Managers can edit if rejected back to PM and they initiated it
-    elif is_project_manager(request.user) and tvf.current_phase.name == 'REWORK_AT_PM' and request.user == tvf.tvf_initiator:
+    elif ROLE_PROJECT_MANAGER in request.roles and tvf.current_phase.name == 'REWORK_AT_PM' and request.user == tvf.tvf_initiator:
         can_edit = True
     # Quality users can edit if rejected back to QA
-    elif is_quality_user(request.user) and tvf.current_phase.name == 'REWORK_AT_QA':
+    elif ROLE_QUALITY in request.roles and tvf.current_phase.name == 'REWORK_AT_QA':
         can_edit = True
     # Logistics users can edit if rejected back to Logistics
-    elif is_logistics_user(request.user) and tvf.current_phase.name == 'REWORK_AT_LOGISTICS':
+    elif ROLE_LOGISTICS in request.roles and tvf.current_phase.name == 'REWORK_AT_LOGISTICS':
         can_edit = True
     # Coaches and Superusers always have edit access
-    elif is_coach(request.user) or request.user.is_superuser:
+    elif ROLE_COACH in request.roles or request.user.is_superuser:
         can_edit = True
 
     if not can_edit:
         messages.error(request, f"You do not have permission to edit TVF {tvf.tvf_number} at its current stage ({tvf.status.name}, {tvf.current_phase.name}).")
         return redirect('test_requests:coach_dashboard') # Or detail view of the TVF
 
+    # Choice lists shared by every form and formset row on the page
+    choices = get_choice_provider(request)
+    plastic_code_kwargs = {'customer_id': tvf.customer_id, 'project_id': tvf.project_id, 'choices': choices}
+
     if request.method == 'POST':
         form = TestRequestForm(request.POST, instance=tvf) # Use tvf instead of test_request
-        plastic_formset = PlasticCodeFormSet(request.POST, instance=tvf, prefix='plastic_codes')
+        plastic_formset = PlasticCodeFormSet(request.POST, instance=tvf, prefix='plastic_codes', form_kwargs=plastic_code_kwargs)
         input_file_formset = InputFileFormSet(request.POST, instance=tvf, prefix='input_files')
-        shipping_form = TestRequestShippingForm(request.POST, instance=shipping_instance, prefix='shipping')
-        quality_form = TestRequestQualityForm(request.POST, instance=quality_instance, prefix='quality')
+        shipping_form = TestRequestShippingForm(request.POST, instance=shipping_instance, prefix='shipping', choices=choices)
+        quality_form = TestRequestQualityForm(request.POST, instance=quality_instance, prefix='quality', choices=choices)
 
 
-        pans_formsets = []
-        for i, input_file_form in enumerate(input_file_formset.forms):
-            if not input_file_form.cleaned_data.get('DELETE', False):
-                prefix = f'input_files-{i}-pans'
-                pan_formset = PanInlineFormSet(request.POST, instance=input_file_form.instance, prefix=prefix)
-                pans_formsets.append(pan_formset)
+        # One PAN formset per input file row, in the same order
+        pans_formsets = [
+            PanInlineFormSet(request.POST, instance=input_file_form.instance, prefix=f'input_files-{i}-pans')
+            for i, input_file_form in enumerate(input_file_formset.forms)
+        ]
 
-        is_valid = form.is_valid() and plastic_formset.is_valid() and input_file_formset.is_valid() \
-                   and shipping_form.is_valid() and quality_form.is_valid()
-        for pan_fs in pans_formsets:
-            is_valid = is_valid and pan_fs.is_valid()
+        is_valid = all([form.is_valid(), plastic_formset.is_valid(), input_file_formset.is_valid(),
+                        shipping_form.is_valid(), quality_form.is_valid()])
+        if is_valid:
+            # PANs of input files being deleted are not validated
+            is_valid = all([
+                pan_fs.is_valid() for input_file_form, pan_fs in zip(input_file_formset.forms, pans_formsets)
+                if not input_file_form.cleaned_data.get('DELETE')
+            ])
 
         if is_valid:
             try:
                 with transaction.atomic():
                     tvf_saved = form.save() # Use tvf_saved
 
-                    for p_form in plastic_formset.forms:
-                        if p_form.instance.pk: 
-                            if p_form.cleaned_data.get('DELETE'): 
-                                p_form.instance.delete()
-                                continue
-                        if p_form.has_changed():
-                            plastic_code_lookup = p_form.cleaned_data.get('plastic_code_lookup')
-                            manual_plastic_code = p_form.cleaned_data.get('manual_plastic_code')
-                            if plastic_code_lookup:
-                                p_form.instance.plastic_code_lookup = plastic_code_lookup
-                                p_form.instance.manual_plastic_code = None
-                            elif manual_plastic_code:
-                                p_form.instance.manual_plastic_code = manual_plastic_code
-                                p_form.instance.plastic_code_lookup = None
-                            p_form.instance.test_request = tvf_saved
-                            p_form.save()
-
-                    # Use tvf_saved for the instance, and corrected formset variable name
-                    saved_input_files = input_file_formset.save(commit=False)
-                    for i, input_file in enumerate(saved_input_files): # Corrected from saved_input_file_formset.forms
-                        if input_file.cleaned_data.get('DELETE'):
-                            if input_file.instance.pk:
-                                input_file.instance.delete()
-                            continue
-                        
-                        # Check if the form has actual data or changes to save, otherwise, it might create empty records
-                        if input_file.has_changed() or (not input_file.instance.pk and any(input_file.cleaned_data.values())):
-                            input_file_instance = input_file.save(commit=False)
-                            input_file_instance.test_request = tvf_saved
-                            input_file_instance.save()
-
-                            if i < len(pans_formsets):
-                                pan_fs_to_save = pans_formsets[i]
-                                for pan_form_instance in pan_fs_to_save.forms:
-                                    if pan_form_instance.cleaned_data.get('DELETE'):
-                                        if pan_form_instance.instance.pk:
-                                            pan_form_instance.instance.delete()
-                                        continue
-                                    if pan_form_instance.has_changed() or (not pan_form_instance.instance.pk and any(pan_form_instance.cleaned_data.values())):
-                                        pan_item = pan_form_instance.save(commit=False)
-                                        pan_item.test_request_input_file = input_file_instance
-                                        pan_item.save()
+                    # Plastic codes, input files and PANs are written in a few batched statements
+                    writer = TVFAggregateWriter(tvf_saved)
+                    writer.add_plastic_code_formset(plastic_formset)
+                    writer.add_input_file_formset(input_file_formset, pans_formsets)
+                    writer.save()
 
                     shipping_form.save()
                     quality_form.save()
@@ -992,10 +994,10 @@ def test_request_update_view(request, pk):
         else:
             messages.error(request, "Please correct the errors below.")
             # Re-instantiate formsets with POST data if validation fails, to show errors
-            plastic_formset = PlasticCodeFormSet(request.POST, instance=tvf, prefix='plastic_codes')
+            plastic_formset = PlasticCodeFormSet(request.POST, instance=tvf, prefix='plastic_codes', form_kwargs=plastic_code_kwargs)
             input_file_formset = InputFileFormSet(request.POST, instance=tvf, prefix='input_files')
-            shipping_form = TestRequestShippingForm(request.POST, instance=shipping_instance, prefix='shipping')
-            quality_form = TestRequestQualityForm(request.POST, instance=quality_instance, prefix='quality')
+            shipping_form = TestRequestShippingForm(request.POST, instance=shipping_instance, prefix='shipping', choices=choices)
+            quality_form = TestRequestQualityForm(request.POST, instance=quality_instance, prefix='quality', choices=choices)
 
             pans_formsets = []
             for i, input_file_form_revalidate in enumerate(input_file_formset.forms):
@@ -1007,10 +1009,10 @@ def test_request_update_view(request, pk):
 
     else:
         form = TestRequestForm(instance=tvf)
-        plastic_formset = PlasticCodeFormSet(instance=tvf, prefix='plastic_codes')
+        plastic_formset = PlasticCodeFormSet(instance=tvf, prefix='plastic_codes', form_kwargs=plastic_code_kwargs)
         input_file_formset = InputFileFormSet(instance=tvf, prefix='input_files')
-        shipping_form = TestRequestShippingForm(instance=shipping_instance, prefix='shipping')
-        quality_form = TestRequestQualityForm(instance=quality_instance, prefix='quality')
+        shipping_form = TestRequestShippingForm(instance=shipping_instance, prefix='shipping', choices=choices)
+        quality_form = TestRequestQualityForm(instance=quality_instance, prefix='quality', choices=choices)
 
         pans_formsets = []
         for i, input_file_form in enumerate(input_file_formset):
@@ -1034,20 +1036,116 @@ def test_request_update_view(request, pk):
     return render(request, 'test_requests/test_request_form.html', context)
 
 
+def _wants_json(request):
+    return 'application/json' in request.headers.get('Accept', '') or request.headers.get('X-Requested-With') == 'XMLHttpRequest'
+
+
 @login_required
 def test_request_pdf_view(request, pk):
-    test_request = get_object_or_404(TestRequest.objects.select_related(
-        'customer', 'project', 'tvf_initiator', 'tvf_type', 'tvf_environment', 'status', 'current_phase', 'trustport_folder_actual'
-    ).prefetch_related(
-        'plastic_codes_entries__plastic_code_lookup',
-        'input_files_entries__pans',
-        'quality_details__quality_sign_off_by',
-        'shipping_details__dispatch_method',
-        'shipping_details__shipping_sign_off_by'
-    ), pk=pk)
+    """
+    Queues the TVF's PDF for the background workers and returns straight away with the job handle.
+    JSON clients get the poll/download URLs; browsers get a page that polls until the file is ready.
+    """
+    wants_json = _wants_json(request)
+
+    # An unchanged TVF's PDF is served from the disk cache. The key comes from the TVF's version,
+    # not its rendered HTML, so nothing is rendered in the request
+    versions = pdf_versions(pk)
+    test_request = get_object_or_404(TestRequest.objects.only('pk', 'tvf_number', 'last_status_update'), pk=pk)
+    key = pdf_cache_key(test_request, versions)
+    cached_path = pdf_cache.get(key)
+    if cached_path is not None:
+        if wants_json:
+            return JsonResponse(_pdf_job_payload(cached_pdf_job(test_request, request.user, key)))
+        try:
+            return FileResponse(
+                open(cached_path, 'rb'), as_attachment=True,
+                filename=pdf_filename(test_request), content_type='application/pdf',
+            )
+        except FileNotFoundError: # Evicted since the lookup; render it again
+            pass
 
+    job = enqueue_pdf_job(test_request, request.user)
+    payload = _pdf_job_payload(job)
+    if wants_json:
+        return JsonResponse(payload, status=202)
     context = {
+        'test_request': test_request,
+        'job': job,
+        'status_url': payload['status_url'],
+    }
+    return render(request, 'test_requests/pdf_job_status.html', context)
+
+
+def _get_pdf_job(request, job_id):
+    job = get_object_or_404(PDFRenderJob.objects.select_related('test_request'), pk=job_id)
+    # Jobs are only visible to whoever queued them (and coaches/superusers)
+    if job.requested_by_id != request.user.pk and not has_role(request, ROLE_COACH, allow_superuser=True):
+        raise Http404("No PDF job matches the given query.")
+    return job
+
 
-        'test_request': test_request
+def _pdf_job_payload(job):
+    return {
+        'job_id': job.pk,
+        'status': job.status,
+        'status_url': reverse('test_requests:pdf_job_status', args=[job.pk]),
+        'download_url': reverse('test_requests:pdf_job_download', args=[job.pk]) if job.status == PDFRenderJob.STATUS_DONE else None,
+        'error': job.error,
     }
-    return render_to_pdf('test_requests/test_request_pdf_template.html', context)
\ No newline at end of file
+
+
+@login_required
+def pdf_job_status_view(request, job_id):
+    return JsonResponse(_pdf_job_payload(_get_pdf_job(request, job_id)))
+
+
+@login_required
+def pdf_job_download_view(request, job_id):
+    job = _get_pdf_job(request, job_id)
+    if job.status != PDFRenderJob.STATUS_DONE or not job.pdf_file:
+        messages.warning(request, f"The PDF for TVF {job.test_request.tvf_number} is not ready yet.")
+        return redirect('test_requests:pdf', pk=job.test_request_id)
+    try:
+        pdf_file = job.pdf_file.open('rb')
+    except FileNotFoundError: # Evicted from the PDF cache; queue a fresh render
+        return redirect('test_requests:pdf', pk=job.test_request_id)
+    return FileResponse(
+        pdf_file, as_attachment=True,
+        filename=pdf_filename(job.test_request), content_type='application/pdf',
+    )
+
+
+@login_required
+@role_required(*DASHBOARD_ROLES, allow_superuser=True)
+def bulk_pdf_export_view(request):
+    """
+    Streams a ZIP of TVF PDFs. Select the TVFs with ?bucket=<dashboard bucket>
+    or with the TVF list parameters (view, filters, sort).
+    """
+    bucket = request.GET.get('bucket')
+    if bucket:
+        bucket_names = buckets_for_roles(request.roles, request.user.is_superuser)
+        if bucket not in bucket_names:
+            messages.error(request, "You cannot export that dashboard queue.")
+            return redirect('test_requests:coach_dashboard')
+        tvf_ids = [row['pk'] for row in fetch_buckets([bucket], request.user)[bucket]]
+        archive_name = bucket
+    else:
+        tvfs, list_settings, _ = _tvf_list_queryset(request)
+        _, sort_field, descending = parse_sort(request.GET.get('sort'), list_settings['default_sort'])
+        tvf_ids = list(tvfs.order_by(('-' if descending else '') + sort_field).values_list('pk', flat=True)[:MAX_EXPORT_TVFS + 1])
+        archive_name = f"{list_settings['active_view']}_tvfs"
+
+    if not tvf_ids:
+        messages.info(request, "There are no TVFs to export.")
+        return redirect(f"{reverse('test_requests:list')}?{request.GET.urlencode()}")
+    if len(tvf_ids) > MAX_EXPORT_TVFS:
+        messages.error(request, f"Exports are limited to {MAX_EXPORT_TVFS} TVFs; please narrow the filters.")
+        return redirect(f"{reverse('test_requests:list')}?{request.GET.urlencode()}")
+
+    # Under ASGI a sync iterator would be buffered in full before anything is sent
+    stream = astream_pdf_zip if isinstance(request, ASGIRequest) else stream_pdf_zip
+    response = StreamingHttpResponse(stream(tvf_ids, request.user), content_type='application/zip')
+    response['Content-Disposition'] = f'attachment; filename="{archive_name}_{timezone.now():%Y%m%d_%H%M}.zip"'
+    return response
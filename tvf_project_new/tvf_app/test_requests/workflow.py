@@ -0,0 +1,397 @@
+# tvf_app/test_requests/workflow.py
+import threading
+
+from django.db import transaction
+from django.db.models import Case, F, Value, When
+from django.db.models.functions import Coalesce, Concat
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+from django.utils import timezone
+
+from . import audit, dashboard, live, queue_counters
+from .models import QUEUE_STATES, TestRequest, TestRequestPhaseDefinition, TVFQueue, TVFStatus
+from .phase_logs import record_phase_changes
+from .roles import ROLE_NPI, ROLE_QUALITY, ROLE_LOGISTICS, ROLE_COACH, DASHBOARD_ROLES
+from .versioning import bump_version, get_version
+
+REGISTRY_VERSION = 'workflow:registry'
+
+# Statuses a TVF can no longer leave through the normal workflow
+FINAL_STATUSES = ('Completed', 'Shipped', 'Cancelled')
+
+# Status given to a TVF rejected back to a phase
+REJECT_STATUS_MAP = {
+    'PM_DRAFT': 'Rejected to PM',
+    'PROJECT_MANAGER': 'Rejected to PM', # Rejection to PROJECT_MANAGER phase should also set 'Rejected to PM' status
+    'REWORK_AT_PM': 'Rejected to PM',
+    'TVF_RELEASED': 'Rejected to NPI',
+    'TVF_DP_DONE': 'Rejected to NPI',
+    'TVF_PROCESSED_AT_NPI': 'Rejected to NPI',
+    'REWORK_AT_PROD': 'Rejected to NPI',
+    'TVF_OPEN_AT_QA': 'Rejected to Quality',
+    'TVF_VALIDATED_AT_QA': 'Rejected to Quality',
+    'REWORK_AT_QA': 'Rejected to Quality',
+    'TVF_OPEN_AT_LOGISTICS': 'Rejected to Logistics',
+    'REWORK_AT_LOGISTICS': 'Rejected to Logistics',
+}
+DEFAULT_REJECT_STATUS = 'Rejected'
+
+# --- Declarative transition table ---
+# roles:           groups allowed to run the transition ('superuser' lets superusers through too)
+# from_phases:     phases the TVF must currently be in (None = any phase)
+# from_statuses:   statuses the TVF must currently have (None = any status)
+# exclude_statuses: statuses the TVF must not have
+# to_status / to_phase: target status name and (phase name, default order)
+# comments:        'replace' overwrites the comments, otherwise a label to append under
+TRANSITIONS = {
+    'dp_done': {
+        'roles': {ROLE_NPI},
+        'from_phases': ['TVF_RELEASED', 'REWORK_AT_PROD'],
+        'to_status': 'DP Done',
+        'to_phase': ('TVF_DP_DONE', 3),
+        'comments': 'replace',
+        'clear_rejected': True,
+    },
+    'tvf_output': {
+        'roles': {ROLE_NPI},
+        'from_phases': ['TVF_DP_DONE'],
+        'to_status': 'TVF Processed',
+        'to_phase': ('TVF_PROCESSED_AT_NPI', 4),
+        'comments': 'replace',
+        'clear_rejected': True,
+    },
+    'push_to_qa': {
+        'roles': {ROLE_NPI},
+        'from_phases': ['TVF_PROCESSED_AT_NPI'],
+        'to_status': 'Open at QA',
+        'to_phase': ('TVF_OPEN_AT_QA', 5),
+        'comments': 'replace',
+        'clear_rejected': True,
+    },
+    'back_to_released': {
+        'roles': {ROLE_NPI},
+        'from_phases': ['TVF_DP_DONE', 'TVF_PROCESSED_AT_NPI', 'REWORK_AT_PROD'],
+        'to_status': 'TVF_SUBMITTED',
+        'to_phase': ('TVF_RELEASED', 2),
+        'comments': 'replace',
+        'clear_rejected': True,
+    },
+    'back_to_dp_done': {
+        'roles': {ROLE_NPI},
+        'from_phases': ['TVF_PROCESSED_AT_NPI', 'REWORK_AT_PROD'],
+        'to_status': 'DP Done',
+        'to_phase': ('TVF_DP_DONE', 3),
+        'comments': 'replace',
+        'clear_rejected': True,
+    },
+    'qa_validate': {
+        'roles': {ROLE_QUALITY},
+        'from_phases': ['TVF_OPEN_AT_QA', 'REWORK_AT_QA'],
+        'to_status': 'Validated',
+        'to_phase': ('TVF_VALIDATED_AT_QA', 6),
+        'comments': 'replace',
+        'clear_rejected': True,
+    },
+    'qa_to_logistics': {
+        'roles': {ROLE_QUALITY},
+        'from_phases': ['TVF_VALIDATED_AT_QA'],
+        'to_status': 'Open at Logistics',
+        'to_phase': ('TVF_OPEN_AT_LOGISTICS', 7),
+        'comments': 'replace',
+        'clear_rejected': True,
+    },
+    'ship': {
+        'roles': {ROLE_LOGISTICS},
+        'from_phases': ['TVF_OPEN_AT_LOGISTICS', 'REWORK_AT_LOGISTICS'],
+        'to_status': 'Shipped',
+        'to_phase': ('TVF_SHIPPED', 14),
+        'comments': 'replace',
+        'clear_rejected': True,
+        'completes': True,
+    },
+    'complete': {
+        'roles': {ROLE_COACH, 'superuser'},
+        'from_phases': ['TVF_SHIPPED'],
+        'from_statuses': ['Shipped'],
+        'to_status': 'Completed',
+        'to_phase': ('TVF_COMPLETED', 8),
+        'comments': 'COMPLETED',
+        'completes': True,
+    },
+    'cancel': {
+        'roles': {ROLE_COACH, 'superuser'},
+        'exclude_statuses': FINAL_STATUSES,
+        'to_status': 'Cancelled',
+        'to_phase': ('TVF_CANCELLED', 9),
+        'comments': 'CANCELLED',
+        'clear_rejected': True,
+        'completes': True, # Mark as completed for archiving purposes
+    },
+    'reject': {
+        'roles': DASHBOARD_ROLES | {'superuser'},
+        'exclude_statuses': FINAL_STATUSES,
+        'to_status': None, # Derived from the target phase via REJECT_STATUS_MAP
+        'to_phase': None,  # Chosen by the user
+        'comments': 'REJECTED',
+    },
+}
+
+
+class TransitionError(Exception):
+    """
+    Raised when a transition does not exist or the user may not perform it.
+    """
+
+
+class WorkflowRegistry:
+    """
+    Process-local map of TVFStatus and TestRequestPhaseDefinition names to primary keys,
+    and of (phase id, status id) pairs to the TVFQueue they put a TVF in (see QUEUE_STATES).
+    Loaded on first use and reloaded whenever either table changes.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._version = None
+        self._status_ids = {}
+        self._phase_ids = {}
+        self._queues = {}
+
+    def _ensure_loaded(self):
+        version = get_version(REGISTRY_VERSION)
+        if version == self._version:
+            return
+        with self._lock:
+            if version == self._version:
+                return
+            self._status_ids = dict(TVFStatus.objects.values_list('name', 'pk'))
+            self._phase_ids = dict(TestRequestPhaseDefinition.objects.values_list('name', 'pk'))
+            self._queues = {
+                (self._phase_ids[phase], self._status_ids[status]): (queue, rejected_only)
+                for phase, status, rejected_only, queue in QUEUE_STATES
+                if phase in self._phase_ids and status in self._status_ids
+            }
+            self._version = version
+
+    def status_id(self, name, create=True):
+        """
+        Returns the pk of the status `name`, creating it if it does not exist yet.
+        Returns None for a missing status when `create` is False.
+        """
+        self._ensure_loaded()
+        pk = self._status_ids.get(name)
+        if pk is None and create:
+            pk = TVFStatus.objects.get_or_create(name=name)[0].pk
+            self._status_ids[name] = pk
+        return pk
+
+    def phase_id(self, name, order=None):
+        """
+        Returns the pk of the phase `name`.
+        Missing phases are created when a default `order` is given,
+        otherwise TestRequestPhaseDefinition.DoesNotExist is raised.
+        """
+        self._ensure_loaded()
+        pk = self._phase_ids.get(name)
+        if pk is None:
+            if order is None:
+                raise TestRequestPhaseDefinition.DoesNotExist(f"Phase '{name}' does not exist.")
+            pk = TestRequestPhaseDefinition.objects.get_or_create(name=name, defaults={'order': order})[0].pk
+            self._phase_ids[name] = pk
+        return pk
+
+    def existing_status_ids(self, names):
+        self._ensure_loaded()
+        return [self._status_ids[name] for name in names if name in self._status_ids]
+
+    def existing_phase_ids(self, names):
+        self._ensure_loaded()
+        return [self._phase_ids[name] for name in names if name in self._phase_ids]
+
+    def status_names(self):
+        """
+        {pk: name} of every status.
+        """
+        self._ensure_loaded()
+        return {pk: name for name, pk in self._status_ids.items()}
+
+    def phase_names(self):
+        """
+        {pk: name} of every phase.
+        """
+        self._ensure_loaded()
+        return {pk: name for name, pk in self._phase_ids.items()}
+
+    def queue_value(self, phase_id, status_id, is_rejected=None):
+        """
+        The TVFQueue of a TVF in the given phase and status. When `is_rejected` is None (not
+        changed by an UPDATE) and the queue depends on it, returns an expression reading the
+        row's is_rejected column instead.
+        """
+        self._ensure_loaded()
+        queue, rejected_only = self._queues.get((phase_id, status_id), (TVFQueue.NONE, False))
+        if not rejected_only:
+            return queue
+        if is_rejected is None:
+            return Case(When(is_rejected=True, then=Value(queue)), default=Value(TVFQueue.NONE))
+        return queue if is_rejected else TVFQueue.NONE
+
+    def queue_expression(self):
+        """
+        The queue of every row computed from its phase, status and is_rejected columns,
+        for checking or rewriting TestRequest.queue in bulk.
+        """
+        self._ensure_loaded()
+        whens = [
+            When(current_phase_id=phase_id, status_id=status_id, **({'is_rejected': True} if rejected_only else {}), then=Value(queue))
+            for (phase_id, status_id), (queue, rejected_only) in self._queues.items()
+        ]
+        return Case(*whens, default=Value(TVFQueue.NONE)) if whens else Value(TVFQueue.NONE)
+
+
+registry = WorkflowRegistry()
+
+
+@receiver(post_save, sender=TVFStatus)
+@receiver(post_delete, sender=TVFStatus)
+@receiver(post_save, sender=TestRequestPhaseDefinition)
+@receiver(post_delete, sender=TestRequestPhaseDefinition)
+def invalidate_workflow_registry(sender, **kwargs):
+    bump_version(REGISTRY_VERSION)
+
+
+def can_perform(request, name):
+    """
+    True if the requesting user's roles allow the named transition.
+    """
+    allowed = TRANSITIONS[name]['roles']
+    if 'superuser' in allowed and request.user.is_superuser:
+        return True
+    return not request.roles.isdisjoint(allowed)
+
+
+def _prepare_transition(request, name, comments, target_phase, extra_fields):
+    """
+    Checks the named transition and returns (transition, target phase id, field updates, time of the change).
+    """
+    transition = TRANSITIONS.get(name)
+    if transition is None:
+        raise TransitionError(f"Unknown transition '{name}'.")
+    if not can_perform(request, name):
+        raise TransitionError(f"You are not allowed to perform '{name}'.")
+
+    now = timezone.now()
+    if transition['to_phase']:
+        target_phase = transition['to_phase'][0]
+        phase_id = registry.phase_id(*transition['to_phase'])
+    else:
+        phase_id = registry.phase_id(target_phase)
+    status_name = transition['to_status'] or REJECT_STATUS_MAP.get(target_phase, DEFAULT_REJECT_STATUS)
+
+    updates = {
+        'status_id': registry.status_id(status_name),
+        'current_phase_id': phase_id,
+        'last_status_update': now,
+    }
+    if transition.get('clear_rejected'):
+        updates['is_rejected'] = False
+    if transition.get('completes'):
+        updates['tvf_completed_date'] = now
+
+    comment_mode = transition.get('comments')
+    if comment_mode == 'replace':
+        updates['comments'] = comments
+    elif comment_mode:
+        suffix = f" (To {target_phase})" if transition['to_phase'] is None else ""
+        updates['comments'] = Concat(
+            Coalesce(F('comments'), Value('')),
+            Value(f"\n\n{comment_mode} by {request.user.username}: {comments}{suffix}"),
+        )
+    updates.update(extra_fields)
+    updates['queue'] = registry.queue_value(phase_id, updates['status_id'], updates.get('is_rejected'))
+    return transition, phase_id, updates, now
+
+
+def _in_source_state(queryset, transition):
+    """
+    Narrows `queryset` to the TVFs the transition may move.
+    """
+    if transition.get('from_phases') is not None:
+        queryset = queryset.filter(current_phase_id__in=registry.existing_phase_ids(transition['from_phases']))
+    if transition.get('from_statuses') is not None:
+        queryset = queryset.filter(status_id__in=registry.existing_status_ids(transition['from_statuses']))
+    if transition.get('exclude_statuses'):
+        queryset = queryset.exclude(status_id__in=registry.existing_status_ids(transition['exclude_statuses']))
+    return queryset
+
+
+def _audited_values(updates):
+    """
+    The updates whose new value is known without reading the row back (not expressions such as the comment append).
+    """
+    return {field: value for field, value in updates.items() if not hasattr(value, 'resolve_expression')}
+
+
+def perform_transition(request, tvf, name, comments='', target_phase=None, **extra_fields):
+    """
+    Moves `tvf` through the named transition. The row is locked only while it is still in an
+    allowed source state, so concurrent clicks cannot move it twice. The queue it leaves and the
+    audited old values are read with the lock, never taken from `tvf`, which may be stale. The
+    TVF's open phase log is closed, the next one opened and the queue counters moved in the same
+    transaction; the dashboard buckets it left and entered are invalidated and the move is pushed
+    to live dashboards once it commits.
+    Returns True if the TVF moved, False if it was not in a valid source state.
+    """
+    transition, phase_id, updates, now = _prepare_transition(request, name, comments, target_phase, extra_fields)
+
+    audited = _audited_values(updates)
+    with transaction.atomic():
+        locked = _in_source_state(TestRequest.objects.select_for_update().filter(pk=tvf.pk), transition)
+        row = locked.values('pk', 'customer_id', *{'queue', *audited}).first()
+        if row is None:
+            return False
+        TestRequest.objects.filter(pk=tvf.pk).update(**updates)
+        record_phase_changes([tvf.pk], phase_id, request.user, comments, now)
+        moves = queue_counters.record_transition([row], updates['queue'])
+        dashboard.invalidate_buckets(moves)
+        live.publish_queue_moves(moves)
+        audit.record(audit.field_changes(TestRequest, tvf.pk, {
+            field: (row[field], value) for field, value in audited.items()
+        }))
+
+    # Keep the in-memory instance in step with the row, without reloading it
+    for field, value in audited.items():
+        if field != 'comments':
+            setattr(tvf, field, value)
+    tvf.queue = moves[0][2]
+    return True
+
+
+def perform_bulk_transition(request, tvf_ids, name, comments='', target_phase=None, **extra_fields):
+    """
+    Moves every TVF in `tvf_ids` that is in an allowed source state through the named transition.
+    The eligible rows are locked, moved with one UPDATE, and their phase logs closed and opened
+    with one UPDATE and one INSERT, and the queue counters moved with one UPDATE per customer
+    and queue touched, all in one transaction, however many TVFs are given.
+    Returns the ids of the TVFs that moved.
+    """
+    transition, phase_id, updates, now = _prepare_transition(request, name, comments, target_phase, extra_fields)
+
+    audited = _audited_values(updates)
+    with transaction.atomic():
+        locked = _in_source_state(TestRequest.objects.select_for_update().filter(pk__in=list(tvf_ids)), transition)
+        # The old values of the audited fields and the counted queue come with the lock, not from a second query
+        rows = list(locked.values('pk', 'customer_id', *{'queue', *audited}))
+        moved = [row['pk'] for row in rows]
+        if moved:
+            TestRequest.objects.filter(pk__in=moved).update(**updates)
+            record_phase_changes(moved, phase_id, request.user, comments, now)
+            moves = queue_counters.record_transition(rows, updates['queue'])
+            dashboard.invalidate_buckets(moves)
+            live.publish_queue_moves(moves)
+            audit.record([
+                entry for row in rows
+                for entry in audit.field_changes(TestRequest, row['pk'], {
+                    field: (row[field], value) for field, value in audited.items()
+                })
+            ])
+    return moved
@@ -14,3 +14,8 @@ from django.core.asgi import get_asgi_application
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'tvf_app.settings')
 
 application = get_asgi_application()
+
+# Audit entries are written by a background thread in the server process (see test_requests/audit.py)
+from test_requests.audit import writer as audit_writer  # noqa: E402
+
+audit_writer.start()
@@ -37,6 +37,8 @@ MIDDLEWARE = [
     'django.middleware.common.CommonMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
     'django.contrib.auth.middleware.AuthenticationMiddleware',
+    'test_requests.middleware.RoleMiddleware',  # request.roles, resolved once per request
+    'test_requests.audit.AuditUserMiddleware',  # the user the audit log attributes changes to
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
 ]
@@ -55,6 +57,7 @@ TEMPLATES = [
                 'django.template.context_processors.request',
                 'django.contrib.auth.context_processors.auth',
                 'django.contrib.messages.context_processors.messages',
+                'test_requests.context_processors.roles',
             ],
         },
     },
@@ -81,6 +84,30 @@ DATABASES = {
 }
 
 
+# Cache
+# Required to be shared by every process (web workers, ASGI workers, pdf_worker, management commands):
+# the version tokens in test_requests/versioning.py that invalidate cached roles, the workflow registry,
+# reference data, holidays, choice lists and dashboard fragments live here. In production set the
+# TVF_REDIS_URL environment variable (e.g. redis://127.0.0.1:6379/1); RedisCache needs the `redis`
+# package (pip install redis). Without it each process gets its own LocMemCache, which is enough for
+# development and tests but only invalidates the process that made a change; the test_requests.W001
+# system check warns about it.
+TVF_REDIS_URL = os.environ.get('TVF_REDIS_URL')
+if TVF_REDIS_URL:
+    CACHES = {
+        'default': {
+            'BACKEND': 'django.core.cache.backends.redis.RedisCache',
+            'LOCATION': TVF_REDIS_URL,
+        }
+    }
+else:
+    CACHES = {
+        'default': {
+            'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        }
+    }
+
+
 # Password validation
 # https://docs.djangoproject.com/en/5.2/ref/settings/#auth-password-validators
 
@@ -120,6 +147,27 @@ STATICFILES_DIRS = [BASE_DIR / 'static']  # Create a 'static' folder in your BAS
 MEDIA_URL = '/media/'
 MEDIA_ROOT = BASE_DIR / 'media'
 
+# Rendered TVF PDFs are cached under MEDIA_ROOT/pdf_cache; least recently used files go past this size
+TVF_PDF_CACHE_MAX_BYTES = 500 * 1024 * 1024
+# Finished PDF render jobs (and any files of their own under pdf_jobs/) are purged by the workers after this many days
+TVF_PDF_JOB_RETENTION_DAYS = 7
+# Bulk PDF exports wait this many seconds per batch for the pdf_worker before writing error entries instead
+TVF_PDF_EXPORT_WAIT_SECONDS = 120
+
+# Audit entries that could not be written to the database are spooled here and replayed at startup
+TVF_AUDIT_SPOOL_DIR = BASE_DIR / 'audit_spool'
+
+# Audit log rows older than this many days are moved to compressed archive files by archive_audit_logs
+TVF_AUDIT_RETENTION_DAYS = 180
+TVF_AUDIT_ARCHIVE_DIR = BASE_DIR / 'audit_archive'
+
+# Live dashboard events (served under ASGI only). LocalBroadcaster suits a single process; with several
+# workers use 'test_requests.live.RedisBroadcaster' and set TVF_LIVE_REDIS_URL
+TVF_LIVE_BROADCASTER = 'test_requests.live.LocalBroadcaster'
+
+# Longest a dashboard bucket fragment is served from the cache; moves into or out of the bucket invalidate it sooner
+TVF_DASHBOARD_FRAGMENT_TIMEOUT = 10 * 60
+
 
 # Default primary key field type
 # https://docs.djangoproject.com/en/5.2/ref/settings/#default-auto-field